@@ -0,0 +1,473 @@
+from build import PLACES_YAML, run_stages, site_stages
+from datasette.plugins import pm
+from fetch_noaa_tide_times import prediction_window
+from harmonic_tides import constituent_speed, predict_station
+from prerender_places import site_datasette
+import asyncio
+import click
+import datetime
+import httpx
+import json
+import numpy
+import pathlib
+import platform
+import pytz
+import sqlite_utils
+import statistics
+import sys
+import tempfile
+import time
+import urllib.parse
+import yaml
+
+# Times the build stages from script/build, run against synthetic NOAA and
+# iNaturalist APIs, and the functions behind a place page render, optionally
+# comparing the results with a baseline saved by an earlier run.
+
+root = pathlib.Path(__file__).parent.resolve()
+TIME_ZONE = "America/Los_Angeles"
+# Typical constituents for the California coast: (name, amplitude in feet)
+CONSTITUENTS = (
+    ("M2", 1.75),
+    ("K1", 1.2),
+    ("O1", 0.75),
+    ("S2", 0.45),
+    ("N2", 0.4),
+    ("P1", 0.37),
+    ("K2", 0.13),
+    ("Q1", 0.13),
+    ("M4", 0.02),
+)
+
+
+def synthetic_harmonics(stations, seed=0):
+    # {station_id: (z0, constituents)} with amplitudes and phases varied per
+    # station, so every station has a realistic but different tide curve
+    random = numpy.random.default_rng(seed)
+    harmonics = {}
+    for i in range(stations):
+        station_id = 9400000 + i
+        harmonics[station_id] = (
+            3.2 + random.uniform(-0.3, 0.3),
+            [
+                {
+                    "name": name,
+                    "amplitude": amplitude * random.uniform(0.8, 1.2),
+                    "phase": random.uniform(0, 360),
+                }
+                for name, amplitude in CONSTITUENTS
+            ],
+        )
+    return harmonics
+
+
+class SyntheticDatagetter:
+    # ASGI stand-in for the NOAA datagetter API, predicting each station's
+    # tides from its synthetic harmonics, up to last_day
+    def __init__(self, harmonics, last_day):
+        self.harmonics = harmonics
+        self.last_day = last_day
+
+    async def __call__(self, scope, receive, send):
+        params = dict(urllib.parse.parse_qsl(scope["query_string"].decode("utf-8")))
+        begin_date = datetime.datetime.strptime(params["begin_date"], "%Y%m%d").date()
+        end_date = min(
+            datetime.datetime.strptime(params["end_date"], "%Y%m%d").date(),
+            self.last_day,
+        )
+        z0, constituents = self.harmonics[int(params["station"])]
+        predictions = []
+        if begin_date <= end_date:
+            predictions = predict_station(
+                constituents, z0, pytz.timezone(TIME_ZONE), begin_date, end_date
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/csv")],
+            }
+        )
+        await send(
+            {
+                "type": "http.response.body",
+                "body": predictions_csv(predictions).encode(),
+            }
+        )
+
+
+def predictions_csv(predictions):
+    # The datagetter API's format=csv response for a list of predictions
+    return "Date Time, Prediction\n" + "".join(
+        "{},{}\n".format(p["t"], p["v"]) for p in predictions
+    )
+
+
+class SyntheticINaturalist:
+    # ASGI stand-in for the iNaturalist API, with species species and
+    # observations observations near every place
+    def __init__(self, species=60, observations=400):
+        self.species = species
+        self.observations = observations
+
+    def taxon(self, i):
+        return {
+            "id": i,
+            "name": "Taxon {}".format(i),
+            "preferred_common_name": "Species {}".format(i),
+            "wikipedia_url": "https://en.wikipedia.org/wiki/Taxon_{}".format(i),
+            "default_photo": {"square_url": "https://example.com/{}.jpg".format(i)},
+        }
+
+    async def __call__(self, scope, receive, send):
+        params = dict(urllib.parse.parse_qsl(scope["query_string"].decode("utf-8")))
+        per_page = int(params["per_page"])
+        if scope["path"].endswith("/species_counts"):
+            page = int(params["page"])
+            species = [
+                {"count": self.species + 1 - i, "taxon": self.taxon(i)}
+                for i in range(1, self.species + 1)
+            ][(page - 1) * per_page : page * per_page]
+            data = {"total_results": self.species, "results": species}
+        else:
+            id_below = int(params.get("id_below", self.observations + 1))
+            data = {
+                "results": [
+                    {
+                        "id": i,
+                        "taxon": self.taxon(i % self.species + 1),
+                        "observed_on": "2020-08-19",
+                        "quality_grade": "research",
+                        "user": {"login": "user{}".format(i % 50)},
+                        "observation_photos": [
+                            {"photo": {"url": "https://example.com/square.jpg"}}
+                        ],
+                    }
+                    for i in range(min(id_below - 1, self.observations), 0, -1)
+                ][:per_page]
+            }
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+class SyntheticMetadata:
+    # ASGI stand-in for the NOAA metadata API, with each station's synthetic
+    # harmonics and datums, and a station list of all of them
+    def __init__(self, harmonics):
+        self.harmonics = harmonics
+
+    def data(self, path):
+        if path.endswith("/children.json"):
+            return {
+                "stationList": [
+                    {
+                        "stationId": str(station_id),
+                        "lat": 37.0 + i / 10,
+                        "lon": -122.0,
+                        "geoGroupName": "Synthetic {}".format(station_id),
+                    }
+                    for i, station_id in enumerate(sorted(self.harmonics))
+                ]
+            }
+        station_id = int(path.split("/")[-2])
+        z0, constituents = self.harmonics[station_id]
+        if path.endswith("/harcon.json"):
+            return {
+                "HarmonicConstituents": [
+                    {
+                        "name": c["name"],
+                        "amplitude": c["amplitude"],
+                        "phase_GMT": c["phase"],
+                        "speed": constituent_speed(c["name"]),
+                    }
+                    for c in constituents
+                ]
+            }
+        return {
+            "datums": [{"name": "MSL", "value": z0}, {"name": "MLLW", "value": 0.0}]
+        }
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send(
+            {
+                "type": "http.response.body",
+                "body": json.dumps(self.data(scope["path"])).encode(),
+            }
+        )
+
+
+def synthetic_apis(harmonics, last_day):
+    # One ASGI app standing in for every API the build fetches from, routed
+    # by path, which is different for each of them
+    datagetter = SyntheticDatagetter(harmonics, last_day)
+    metadata = SyntheticMetadata(harmonics)
+    inaturalist = SyntheticINaturalist()
+
+    async def app(scope, receive, send):
+        if scope["path"].startswith("/mdapi/"):
+            await metadata(scope, receive, send)
+        elif scope["path"].startswith("/v1/"):
+            await inaturalist(scope, receive, send)
+        else:
+            await datagetter(scope, receive, send)
+
+    return app
+
+
+def write_places(path, harmonics, places):
+    # The real places, with the first places of them live and spread across
+    # the synthetic stations. Places are repeated with numbered slugs if
+    # there are not enough.
+    originals = sorted(
+        yaml.safe_load(open(PLACES_YAML)), key=lambda place: place["slug"]
+    )
+    station_ids = sorted(harmonics)
+    rows = []
+    for i in range(max(places, len(originals))):
+        place = dict(originals[i % len(originals)])
+        if i >= len(originals):
+            place["slug"] = "{}-{}".format(place["slug"], i // len(originals) + 1)
+        place["live_on_site"] = int(i < places)
+        place["station_id"] = station_ids[i % len(station_ids)]
+        place["time_zone"] = TIME_ZONE
+        rows.append(place)
+    pathlib.Path(path).write_text(yaml.safe_dump(rows))
+
+
+def synthetic_build(directory, harmonics, places, days, today, only=None):
+    # Runs the stages of script/build, or just the ones named in only, into
+    # a new data.db in directory, with every API replaced by a synthetic one.
+    # Returns the results from run_stages.
+    directory = pathlib.Path(directory)
+    db_path = directory / "data.db"
+    db_path.unlink(missing_ok=True)
+    places_yaml = directory / "places.yml"
+    write_places(places_yaml, harmonics, places)
+    # Predictions for days days, starting with yesterday
+    window = days - 1
+    db = sqlite_utils.Database(str(db_path))
+    stages = site_stages(
+        db,
+        str(db_path),
+        str(directory / "prerendered"),
+        full=True,
+        transport=httpx.ASGITransport(
+            app=synthetic_apis(harmonics, prediction_window(today, window)[1])
+        ),
+        today=today,
+        days=window,
+        places_yaml=places_yaml,
+        harvester_options={"rate": 1e6, "burst": 1000},
+    )
+    try:
+        results = asyncio.run(run_stages(stages, db, only=only))
+    finally:
+        db.close()
+    failed = [name for name, result in results.items() if result["status"] != "ok"]
+    if failed:
+        raise ValueError("Build stages failed: {}".format(", ".join(failed)))
+    return results
+
+
+async def render_benchmarks(db_path, slug, day, repeat):
+    # {name: [seconds for each run]} for the work behind a place page
+    datasette = site_datasette(db_path, root)
+    await datasette.invoke_startup()
+    template_vars = pm.get_plugin("template_vars.py").extra_template_vars(datasette)
+    page_cache = pm.get_plugin("urls.py").page_cache
+    days = await template_vars["get_tide_data_for_next_30_days"](slug)
+
+    async def place_page():
+        # Every run is a fresh render, not a cached page
+        page_cache.pages.clear()
+        response = await client.get("http://localhost/us/{}".format(slug))
+        assert response.status_code == 200
+
+    async def best_low_tides():
+        response = await client.get("http://localhost/best-low-tides.json?k=50")
+        assert response.status_code == 200
+
+    benchmarks = {
+        "tide_data_for_place": lambda: template_vars["tide_data_for_place"](slug, day),
+        "get_tide_data_for_next_30_days": lambda: template_vars[
+            "get_tide_data_for_next_30_days"
+        ](slug),
+        "calculate_best_times": lambda: template_vars["calculate_best_times"](days),
+        "place_page": place_page,
+        "best_low_tides": best_low_tides,
+    }
+    timings = {}
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=datasette.app())
+    ) as client:
+        for name, benchmark in benchmarks.items():
+            # One untimed run to warm up caches and connections
+            await benchmark()
+            timings["render." + name] = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                await benchmark()
+                timings["render." + name].append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmarks(
+    directory, stations=4, places=8, days=366, repeat=5, build_repeat=1, today=None
+):
+    # Returns machine readable results: the parameters plus min, median and
+    # max seconds for each benchmark
+    today = today or datetime.date.today()
+    db_path = str(pathlib.Path(directory) / "data.db")
+    harmonics = synthetic_harmonics(stations)
+    timings = {}
+    for _ in range(build_repeat):
+        start = time.perf_counter()
+        results = synthetic_build(directory, harmonics, places, days, today)
+        timings.setdefault("build.total", []).append(time.perf_counter() - start)
+        for name, result in results.items():
+            timings.setdefault("build." + name, []).append(result["seconds"])
+    slug = next(
+        sqlite_utils.Database(db_path)["places"].rows_where("live_on_site = 1")
+    )["slug"]
+    timings.update(asyncio.run(render_benchmarks(db_path, slug, today, repeat)))
+    return {
+        "parameters": {
+            "stations": stations,
+            "places": places,
+            "days": days,
+            "repeat": repeat,
+            "build_repeat": build_repeat,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "system": platform.system(),
+        },
+        "benchmarks": {
+            name: {
+                "min": min(seconds),
+                "median": statistics.median(seconds),
+                "max": max(seconds),
+                "runs": len(seconds),
+            }
+            for name, seconds in timings.items()
+        },
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    # Returns a row per benchmark: (name, baseline median, median, ratio,
+    # regressed). Benchmarks missing from either side have None for ratio.
+    rows = []
+    previous = baseline.get("benchmarks", {})
+    for name in sorted(set(results["benchmarks"]) | set(previous)):
+        before = previous.get(name, {}).get("median")
+        after = results["benchmarks"].get(name, {}).get("median")
+        ratio = after / before if before and after is not None else None
+        rows.append(
+            (name, before, after, ratio, ratio is not None and ratio > 1 + tolerance)
+        )
+    return rows
+
+
+def format_comparison(rows):
+    def ms(seconds):
+        return "-" if seconds is None else "{:.2f}ms".format(seconds * 1000)
+
+    lines = ["{:<42} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "now", "")]
+    for name, before, after, ratio, regressed in rows:
+        lines.append(
+            "{:<42} {:>12} {:>12} {:>8}{}".format(
+                name,
+                ms(before),
+                ms(after),
+                "-" if ratio is None else "{:.2f}x".format(ratio),
+                "  REGRESSED" if regressed else "",
+            )
+        )
+    return "\n".join(lines)
+
+
+@click.command()
+@click.option("--stations", type=int, default=4, help="Synthetic tide stations")
+@click.option("--places", type=int, default=8, help="Live places")
+@click.option("--days", type=int, default=366, help="Days of tide predictions")
+@click.option("--repeat", type=int, default=5, help="Runs of each render benchmark")
+@click.option("--build-repeat", type=int, default=1, help="Runs of the whole build")
+@click.option(
+    "-o", "--output", type=click.File("w"), help="Write JSON results to this file"
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False),
+    help="Results from an earlier run on this machine to compare against",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="Fraction slower than the baseline that counts as a regression",
+)
+@click.option("--check", is_flag=True, help="Exit with an error on any regression")
+@click.option("--save-baseline", is_flag=True, help="Write these results to --baseline")
+def cli(
+    stations,
+    places,
+    days,
+    repeat,
+    build_repeat,
+    output,
+    baseline,
+    tolerance,
+    check,
+    save_baseline,
+):
+    "Benchmark the build and place page render against a synthetic database"
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_benchmarks(
+            directory,
+            stations=stations,
+            places=places,
+            days=days,
+            repeat=repeat,
+            build_repeat=build_repeat,
+        )
+    if output:
+        json.dump(results, output, indent=2)
+    if baseline is None:
+        if save_baseline or check:
+            raise click.UsageError("--save-baseline and --check need --baseline")
+        click.echo(format_comparison(compare(results, {}, tolerance)), err=True)
+        return
+    baseline_path = pathlib.Path(baseline)
+    if save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n")
+        click.echo("Saved baseline to {}".format(baseline_path), err=True)
+        return
+    previous = {}
+    if baseline_path.exists():
+        previous = json.loads(baseline_path.read_text())
+        for key in ("parameters", "environment"):
+            if previous.get(key) != results[key]:
+                click.echo("Baseline was run with a different {}".format(key), err=True)
+    rows = compare(results, previous, tolerance)
+    click.echo(format_comparison(rows), err=True)
+    if check and any(regressed for *_, regressed in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
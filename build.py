@@ -0,0 +1,469 @@
+from build_place_cards import refresh_place_cards
+from calculate_daily_tide_summary import refresh_daily_tide_summary
+from calculate_sunrise_sunset import refresh_sunrise_sunset
+from collections.abc import Coroutine
+from contextvars import ContextVar
+from fetch_inaturalist import Harvester
+from fetch_noaa_harmonics import fetch_noaa_harmonics_async
+from fetch_noaa_stations import fetch_noaa_stations_async, mark_good_stations
+from fetch_noaa_tide_times import (
+    fetch_noaa_tide_times_async,
+    prediction_window,
+    station_ids_for_places,
+)
+from harmonic_tides import fill_predictions, stations_missing_days
+from http_cache import ResponseCache
+from pack_tide_days import pack_tide_days
+from prerender_places import prerender, site_datasette
+from suggest_stations import format_suggestion, suggest_stations
+import asyncio
+import click
+import inspect
+import json
+import pathlib
+import shutil
+import sqlite_utils
+import sys
+import time
+import traceback
+import yaml
+
+# Builds data.db as a graph of stages, each starting as soon as the stages it
+# depends on have finished. Every stage runs in one process and event loop and
+# writes through the same connection, so writes are never contended - but only
+# time spent waiting on the network overlaps. Stages that are plain functions,
+# like harmonic_tides and pack_tide_days, block the event loop while they run,
+# so the NOAA, iNaturalist and station fetches in flight wait for them.
+
+root = pathlib.Path(__file__).parent.resolve()
+PLACES_YAML = root / "airtable" / "tidepool_areas.yml"
+STATIONS_YAML = root / "data" / "stations.yml"
+
+# The stage whose code is running, inherited by the tasks it starts
+current_stage = ContextVar("current_stage", default=None)
+
+
+class Stage:
+    # run() may return an awaitable. If an optional stage fails, the stages
+    # that depend on it still run.
+    def __init__(self, name, run, depends_on=(), optional=False):
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+        self.optional = optional
+
+
+class RowCounter:
+    # Adds up the rows each stage changes through a connection, from its
+    # total_changes before and after every step of every task on the loop.
+    # Tasks only give way to each other between steps, so each step's rows
+    # belong to the stage that started its task.
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = {}
+        self.total_changes = conn.total_changes
+
+    def start(self):
+        self.total_changes = self.conn.total_changes
+
+    def flush(self):
+        total_changes = self.conn.total_changes
+        stage = current_stage.get()
+        if stage is not None:
+            self.rows[stage] = (
+                self.rows.get(stage, 0) + total_changes - self.total_changes
+            )
+        self.total_changes = total_changes
+
+    def task_factory(self, loop, coro, **kwargs):
+        return asyncio.Task(CountedCoroutine(coro, self), loop=loop, **kwargs)
+
+
+class CountedCoroutine(Coroutine):
+    # Runs a task's coroutine a step at a time for RowCounter
+    def __init__(self, coro, counter):
+        self.coro = coro
+        self.counter = counter
+
+    def step(self, method, *args):
+        self.counter.start()
+        try:
+            return method(*args)
+        finally:
+            self.counter.flush()
+
+    def send(self, value):
+        return self.step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self.step(self.coro.throw, *args)
+
+    def close(self):
+        self.coro.close()
+
+    def __await__(self):
+        return self.coro.__await__()
+
+
+def check_stages(stages):
+    # Raises ValueError for duplicate names, unknown dependencies or cycles
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError("Duplicate stage {}".format(stage.name))
+        by_name[stage.name] = stage
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in by_name:
+                raise ValueError(
+                    "{} depends on unknown stage {}".format(stage.name, dependency)
+                )
+    finished = set()
+    visiting = set()
+
+    def visit(name):
+        if name in finished:
+            return
+        if name in visiting:
+            raise ValueError("Stages depend on each other: {}".format(name))
+        visiting.add(name)
+        for dependency in by_name[name].depends_on:
+            visit(dependency)
+        visiting.discard(name)
+        finished.add(name)
+
+    for stage in stages:
+        visit(stage.name)
+
+
+async def run_stages(stages, db, only=None):
+    # Runs stages, or just the ones named in only, assuming the stages they
+    # depend on have already run. Returns {name: {"status", "seconds",
+    # "rows"}} in stage order, where status is ok, failed or skipped - for
+    # stages depending on one that failed that was not optional.
+    check_stages(stages)
+    selected = [stage for stage in stages if only is None or stage.name in only]
+    optional = {stage.name: stage.optional for stage in stages}
+    results = {stage.name: None for stage in selected}
+    tasks = {}
+    counter = RowCounter(db.conn)
+    loop = asyncio.get_running_loop()
+    task_factory = loop.get_task_factory()
+    loop.set_task_factory(counter.task_factory)
+
+    async def run_stage(stage):
+        failed_dependencies = []
+        for dependency in stage.depends_on:
+            if dependency in tasks:
+                result = await tasks[dependency]
+                if result["status"] != "ok" and not optional[dependency]:
+                    failed_dependencies.append(dependency)
+        if failed_dependencies:
+            results[stage.name] = {"status": "skipped", "seconds": 0.0, "rows": 0}
+            return results[stage.name]
+        current_stage.set(stage.name)
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            result = stage.run()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            status = "failed"
+            click.echo("Stage {} failed:".format(stage.name), err=True)
+            traceback.print_exc()
+        counter.flush()
+        results[stage.name] = {
+            "status": status,
+            "seconds": time.perf_counter() - start,
+            "rows": counter.rows.get(stage.name, 0),
+        }
+        return results[stage.name]
+
+    # Each task runs in a copy of the current context, so current_stage.set()
+    # only applies to that stage and the tasks it starts
+    try:
+        for stage in selected:
+            tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+        await asyncio.gather(*tasks.values())
+    finally:
+        loop.set_task_factory(task_factory)
+    return results
+
+
+def load_yaml(db, table, path, pk):
+    # Replaces table with the YAML, as yaml-to-sqlite into a new data.db did.
+    # Upserting would keep rows removed from the YAML, and values for keys it
+    # leaves out - the Airtable export omits false fields such as live_on_site.
+    docs = json.loads(json.dumps(yaml.safe_load(open(path)), default=str))
+    with db.conn:
+        if db[table].exists():
+            db.execute("delete from [{}]".format(table))
+        db[table].insert_all(docs, pk=pk, alter=True)
+
+
+# Tables the build only adds to or refreshes, for each live place and for each
+# station a place uses, and the watermarks stages record for them
+PLACE_TABLES = (
+    "sunrise_sunset",
+    "daily_tide_summary",
+    "daylight_low_tides",
+    "species_counts",
+    "observations",
+    "inaturalist_checkpoints",
+    "species_cards",
+    "observation_cards",
+)
+STATION_TABLES = ("tide_heights", "tide_days", "harmonic_constituents", "tide_datums")
+LIVE_PLACES_SQL = "select slug from places where live_on_site = 1"
+PLACE_STATIONS_SQL = (
+    "select cast(station_id as integer) from places where station_id is not null"
+)
+
+
+def prune_removed(db):
+    # Deletes rows for places that are gone or no longer live, and for
+    # stations no place uses any more, which a rebuild from scratch would
+    # never have created
+    with db.conn:
+        for table in PLACE_TABLES:
+            if db[table].exists():
+                db.execute(
+                    "delete from [{}] where place not in ({})".format(
+                        table, LIVE_PLACES_SQL
+                    )
+                )
+        for table in STATION_TABLES:
+            if db[table].exists():
+                db.execute(
+                    "delete from [{}] where station_id not in ({})".format(
+                        table, PLACE_STATIONS_SQL
+                    )
+                )
+        if db["watermarks"].exists():
+            db.execute(
+                "delete from watermarks where stage = 'sunrise_sunset' "
+                "and key not in ({})".format(LIVE_PLACES_SQL)
+            )
+            db.execute(
+                "delete from watermarks where stage = 'tide_predictions' "
+                "and cast(key as integer) not in ({})".format(PLACE_STATIONS_SQL)
+            )
+
+
+def load_places(db, path=PLACES_YAML):
+    load_yaml(db, "places", path, "slug")
+    prune_removed(db)
+
+
+def site_stages(
+    db,
+    db_path,
+    output_dir,
+    full=False,
+    cache=None,
+    transport=None,
+    today=None,
+    days=365,
+    places_yaml=PLACES_YAML,
+    harvester_options=None,
+):
+    # Every stage of the site build. harvester_options are keyword arguments
+    # for the iNaturalist Harvester, such as max_pages. transport, today, days
+    # and places_yaml are there for benchmark.py to build against synthetic
+    # APIs.
+    async def fetch_noaa_harmonics():
+        await fetch_noaa_harmonics_async(
+            db, station_ids_for_places(db), transport=transport, cache=cache
+        )
+
+    async def fetch_noaa_tide_times():
+        await fetch_noaa_tide_times_async(
+            db,
+            station_ids_for_places(db),
+            full=full,
+            transport=transport,
+            cache=cache,
+            today=today,
+            days=days,
+        )
+
+    async def fetch_inaturalist():
+        await Harvester(
+            db, transport=transport, cache=cache, **(harvester_options or {})
+        ).harvest(list(db["places"].rows_where("live_on_site = 1")))
+
+    async def fetch_noaa_stations():
+        await fetch_noaa_stations_async(db, transport=transport, cache=cache)
+
+    def check_tide_coverage():
+        # Subordinate stations have no constituents, so if NOAA's predictions
+        # could not be fetched harmonic_tides cannot fill in their days
+        missing = stations_missing_days(db, *prediction_window(today, days))
+        if missing:
+            raise ValueError(
+                "No tide predictions for "
+                + ", ".join(
+                    "{} days at {}".format(days, station_id)
+                    for station_id, days in sorted(missing.items())
+                )
+            )
+
+    def check_stations():
+        for suggestion in suggest_stations(db):
+            click.echo(format_suggestion(*suggestion), err=True)
+
+    async def prerender_places():
+        # Records a hash of data.db, so has to come after every other stage
+        shutil.rmtree(output_dir, ignore_errors=True)
+        datasette = site_datasette(db_path, root)
+        await datasette.invoke_startup()
+        await prerender(datasette, output_dir, db_path)
+
+    stages = [
+        Stage(
+            "load_stations",
+            lambda: load_yaml(db, "stations", STATIONS_YAML, "id"),
+        ),
+        Stage("load_places", lambda: load_places(db, places_yaml)),
+        # Harmonic constituents let harmonic_tides fill in any days the NOAA
+        # predictions API could not provide, so neither fetch failing stops
+        # the build unless check_tide_coverage finds days still missing
+        Stage(
+            "fetch_noaa_harmonics",
+            fetch_noaa_harmonics,
+            ["load_places"],
+            optional=True,
+        ),
+        Stage(
+            "fetch_noaa_tide_times",
+            fetch_noaa_tide_times,
+            ["load_places"],
+            optional=True,
+        ),
+        Stage(
+            "harmonic_tides",
+            lambda: fill_predictions(db, *prediction_window(today, days)),
+            ["fetch_noaa_harmonics", "fetch_noaa_tide_times"],
+        ),
+        Stage("check_tide_coverage", check_tide_coverage, ["harmonic_tides"]),
+        Stage("pack_tide_days", lambda: pack_tide_days(db), ["harmonic_tides"]),
+        Stage(
+            "calculate_sunrise_sunset",
+            lambda: refresh_sunrise_sunset(db, full=full, today=today),
+            ["load_places"],
+        ),
+        Stage(
+            "calculate_daily_tide_summary",
+            lambda: refresh_daily_tide_summary(db),
+            ["pack_tide_days", "calculate_sunrise_sunset"],
+        ),
+        Stage("fetch_inaturalist", fetch_inaturalist, ["load_places"]),
+        Stage(
+            "build_place_cards",
+            lambda: refresh_place_cards(db),
+            ["fetch_inaturalist"],
+        ),
+        Stage("fetch_noaa_stations", fetch_noaa_stations),
+        Stage(
+            "mark_good_stations",
+            lambda: mark_good_stations(db),
+            ["fetch_noaa_stations"],
+        ),
+        Stage(
+            "suggest_stations", check_stations, ["mark_good_stations", "load_places"]
+        ),
+    ]
+    stages.append(
+        Stage(
+            "prerender_places",
+            prerender_places,
+            [stage.name for stage in stages],
+        )
+    )
+    return stages
+
+
+def format_results(results, seconds):
+    lines = ["{:<30} {:>8} {:>10} {:>10}".format("stage", "status", "seconds", "rows")]
+    for name, result in results.items():
+        lines.append(
+            "{:<30} {:>8} {:>10.2f} {:>10}".format(
+                name, result["status"], result["seconds"], result["rows"]
+            )
+        )
+    lines.append("{:<30} {:>8} {:>10.2f}".format("total", "", seconds))
+    return "\n".join(lines)
+
+
+STAGE_NAMES = [stage.name for stage in site_stages(None, None, None)]
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False), default="data.db")
+@click.option("--full", is_flag=True, help="Rebuild from scratch, ignoring watermarks")
+@click.option(
+    "--stage",
+    "only",
+    type=click.Choice(STAGE_NAMES),
+    multiple=True,
+    help="Run just this stage, can be used more than once",
+)
+@click.option(
+    "--http-cache",
+    type=click.Path(dir_okay=False),
+    default="http-cache.db",
+    show_default=True,
+    help="SQLite file to cache responses in",
+)
+@click.option(
+    "--prerendered",
+    type=click.Path(file_okay=False),
+    default="prerendered",
+    show_default=True,
+    help="Directory to prerender place pages to",
+)
+@click.option(
+    "--inaturalist-pages",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Most pages of species counts and of observations to fetch per place",
+)
+@click.option(
+    "-o", "--output", type=click.File("w"), help="Write JSON results to this file"
+)
+def cli(db_path, full, only, http_cache, prerendered, inaturalist_pages, output):
+    "Build the site database, running independent stages at the same time"
+    assert db_path.endswith(".db")
+    if full and not only:
+        pathlib.Path(db_path).unlink(missing_ok=True)
+    db = sqlite_utils.Database(db_path)
+    cache = ResponseCache(http_cache) if http_cache else None
+    stages = site_stages(
+        db,
+        db_path,
+        prerendered,
+        full=full,
+        cache=cache,
+        harvester_options={"max_pages": inaturalist_pages},
+    )
+    start = time.perf_counter()
+    results = asyncio.run(run_stages(stages, db, only=set(only) or None))
+    seconds = time.perf_counter() - start
+    if cache is not None:
+        cache.save_stats()
+        click.echo(cache.summary(), err=True)
+    click.echo(format_results(results, seconds), err=True)
+    if output:
+        json.dump({"seconds": seconds, "stages": results}, output, indent=2)
+    if any(
+        results[stage.name]["status"] != "ok" and not stage.optional
+        for stage in stages
+        if stage.name in results
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,138 @@
+import sqlite_utils
+import sys
+
+# Slim, pre-sorted copies of the species counts and observations shown on
+# each place page, so a render reads them with one primary key range query
+# instead of GraphQL over the wide taxons and observations tables
+
+SPECIES_CARDS = 12
+OBSERVATION_CARDS = 24
+
+SPECIES_CARDS_SQL = """
+create table if not exists species_cards (
+  place text not null,
+  rank integer not null,
+  taxon_id integer,
+  common_name text,
+  latin_name text,
+  photo_url text,
+  count integer,
+  primary key (place, rank)
+) without rowid
+"""
+
+OBSERVATION_CARDS_SQL = """
+create table if not exists observation_cards (
+  place text not null,
+  rank integer not null,
+  observation_id integer,
+  common_name text,
+  latin_name text,
+  photo_url text,
+  user_login text,
+  observed_on text,
+  primary key (place, rank)
+) without rowid
+"""
+
+
+def column(db, table, name, expression=None):
+    # expression, or the column itself, if table has it - the iNaturalist
+    # tables only gain columns the API has returned
+    if name not in db[table].columns_dict:
+        return "null"
+    return expression or "{}.[{}]".format(table, name)
+
+
+def species_card_rows(db, place_slug):
+    sql = """
+    select
+      taxons.id,
+      {common_name},
+      {latin_name},
+      {photo_url},
+      species_counts.count
+    from species_counts join taxons on taxons.id = species_counts.taxon
+    where species_counts.place = ?
+    order by species_counts.count desc, taxons.id
+    limit {limit}
+    """.format(
+        common_name=column(db, "taxons", "preferred_common_name"),
+        latin_name=column(db, "taxons", "name"),
+        photo_url=column(
+            db,
+            "taxons",
+            "default_photo",
+            "json_extract(taxons.default_photo, '$.medium_url')",
+        ),
+        limit=SPECIES_CARDS,
+    )
+    for rank, row in enumerate(db.execute(sql, [place_slug]).fetchall(), start=1):
+        yield (place_slug, rank) + tuple(row)
+
+
+def observation_card_rows(db, place_slug):
+    sql = """
+    select
+      observations.id,
+      {common_name},
+      {latin_name},
+      {photo_url},
+      {user_login},
+      {observed_on}
+    from observations join taxons on taxons.id = observations.taxon
+    where observations.place = ? and {research}
+    order by {observed_on} desc, observations.id desc
+    limit {limit}
+    """.format(
+        common_name=column(db, "taxons", "preferred_common_name"),
+        latin_name=column(db, "taxons", "name"),
+        photo_url=column(
+            db,
+            "observations",
+            "observation_photos",
+            "json_extract(observations.observation_photos, '$[0].photo.url')",
+        ),
+        user_login=column(
+            db, "observations", "user", "json_extract(observations.[user], '$.login')"
+        ),
+        observed_on=column(db, "observations", "observed_on"),
+        research=column(
+            db,
+            "observations",
+            "quality_grade",
+            "observations.quality_grade = 'research'",
+        ),
+        limit=OBSERVATION_CARDS,
+    )
+    for rank, row in enumerate(db.execute(sql, [place_slug]).fetchall(), start=1):
+        row = list(row)
+        # The API returns square thumbnails, the page shows medium ones
+        if row[3]:
+            row[3] = row[3].replace("/square.", "/medium.")
+        yield (place_slug, rank) + tuple(row)
+
+
+def refresh_place_cards(db):
+    # Rewrites both tables for every live place
+    with db.conn:
+        db.execute(SPECIES_CARDS_SQL)
+        db.execute(OBSERVATION_CARDS_SQL)
+        db.execute("delete from species_cards")
+        db.execute("delete from observation_cards")
+        for place in db["places"].rows_where("live_on_site = 1"):
+            if db["species_counts"].exists() and db["taxons"].exists():
+                db.conn.executemany(
+                    "insert into species_cards values (?, ?, ?, ?, ?, ?, ?)",
+                    species_card_rows(db, place["slug"]),
+                )
+            if db["observations"].exists() and db["taxons"].exists():
+                db.conn.executemany(
+                    "insert into observation_cards values (?, ?, ?, ?, ?, ?, ?, ?)",
+                    observation_card_rows(db, place["slug"]),
+                )
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1].endswith(".db")
+    refresh_place_cards(sqlite_utils.Database(sys.argv[-1]))
@@ -0,0 +1,107 @@
+from plugins.template_vars import (
+    calculate_tide_info,
+    find_extrema,
+    indexes_in_range,
+    split_tide_times_by_day,
+    summary_row_from_tide_info,
+    tide_arrays,
+    tide_times_for_day,
+)
+import datetime
+import sqlite_utils
+import sys
+
+# Each live place's lowest daylight low tide for every day, ordered by height
+# within each place, for the best low tides ranking at /best-low-tides.json
+DAYLIGHT_LOW_TIDES_SQL = """
+create table if not exists daylight_low_tides (
+  place text not null,
+  feet real not null,
+  day text not null,
+  time text not null,
+  primary key (place, feet, day)
+) without rowid
+"""
+
+
+def calculate_daily_tide_summary(place, tide_times, sun_info_by_day=None):
+    # tide_times should be every prediction for the place's station, in order.
+    # sun_info_by_day is an optional {date: sunrise_sunset row} dictionary.
+    sun_info_by_day = sun_info_by_day or {}
+    tide_times = tide_arrays(tide_times)
+    # Find extrema across the whole series in one pass, then slice per day
+    minima_indexes, maxima_indexes = find_extrema(tide_times[1])
+    tide_times_by_day = split_tide_times_by_day(tide_times)
+    start = 0
+    for day in sorted(tide_times_by_day):
+        end = start + len(tide_times_by_day[day][0])
+        # Positions in the per-day list are shifted by the previous day's row
+        offset = start
+        if day - datetime.timedelta(days=1) in tide_times_by_day:
+            offset -= 1
+        extrema = (
+            indexes_in_range(minima_indexes, start, end) - offset,
+            indexes_in_range(maxima_indexes, start, end) - offset,
+        )
+        info = calculate_tide_info(
+            place,
+            day,
+            tide_times_for_day(tide_times_by_day, day),
+            extrema,
+            sun_info_by_day.get(day),
+        )
+        if info is not None:
+            yield summary_row_from_tide_info(place["slug"], day, info)
+        start = end
+
+
+def refresh_daily_tide_summary(db):
+    table = db.table(
+        "daily_tide_summary",
+        pk=("place", "day"),
+        foreign_keys=(("place", "places", "slug"),),
+    )
+    for place in db["places"].rows_where("live_on_site = 1 and station_id is not null"):
+        tide_times = db["tide_heights"].rows_where(
+            "station_id = ?",
+            [place["station_id"]],
+            order_by="minute",
+            select="minute, mllw_mft",
+        )
+        sun_info_by_day = {}
+        if db["sunrise_sunset"].exists():
+            sun_info_by_day = {
+                datetime.date.fromisoformat(row["day"]): row
+                for row in db["sunrise_sunset"].rows_where("place = ?", [place["slug"]])
+            }
+        with db.conn:
+            # Replace the place's rows so days outside the window are dropped
+            if table.exists():
+                table.delete_where("place = ?", [place["slug"]])
+            table.insert_all(
+                calculate_daily_tide_summary(place, tide_times, sun_info_by_day),
+                replace=True,
+            )
+    refresh_daylight_low_tides(db)
+
+
+def refresh_daylight_low_tides(db):
+    with db.conn:
+        db.execute(DAYLIGHT_LOW_TIDES_SQL)
+        db.execute("delete from daylight_low_tides")
+        if db["daily_tide_summary"].exists():
+            db.execute("""
+                insert into daylight_low_tides
+                select
+                  place,
+                  json_extract(lowest_daylight_minima, '$.feet'),
+                  day,
+                  json_extract(lowest_daylight_minima, '$.time')
+                from daily_tide_summary
+                where json_extract(lowest_daylight_minima, '$.feet') is not null
+                """)
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1].endswith(".db")
+    refresh_daily_tide_summary(sqlite_utils.Database(sys.argv[-1]))
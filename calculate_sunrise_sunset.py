@@ -1,45 +1,322 @@
-from astral import LocationInfo, sun
+from plugins.template_vars import SUN_PHASES, time_to_float
+from watermarks import get_watermark, missing_range, set_watermark
+import click
 import datetime
-import httpx
+import math
+import numpy
 import pytz
 import sqlite_utils
-import sys
-from urllib.parse import urlencode
 
+# These replicate the NOAA-based calculations in astral.sun, using the same
+# order of floating point operations so results match astral to the second
+SUN_APPARENT_RADIUS = 32.0 / (60.0 * 2.0)
+CIVIL_DEPRESSION = 6.0
+# astral.julian.julianday(date) == date.toordinal() + JULIAN_DAY_ORDINAL_OFFSET
+JULIAN_DAY_ORDINAL_OFFSET = 1721424.5
+UNIX_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
 
-def calculate_sunrise_sunset(place):
-    start_date = datetime.date.today() - datetime.timedelta(days=180)
-    end_date = datetime.date.today() + datetime.timedelta(days=365)
-    location_info = LocationInfo(
-        place["address"], "", place["time_zone"], place["latitude"], place["longitude"]
+
+def calculate_sunrise_sunset(place, start_date=None, end_date=None):
+    return calculate_sunrise_sunset_for_places([place], start_date, end_date)
+
+
+def sun_window(today=None):
+    # 180 days ago through 365 days from now
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=180), today + datetime.timedelta(days=365)
+
+
+def calculate_sunrise_sunset_for_places(places, start_date=None, end_date=None):
+    # Calculates the whole (places x days) grid with NumPy
+    if start_date is None or end_date is None:
+        start_date, end_date = sun_window()
+    places = list(places)
+    if not places:
+        return []
+    ordinals = numpy.arange(start_date.toordinal(), end_date.toordinal() + 1)
+    latitudes = numpy.array([[float(p["latitude"])] for p in places])
+    longitudes = numpy.array([[float(p["longitude"])] for p in places])
+    # Unix timestamps of each event, shape (places, days)
+    timestamps = sun_event_timestamps(latitudes, longitudes, ordinals)
+    # Convert to seconds since local midnight, one timezone at a time
+    local_seconds = {key: numpy.zeros_like(timestamps[key]) for key in SUN_PHASES}
+    for time_zone in {p["time_zone"] for p in places}:
+        rows = numpy.array([p["time_zone"] == time_zone for p in places])
+        tz = pytz.timezone(time_zone)
+        offsets_for = utc_offsets(
+            tz,
+            min(timestamps[key][rows].min() for key in SUN_PHASES),
+            max(timestamps[key][rows].max() for key in SUN_PHASES),
+        )
+        for key in SUN_PHASES:
+            utc = timestamps[key][rows]
+            local_seconds[key][rows] = (utc + offsets_for(utc)) % 86400
+    # Format each distinct second of the day just once
+    unique_seconds, inverse = numpy.unique(
+        numpy.stack([local_seconds[key] for key in SUN_PHASES]), return_inverse=True
     )
-    day = start_date
+    unique_times = [seconds_to_time(seconds) for seconds in unique_seconds.tolist()]
+    unique_pcts = [round(100 * time_to_float(time), 2) for time in unique_times]
+    inverse = inverse.reshape((len(SUN_PHASES), len(places), len(ordinals)))
+    day_strings = [
+        datetime.date.fromordinal(int(ordinal)).isoformat() for ordinal in ordinals
+    ]
+    keys = ["place", "day"]
+    for key in SUN_PHASES:
+        keys.extend((key, "{}_pct".format(key)))
     day_infos = []
-    tz = pytz.timezone(place["time_zone"])
-    while day <= end_date:
-        info = sun.sun(location_info.observer, date=day)
-        day_info = {
-            "place": place["slug"],
-            "day": day.isoformat(),
-        }
-        day_info.update(
-            {
-                key: value.astimezone(tz).time().isoformat(timespec="seconds")
-                for key, value in info.items()
-            }
-        )
-        day_infos.append(day_info)
-        day += datetime.timedelta(days=1)
+    for i, place in enumerate(places):
+        columns = [[place["slug"]] * len(day_strings), day_strings]
+        for k in range(len(SUN_PHASES)):
+            indexes = inverse[k][i].tolist()
+            columns.append([unique_times[index] for index in indexes])
+            columns.append([unique_pcts[index] for index in indexes])
+        day_infos.extend(dict(zip(keys, values)) for values in zip(*columns))
     return day_infos
 
 
-if __name__ == "__main__":
-    assert sys.argv[-1].endswith(".db")
-    db = sqlite_utils.Database(sys.argv[-1])
+def seconds_to_time(seconds):
+    return "{:02d}:{:02d}:{:02d}".format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60
+    )
+
+
+def sun_event_timestamps(latitudes, longitudes, ordinals):
+    # Returns {"dawn": array, "sunrise": ..., "noon": ..., "sunset": ...,
+    # "dusk": ...} of integer Unix timestamps, matching astral.sun.sun() called
+    # with its default UTC tzinfo for each date
+    latitudes = numpy.clip(latitudes, -89.8, 89.8)
+    return {
+        "dawn": transit_timestamps(
+            latitudes, longitudes, ordinals, 90.0 + CIVIL_DEPRESSION, 1
+        ),
+        "sunrise": transit_timestamps(
+            latitudes, longitudes, ordinals, 90.0 + SUN_APPARENT_RADIUS, 1
+        ),
+        "noon": noon_timestamps(longitudes, ordinals),
+        "sunset": transit_timestamps(
+            latitudes, longitudes, ordinals, 90.0 + SUN_APPARENT_RADIUS, -1
+        ),
+        "dusk": transit_timestamps(
+            latitudes, longitudes, ordinals, 90.0 + CIVIL_DEPRESSION, -1
+        ),
+    }
+
+
+def transit_timestamps(latitudes, longitudes, ordinals, zenith, direction):
+    time_utc = transit_minutes(latitudes, longitudes, ordinals, zenith, direction)
+    # astral retries with the previous day if the event lands on the next UTC
+    # date - time_utc is never negative so that is the only case to handle
+    retry = time_utc >= 1440.0
+    previous = transit_minutes(latitudes, longitudes, ordinals - 1, zenith, direction)
+    base_ordinals = numpy.where(retry, ordinals - 1, ordinals)
+    time_utc = numpy.where(retry, previous, time_utc)
+    # Same truncation as astral.sun.minutes_to_timedelta(), dropping microseconds
+    days = numpy.trunc(time_utc / 1440)
+    seconds = numpy.trunc((time_utc - (days * 1440)) * 60)
+    return (
+        (base_ordinals - UNIX_EPOCH_ORDINAL) * 86400
+        + days.astype(numpy.int64) * 86400
+        + seconds.astype(numpy.int64)
+    )
+
+
+def transit_minutes(latitudes, longitudes, ordinals, zenith, direction):
+    # Minutes after UTC midnight when the sun crosses zenith, see
+    # astral.sun.time_of_transit()
+    adjustment_for_refraction = refraction_at_zenith(zenith)
+    jd = ordinals + JULIAN_DAY_ORDINAL_OFFSET
+    adjustment = 0.0
+    time_utc = 0.0
+    for _ in range(2):
+        jc = (jd + adjustment - 2451545.0) / 36525.0
+        declination = sun_declination(jc)
+        latitude_rad = numpy.radians(latitudes)
+        declination_rad = numpy.radians(declination)
+        zenith_rad = numpy.radians(zenith + adjustment_for_refraction)
+        h = (
+            numpy.cos(zenith_rad) - numpy.sin(latitude_rad) * numpy.sin(declination_rad)
+        ) / (numpy.cos(latitude_rad) * numpy.cos(declination_rad))
+        hour_angle = numpy.arccos(h) * direction
+        delta = -longitudes - numpy.degrees(hour_angle)
+        offset = delta * 4.0 - eq_of_time(jc)
+        offset = numpy.where(offset < -720.0, offset + 1440, offset)
+        time_utc = 720.0 + offset
+        adjustment = time_utc / 1440.0
+    return time_utc
+
+
+def noon_timestamps(longitudes, ordinals):
+    # See astral.sun.noon()
+    jc = (ordinals + JULIAN_DAY_ORDINAL_OFFSET - 2451545.0) / 36525.0
+    time_utc = (720.0 - (4 * longitudes) - eq_of_time(jc)) / 60.0
+    hour = numpy.trunc(time_utc)
+    minute = numpy.trunc((time_utc - hour) * 60)
+    second = numpy.trunc((((time_utc - hour) * 60) - minute) * 60)
+    return (ordinals - UNIX_EPOCH_ORDINAL) * 86400 + (
+        hour * 3600 + minute * 60 + second
+    ).astype(numpy.int64)
+
+
+def refraction_at_zenith(zenith):
+    # Scalar, see astral.refraction_at_zenith()
+    elevation = 90 - zenith
+    if elevation >= 85.0:
+        return 0
+    te = math.tan(math.radians(elevation))
+    if elevation > 5.0:
+        refraction_correction = (
+            58.1 / te - 0.07 / (te * te * te) + 0.000086 / (te * te * te * te * te)
+        )
+    elif elevation > -0.575:
+        step1 = -12.79 + elevation * 0.711
+        step2 = 103.4 + elevation * step1
+        step3 = -518.2 + elevation * step2
+        refraction_correction = 1735.0 + elevation * step3
+    else:
+        refraction_correction = -20.774 / te
+    return refraction_correction / 3600.0
+
+
+def geom_mean_long_sun(jc):
+    l0 = 280.46646 + jc * (36000.76983 + 0.0003032 * jc)
+    return l0 % 360.0
+
+
+def geom_mean_anomaly_sun(jc):
+    return 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+
+
+def eccentric_location_earth_orbit(jc):
+    return 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+
+
+def sun_eq_of_center(jc):
+    mrad = numpy.radians(geom_mean_anomaly_sun(jc))
+    sinm = numpy.sin(mrad)
+    sin2m = numpy.sin(mrad + mrad)
+    sin3m = numpy.sin(mrad + mrad + mrad)
+    return (
+        sinm * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+        + sin2m * (0.019993 - 0.000101 * jc)
+        + sin3m * 0.000289
+    )
+
+
+def sun_apparent_long(jc):
+    true_long = geom_mean_long_sun(jc) + sun_eq_of_center(jc)
+    omega = 125.04 - 1934.136 * jc
+    return true_long - 0.00569 - 0.00478 * numpy.sin(numpy.radians(omega))
+
+
+def obliquity_correction(jc):
+    seconds = 21.448 - jc * (46.815 + jc * (0.00059 - jc * (0.001813)))
+    e0 = 23.0 + (26.0 + (seconds / 60.0)) / 60.0
+    omega = 125.04 - 1934.136 * jc
+    return e0 + 0.00256 * numpy.cos(numpy.radians(omega))
+
+
+def sun_declination(jc):
+    e = obliquity_correction(jc)
+    lambd = sun_apparent_long(jc)
+    sint = numpy.sin(numpy.radians(e)) * numpy.sin(numpy.radians(lambd))
+    return numpy.degrees(numpy.arcsin(sint))
+
+
+def eq_of_time(jc):
+    l0 = geom_mean_long_sun(jc)
+    e = eccentric_location_earth_orbit(jc)
+    m = geom_mean_anomaly_sun(jc)
+    y = numpy.tan(numpy.radians(obliquity_correction(jc)) / 2.0)
+    y = y * y
+    sin2l0 = numpy.sin(2.0 * numpy.radians(l0))
+    sinm = numpy.sin(numpy.radians(m))
+    cos2l0 = numpy.cos(2.0 * numpy.radians(l0))
+    sin4l0 = numpy.sin(4.0 * numpy.radians(l0))
+    sin2m = numpy.sin(2.0 * numpy.radians(m))
+    etime = (
+        y * sin2l0
+        - 2.0 * e * sinm
+        + 4.0 * e * y * sinm * cos2l0
+        - 0.5 * y * y * sin4l0
+        - 1.25 * e * e * sin2m
+    )
+    return numpy.degrees(etime) * 4.0
+
+
+def utc_offsets(tz, start, end):
+    # Returns a function mapping an array of Unix timestamps between start and
+    # end to their UTC offsets in seconds. Transitions are found by sampling tz
+    # daily across the range and bisecting any changes.
+    def offset_at(timestamp):
+        return int(
+            datetime.datetime.fromtimestamp(timestamp, tz).utcoffset().total_seconds()
+        )
+
+    samples = list(range(int(start), int(end) + 86400, 86400))
+    offsets = [offset_at(sample) for sample in samples]
+    transitions = []
+    transition_offsets = [offsets[0]]
+    for i in range(1, len(samples)):
+        if offsets[i] != offsets[i - 1]:
+            low, high = samples[i - 1], samples[i]
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset_at(middle) == offsets[i - 1]:
+                    low = middle
+                else:
+                    high = middle
+            transitions.append(high)
+            transition_offsets.append(offsets[i])
+    transition_offsets = numpy.array(transition_offsets)
+
+    def offsets_for(timestamps):
+        return transition_offsets[
+            numpy.searchsorted(transitions, timestamps, side="right")
+        ]
+
+    return offsets_for
+
+
+def refresh_sunrise_sunset(db, full=False, today=None):
+    # Unless full is True only calculates days missing from each place's
+    # watermark, then deletes rows for days that have fallen out of the window
+    start_date, end_date = sun_window(today)
+    places_by_range = {}
+    for place in db["places"].rows_where("live_on_site = 1"):
+        watermark = None
+        if not full:
+            watermark = get_watermark(db, "sunrise_sunset", place["slug"])
+        missing = missing_range(watermark, start_date, end_date)
+        if missing is not None:
+            places_by_range.setdefault(missing, []).append(place)
     table = db.table(
         "sunrise_sunset",
         pk=("place", "day"),
         foreign_keys=(("place", "places", "slug"),),
     )
-    for place in db["places"].rows_where("live_on_site = 1"):
-        table.insert_all(calculate_sunrise_sunset(place), replace=True)
+    with db.conn:
+        for (range_start, range_end), places in places_by_range.items():
+            table.insert_all(
+                calculate_sunrise_sunset_for_places(places, range_start, range_end),
+                replace=True,
+            )
+            for place in places:
+                set_watermark(db, "sunrise_sunset", place["slug"], start_date, end_date)
+        if table.exists():
+            table.delete_where("day < ?", [start_date.isoformat()])
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--full", is_flag=True, help="Recalculate the whole window, ignoring watermarks"
+)
+def cli(db_path, full):
+    "Calculate sunrise and sunset times for every live place"
+    assert db_path.endswith(".db")
+    refresh_sunrise_sunset(sqlite_utils.Database(db_path), full=full)
+
+
+if __name__ == "__main__":
+    cli()
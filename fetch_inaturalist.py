@@ -1,69 +1,285 @@
+from http_cache import CachingTransport, ResponseCache
+from http_retries import get_with_retries
+import asyncio
+import click
 import httpx
 import sqlite_utils
-import sys
-from urllib.parse import urlencode
+import time
 
+SPECIES_COUNTS_URL = "https://api.inaturalist.org/v1/observations/species_counts"
+OBSERVATIONS_URL = "https://api.inaturalist.org/v1/observations"
 
-def fetch_species_counts(place):
-    url = "https://api.inaturalist.org/v1/observations/species_counts?" + urlencode(
-        {
-            "quality_grade": "research",
-            "lat": place["latitude"],
-            "lng": place["longitude"],
-            "radius": (place["radius_km"] or "0.5"),
-        }
-    )
-    return httpx.get(url, timeout=20.0).json()["results"]
+
+def species_counts_params(place):
+    return {
+        "quality_grade": "research",
+        "lat": place["latitude"],
+        "lng": place["longitude"],
+        "radius": (place["radius_km"] or "0.5"),
+    }
+
+
+def observations_params(place):
+    # Newest first, so id_below can page back through them
+    return {
+        "order_by": "id",
+        "order": "desc",
+        "photos": "true",
+        "lat": place["latitude"],
+        "lng": place["longitude"],
+        "radius": (place["radius_km"] or "0.5"),
+        "quality_grade": "research",
+    }
+
+
+class TokenBucket:
+    # Allows rate requests per second on average, in bursts of up to capacity
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = self.clock()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 
-def fetch_observations(place):
-    url = "https://api.inaturalist.org/v1/observations?" + urlencode(
+def collect_place(place, species_counts, observations, seen_taxa):
+    # Turns API results for a place into (taxons, species_counts, observations)
+    # lists of rows. seen_taxa is a {taxon_id: set of keys} dictionary shared
+    # across places - a taxon is only returned again if it has new keys.
+    taxons = []
+
+    def taxon_id(taxon):
+        keys = seen_taxa.get(taxon["id"])
+        if keys is None or not keys.issuperset(taxon):
+            seen_taxa[taxon["id"]] = (keys or set()).union(taxon)
+            taxons.append(taxon)
+        return taxon["id"]
+
+    species_count_rows = [
         {
-            "order_by": "observed_on",
-            "photos": "true",
-            "lat": place["latitude"],
-            "lng": place["longitude"],
-            "radius": (place["radius_km"] or "0.5"),
-            "quality_grade": "research",
+            "place": place["slug"],
+            "taxon": taxon_id(species_count["taxon"]),
+            "count": species_count["count"],
+        }
+        for species_count in species_counts
+    ]
+    observation_rows = []
+    for observation in observations:
+        observation_to_insert = {
+            "place": place["slug"],
+            "taxon": taxon_id(observation["taxon"]),
         }
+        observation_to_insert.update(
+            {k: v for k, v in observation.items() if k not in ("place", "taxon")}
+        )
+        observation_rows.append(observation_to_insert)
+    return taxons, species_count_rows, observation_rows
+
+
+def save_place(db, taxons, species_counts, observations, replace=None):
+    # One transaction per place, adding any new columns once per batch.
+    # replace is an optional (table, place slug) pair to delete the rows of
+    # first, so results iNaturalist no longer returns do not linger.
+    with db.conn:
+        if replace is not None and db[replace[0]].exists():
+            db[replace[0]].delete_where("place = ?", [replace[1]])
+        # Upsert so a taxon seen again with extra keys keeps its other columns
+        db["taxons"].upsert_all(taxons, pk="id", alter=True)
+        db["species_counts"].insert_all(
+            species_counts,
+            pk=("place", "taxon"),
+            foreign_keys=("taxon", "place"),
+            replace=True,
+        )
+        db["observations"].insert_all(
+            observations,
+            pk="id",
+            replace=True,
+            alter=True,
+            foreign_keys=("taxon", "place"),
+        )
+
+
+def get_checkpoint(db, place_slug, kind):
+    # Progress through one place's species_counts or observations: cursor is
+    # the next page for species_counts or the id_below for observations
+    if db["inaturalist_checkpoints"].exists():
+        rows = list(
+            db["inaturalist_checkpoints"].rows_where(
+                "place = ? and kind = ?", [place_slug, kind]
+            )
+        )
+        if rows:
+            return rows[0]
+    return {"place": place_slug, "kind": kind, "cursor": None, "pages": 0, "done": 0}
+
+
+def set_checkpoint(db, checkpoint):
+    with db.conn:
+        db["inaturalist_checkpoints"].insert(
+            checkpoint, pk=("place", "kind"), replace=True
+        )
+
+
+async def harvest_species_counts(harvester, place):
+    checkpoint = get_checkpoint(harvester.db, place["slug"], "species_counts")
+    while not checkpoint["done"]:
+        page = checkpoint["cursor"] or 1
+        data = await harvester.get_json(
+            SPECIES_COUNTS_URL,
+            dict(species_counts_params(place), page=page, per_page=harvester.per_page),
+        )
+        results = data["results"]
+        # The first page of a fresh harvest replaces the place's species counts
+        harvester.save(
+            place,
+            species_counts=results,
+            replace=None if checkpoint["pages"] else "species_counts",
+        )
+        checkpoint = dict(checkpoint, cursor=page + 1, pages=checkpoint["pages"] + 1)
+        checkpoint["done"] = int(
+            len(results) < harvester.per_page
+            or page * harvester.per_page >= data["total_results"]
+            or checkpoint["pages"] >= harvester.max_pages
+        )
+        set_checkpoint(harvester.db, checkpoint)
+
+
+async def harvest_observations(harvester, place):
+    checkpoint = get_checkpoint(harvester.db, place["slug"], "observations")
+    while not checkpoint["done"]:
+        params = dict(observations_params(place), per_page=harvester.per_page)
+        if checkpoint["cursor"] is not None:
+            params["id_below"] = checkpoint["cursor"]
+        results = (await harvester.get_json(OBSERVATIONS_URL, params))["results"]
+        harvester.save(
+            place,
+            observations=results,
+            replace=None if checkpoint["pages"] else "observations",
+        )
+        checkpoint = dict(checkpoint, pages=checkpoint["pages"] + 1)
+        if results:
+            checkpoint["cursor"] = min(r["id"] for r in results)
+        checkpoint["done"] = int(
+            len(results) < harvester.per_page
+            or checkpoint["pages"] >= harvester.max_pages
+        )
+        set_checkpoint(harvester.db, checkpoint)
+
+
+class Harvester:
+    # Fetches every page of species counts and observations for places, up
+    # to max_pages each, for concurrency places at a time. All requests share
+    # one token bucket rate limit. Progress is checkpointed after every page
+    # so an interrupted harvest picks up where it left off. Requests go
+    # through cache, a ResponseCache, if one is provided.
+    def __init__(
+        self,
+        db,
+        concurrency=3,
+        rate=1.0,
+        burst=1,
+        per_page=200,
+        max_pages=5,
+        timeout=20.0,
+        retries=3,
+        backoff=1.0,
+        transport=None,
+        cache=None,
+    ):
+        if cache is not None:
+            transport = CachingTransport(cache, transport)
+        self.db = db
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport
+        self.seen_taxa = {}
+        self.client = None
+
+    async def get_json(self, url, params):
+        await self.bucket.acquire()
+        response = await get_with_retries(
+            self.client, url, params, retries=self.retries, backoff=self.backoff
+        )
+        return response.json()
+
+    def save(self, place, species_counts=(), observations=(), replace=None):
+        # replace names a table to delete the place's rows from first
+        save_place(
+            self.db,
+            *collect_place(place, species_counts, observations, self.seen_taxa),
+            replace=replace and (replace, place["slug"]),
+        )
+
+    async def harvest(self, places):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def harvest_place(place):
+            async with semaphore:
+                await harvest_species_counts(self, place)
+                await harvest_observations(self, place)
+
+        async with httpx.AsyncClient(
+            transport=self.transport, timeout=self.timeout
+        ) as self.client:
+            await asyncio.gather(*[harvest_place(place) for place in places])
+        # Finished, so the next harvest starts from scratch
+        if self.db["inaturalist_checkpoints"].exists():
+            with self.db.conn:
+                self.db["inaturalist_checkpoints"].delete_where()
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option("--concurrency", type=int, default=3, help="Places to fetch at once")
+@click.option("--rate", type=float, default=1.0, help="Requests per second")
+@click.option("--max-pages", type=int, default=5, help="Pages to fetch per query")
+@click.option("--per-page", type=int, default=200, help="Results per page")
+@click.option("--restart", is_flag=True, help="Ignore checkpoints from a previous run")
+@click.option(
+    "--http-cache",
+    type=click.Path(dir_okay=False),
+    help="SQLite file to cache responses in",
+)
+def cli(db_path, concurrency, rate, max_pages, per_page, restart, http_cache):
+    "Fetch species counts and observations from iNaturalist for live places"
+    assert db_path.endswith(".db")
+    db = sqlite_utils.Database(db_path)
+    if restart and db["inaturalist_checkpoints"].exists():
+        db["inaturalist_checkpoints"].delete_where()
+    cache = ResponseCache(http_cache) if http_cache else None
+    harvester = Harvester(
+        db,
+        concurrency=concurrency,
+        rate=rate,
+        per_page=per_page,
+        max_pages=max_pages,
+        cache=cache,
     )
-    return httpx.get(url, timeout=20.0).json()["results"]
+    asyncio.run(harvester.harvest(list(db["places"].rows_where("live_on_site = 1"))))
+    if cache is not None:
+        cache.save_stats()
+        click.echo(cache.summary(), err=True)
 
 
 if __name__ == "__main__":
-    assert sys.argv[-1].endswith(".db")
-    db = sqlite_utils.Database(sys.argv[-1])
-    for place in db["places"].rows_where("live_on_site = 1"):
-        for species_count in fetch_species_counts(place):
-            db["taxons"].insert(
-                species_count["taxon"], pk="id", replace=True, alter=True
-            )
-            db["species_counts"].insert(
-                {
-                    "place": place["slug"],
-                    "taxon": species_count["taxon"]["id"],
-                    "count": species_count["count"],
-                },
-                pk=("place", "taxon"),
-                foreign_keys=("taxon", "place"),
-                replace=True,
-            )
-        for observation in fetch_observations(place):
-            observation_to_insert = {
-                "place": place["slug"],
-                "taxon": (
-                    db["taxons"]
-                    .insert(observation["taxon"], pk="id", replace=True, alter=True)
-                    .last_pk
-                ),
-            }
-            observation_to_insert.update(
-                {k: v for k, v in observation.items() if k not in ("place", "taxon")}
-            )
-            db["observations"].insert(
-                observation_to_insert,
-                pk="id",
-                replace=True,
-                alter=True,
-                foreign_keys=("taxon", "place"),
-            )
+    cli()
@@ -0,0 +1,96 @@
+import asyncio
+import click
+import httpx
+import sqlite_utils
+from fetch_noaa_tide_times import station_ids_for_places
+from http_cache import CachingTransport, ResponseCache
+from http_retries import get_with_retries
+
+STATION_URL = "https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/stations/{}/"
+
+
+async def fetch_station_harmonics(client, station_id):
+    # Returns (constituents, msl_above_mllw) for a station, or None for
+    # subordinate stations, which have no constituents of their own
+    url = STATION_URL.format(station_id)
+    harcon = (
+        await get_with_retries(client, url + "harcon.json", {"units": "english"})
+    ).json()
+    constituents = [
+        {
+            "station_id": int(station_id),
+            "name": c["name"],
+            "amplitude": c["amplitude"],
+            "phase": c["phase_GMT"],
+            "speed": c["speed"],
+        }
+        for c in harcon.get("HarmonicConstituents") or []
+        if c["amplitude"]
+    ]
+    if not constituents:
+        return None
+    datums = (
+        await get_with_retries(client, url + "datums.json", {"units": "english"})
+    ).json()
+    values = {d["name"]: d["value"] for d in datums.get("datums") or []}
+    if "MSL" not in values or "MLLW" not in values:
+        return None
+    return constituents, values["MSL"] - values["MLLW"]
+
+
+async def fetch_noaa_harmonics_async(
+    db, station_ids, concurrency=4, timeout=30.0, transport=None, cache=None
+):
+    # Saves harmonic constituents and the height of mean sea level above MLLW
+    # for each station, used by harmonic_tides.py to predict tides offline
+    if cache is not None:
+        transport = CachingTransport(cache, transport)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_station(client, station_id):
+        async with semaphore:
+            harmonics = await fetch_station_harmonics(client, station_id)
+        if harmonics is None:
+            return
+        constituents, msl_above_mllw = harmonics
+        with db.conn:
+            # Replaces the station's constituents, in case any were dropped
+            if db["harmonic_constituents"].exists():
+                db["harmonic_constituents"].delete_where(
+                    "station_id = ?", [int(station_id)]
+                )
+            db["harmonic_constituents"].insert_all(
+                constituents, pk=("station_id", "name"), replace=True
+            )
+            db["tide_datums"].insert(
+                {"station_id": int(station_id), "msl_above_mllw": msl_above_mllw},
+                pk="station_id",
+                replace=True,
+            )
+
+    async with httpx.AsyncClient(transport=transport, timeout=timeout) as client:
+        await asyncio.gather(
+            *[fetch_station(client, station_id) for station_id in sorted(station_ids)]
+        )
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--http-cache",
+    type=click.Path(dir_okay=False),
+    help="SQLite file to cache responses in",
+)
+def cli(db_path, http_cache):
+    "Fetch NOAA harmonic constituents for the stations used by places"
+    assert db_path.endswith(".db")
+    db = sqlite_utils.Database(db_path)
+    cache = ResponseCache(http_cache) if http_cache else None
+    asyncio.run(fetch_noaa_harmonics_async(db, station_ids_for_places(db), cache=cache))
+    if cache is not None:
+        cache.save_stats()
+        click.echo(cache.summary(), err=True)
+
+
+if __name__ == "__main__":
+    cli()
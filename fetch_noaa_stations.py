@@ -0,0 +1,76 @@
+import asyncio
+import click
+import httpx
+import sqlite_utils
+from http_cache import CachingTransport, ResponseCache
+from http_retries import get_with_retries
+
+# California stations
+STATIONS_URL = "https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/geogroups/1393/children.json"
+# Stations known to have good predictions, flagged with good = 1
+GOOD_STATION_IDS = (
+    "9410170 9410135 9410196 9410230 9410580 9410680 9410660 9410840 9411340 "
+    "9411399 9411406 9410032 9410079 9412110 9412802 9413450 9413631 9413643 "
+    "9413651 9413663 9414131 9414290 9414317 9414764 9414750 9414746 9414358 "
+    "9414688 9414458 9414523 9414509 9414575 9414816 9414863 9415218 9415143 "
+    "9415102 9415265 9415144 9414811 9415112 9415064 9415316 9415056 9415338 "
+    "9414958 9415020 9416409 9416841 9417426 9418024 9418637 9418767 9418723 "
+    "9418817 9419750 9419945"
+).split()
+STATIONS_MAP_VIEW = """
+select rowid, stationId, lat as latitude, lon as longitude,
+    refStationId, stationType, parentGeoGroupId, seq,
+    geoGroupId, geoGroupName, level, geoGroupType, abbrev, good
+from noaa_stations
+"""
+
+
+async def fetch_noaa_stations_async(db, transport=None, cache=None, timeout=30.0):
+    # Saves every child of the geogroup that is a station, skipping the
+    # insert if the list is unchanged since the last cached fetch
+    if cache is not None:
+        transport = CachingTransport(cache, transport)
+    async with httpx.AsyncClient(transport=transport, timeout=timeout) as client:
+        response = await get_with_retries(client, STATIONS_URL)
+    if response.extensions.get("http_cache") == "hit" and db["noaa_stations"].exists():
+        return
+    stations = [s for s in response.json()["stationList"] if s.get("stationId")]
+    with db.conn:
+        db["noaa_stations"].insert_all(
+            stations, pk="stationId", replace=True, alter=True
+        )
+
+
+def mark_good_stations(db):
+    # Sets good on every station and creates the view used by the cluster map
+    with db.conn:
+        db["noaa_stations"].add_missing_columns([{"good": 1}])
+        db.execute("update noaa_stations set good = 0")
+        db.execute(
+            "update noaa_stations set good = 1 where stationId in ({})".format(
+                ", ".join("?" for _ in GOOD_STATION_IDS)
+            ),
+            GOOD_STATION_IDS,
+        )
+    db.create_view("noaa_stations_map", STATIONS_MAP_VIEW, replace=True)
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--http-cache",
+    type=click.Path(dir_okay=False),
+    help="SQLite file to cache responses in",
+)
+def cli(db_path, http_cache):
+    "Fetch the list of California NOAA stations"
+    assert db_path.endswith(".db")
+    cache = ResponseCache(http_cache) if http_cache else None
+    asyncio.run(fetch_noaa_stations_async(sqlite_utils.Database(db_path), cache=cache))
+    if cache is not None:
+        cache.save_stats()
+        click.echo(cache.summary(), err=True)
+
+
+if __name__ == "__main__":
+    cli()
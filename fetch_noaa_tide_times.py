@@ -1,52 +1,271 @@
+import asyncio
+import click
 import datetime
 import httpx
 import sqlite_utils
-import sys
-from urllib.parse import urlencode
-
-
-def fetch_predictions(station_id):
-    yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    end_date = yesterday + datetime.timedelta(days=365)
-    url = "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter?" + urlencode(
-        {
-            "begin_date": yesterday.strftime("%Y%m%d"),
-            "end_date": end_date.strftime("%Y%m%d"),
-            "product": "predictions",
-            "station": station_id,
-            "datum": "mllw",
-            "time_zone": "lst_ldt",
-            "units": "english",
-            "format": "json",
-        }
-    )
-    response = httpx.get(url)
-    return response.json()["predictions"]
+from http_cache import CachingTransport, ResponseCache
+from http_retries import get_lines_with_retries
+from plugins.template_vars import HEIGHT_SCALE, datetime_to_minute, day_to_minute
+from watermarks import get_watermark, missing_range, set_watermark
 
+DATAGETTER_URL = "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter"
+# Predictions are written in transactions of this many rows, ten days of 6
+# minute predictions
+PREDICTIONS_BATCH = 2400
 
-def fetch_noaa_tide_times(filepath):
-    db = sqlite_utils.Database(filepath)
-    tide_predictions = db.table("tide_predictions", pk=("station_id", "datetime"))
+# Predictions are stored compactly in tide_heights, see HEIGHT_SCALE and
+# datetime_to_minute(). tide_predictions is a view with the original text
+# datetime and float mllw_feet columns, for browsing in Datasette.
+TIDE_HEIGHTS_SQL = """
+create table if not exists tide_heights (
+  station_id integer not null,
+  minute integer not null,
+  mllw_mft integer not null,
+  primary key (station_id, minute)
+) without rowid
+"""
+TIDE_PREDICTIONS_VIEW_SQL = """
+create view if not exists tide_predictions as
+select
+  station_id,
+  strftime('%Y-%m-%d %H:%M', minute * 60, 'unixepoch') as datetime,
+  mllw_mft / {scale:.1f} as mllw_feet
+from
+  tide_heights
+""".format(scale=HEIGHT_SCALE)
+
+
+def prediction_window(today=None, days=365):
+    # Yesterday through days days after that
+    yesterday = (today or datetime.date.today()) - datetime.timedelta(days=1)
+    return yesterday, yesterday + datetime.timedelta(days=days)
+
+
+def month_ranges(begin_date, end_date):
+    # Splits begin_date to end_date, inclusive, into (begin, end) ranges that
+    # each fall within one calendar month
+    ranges = []
+    while begin_date <= end_date:
+        next_month = (begin_date.replace(day=1) + datetime.timedelta(days=32)).replace(
+            day=1
+        )
+        month_end = min(end_date, next_month - datetime.timedelta(days=1))
+        ranges.append((begin_date, month_end))
+        begin_date = next_month
+    return ranges
+
+
+def predictions_params(station_id, begin_date=None, end_date=None):
+    if begin_date is None or end_date is None:
+        begin_date, end_date = prediction_window()
+    return {
+        "begin_date": begin_date.strftime("%Y%m%d"),
+        "end_date": end_date.strftime("%Y%m%d"),
+        "product": "predictions",
+        "station": station_id,
+        "datum": "mllw",
+        "time_zone": "lst_ldt",
+        "units": "english",
+        "format": "csv",
+    }
+
+
+async def stream_predictions_async(
+    client, station_id, begin_date=None, end_date=None, retries=3, backoff=1.0
+):
+    # Yields {"t": "2020-08-19 00:00", "v": "5.913"} predictions, requesting
+    # a month at a time as CSV, so only one month's response is held in
+    # memory however long the range. Each month is read in full before any
+    # of it is yielded, so a month that fails part way through the body is
+    # requested again without repeating what the caller has already seen.
+    if begin_date is None or end_date is None:
+        begin_date, end_date = prediction_window()
+    for month_begin, month_end in month_ranges(begin_date, end_date):
+        lines = await get_lines_with_retries(
+            client,
+            DATAGETTER_URL,
+            params=predictions_params(station_id, month_begin, month_end),
+            retries=retries,
+            backoff=backoff,
+        )
+        # "Date Time, Prediction", or an error message with a 200 status
+        header = lines[0] if lines else ""
+        if not header.startswith("Date Time"):
+            raise ValueError(
+                "NOAA error for station {}: {}".format(station_id, header.strip())
+            )
+        for line in lines[1:]:
+            if line.strip():
+                t, v = line.split(",")[:2]
+                yield {"t": t.strip(), "v": v.strip()}
+
+
+def ensure_tide_heights(db):
+    # Creates tide_heights and the tide_predictions view, first moving rows
+    # over from a tide_predictions table written by an older build
+    with db.conn:
+        db.execute(TIDE_HEIGHTS_SQL)
+        if "tide_predictions" in db.table_names():
+            db.execute(
+                """
+                insert or replace into tide_heights
+                select
+                  station_id,
+                  cast(strftime('%s', datetime) as integer) / 60,
+                  cast(round(mllw_feet * ?) as integer)
+                from
+                  tide_predictions
+                """,
+                [HEIGHT_SCALE],
+            )
+            db.execute("drop table tide_predictions")
+        db.execute(TIDE_PREDICTIONS_VIEW_SQL)
+
+
+def save_predictions(db, station_id, predictions):
+    ensure_tide_heights(db)
+    with db.conn:
+        db.conn.executemany(
+            "insert or replace into tide_heights values (?, ?, ?)",
+            (
+                (
+                    int(station_id),
+                    datetime_to_minute(p["t"]),
+                    round(float(p["v"]) * HEIGHT_SCALE),
+                )
+                for p in predictions
+            ),
+        )
+
+
+def station_ids_for_places(db):
     station_ids = set()
     for place in db["places"].rows:
         if place["station_id"]:
             station_ids.add(place["station_id"])
-    for station_id in station_ids:
-        predictions = fetch_predictions(station_id)
-        with db.conn:
-            tide_predictions.insert_all(
-                (
-                    {
-                        "station_id": station_id,
-                        "datetime": p["t"],
-                        "mllw_feet": float(p["v"]),
-                    }
-                    for p in predictions
-                ),
-                replace=True,
-            )
+    return station_ids
+
+
+def prune_predictions(db, station_id, begin_date):
+    with db.conn:
+        db["tide_heights"].delete_where(
+            "station_id = ? and minute < ?", [station_id, day_to_minute(begin_date)]
+        )
+
+
+async def fetch_noaa_tide_times_async(
+    db,
+    station_ids,
+    concurrency=4,
+    timeout=30.0,
+    retries=3,
+    backoff=1.0,
+    transport=None,
+    full=False,
+    today=None,
+    cache=None,
+    days=365,
+):
+    # Fetches up to concurrency stations at a time over a pooled client,
+    # saving each station's predictions in batches as they stream in. Unless
+    # full is True only the days missing from each station's watermark, in
+    # the window from yesterday to days ahead, are fetched.
+    # Requests go through cache, a ResponseCache, if one is provided.
+    begin_date, end_date = prediction_window(today, days)
+    ranges = {}
+    for station_id in sorted(station_ids):
+        watermark = None
+        if not full:
+            watermark = get_watermark(db, "tide_predictions", station_id)
+        ranges[station_id] = missing_range(watermark, begin_date, end_date)
+        if ranges[station_id] is None and db["tide_heights"].exists():
+            prune_predictions(db, station_id, begin_date)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    if cache is not None:
+        transport = CachingTransport(
+            cache, transport or httpx.AsyncHTTPTransport(limits=limits)
+        )
+    async with httpx.AsyncClient(
+        transport=transport, timeout=timeout, limits=limits
+    ) as client:
+
+        async def fetch(station_id, fetch_begin_date, fetch_end_date):
+            async with semaphore:
+                batch = []
+                async for prediction in stream_predictions_async(
+                    client,
+                    station_id,
+                    fetch_begin_date,
+                    fetch_end_date,
+                    retries,
+                    backoff,
+                ):
+                    batch.append(prediction)
+                    if len(batch) == PREDICTIONS_BATCH:
+                        save_predictions(db, station_id, batch)
+                        batch = []
+                save_predictions(db, station_id, batch)
+            # Only once every month has been saved, so a station that fails
+            # part way through is fetched again next time
+            prune_predictions(db, station_id, begin_date)
+            set_watermark(db, "tide_predictions", station_id, begin_date, end_date)
+
+        results = await asyncio.gather(
+            *[
+                fetch(station_id, *missing)
+                for station_id, missing in ranges.items()
+                if missing is not None
+            ],
+            return_exceptions=True,
+        )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+def fetch_noaa_tide_times(filepath, **kwargs):
+    db = sqlite_utils.Database(filepath)
+    asyncio.run(fetch_noaa_tide_times_async(db, station_ids_for_places(db), **kwargs))
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--concurrency", type=int, default=4, help="Stations to fetch at the same time"
+)
+@click.option("--timeout", type=float, default=30.0, help="Per-request timeout")
+@click.option("--retries", type=int, default=3, help="Retries per request")
+@click.option(
+    "--backoff", type=float, default=1.0, help="Seconds before the first retry"
+)
+@click.option(
+    "--full", is_flag=True, help="Refetch the whole window, ignoring watermarks"
+)
+@click.option(
+    "--http-cache",
+    type=click.Path(dir_okay=False),
+    help="SQLite file to cache responses in",
+)
+@click.option("--days", type=int, default=365, help="Days ahead to fetch")
+def cli(db_path, concurrency, timeout, retries, backoff, full, http_cache, days):
+    "Fetch NOAA tide predictions for every station used by a place"
+    assert db_path.endswith(".db")
+    cache = ResponseCache(http_cache) if http_cache else None
+    fetch_noaa_tide_times(
+        db_path,
+        concurrency=concurrency,
+        timeout=timeout,
+        retries=retries,
+        backoff=backoff,
+        full=full,
+        cache=cache,
+        days=days,
+    )
+    if cache is not None:
+        cache.save_stats()
+        click.echo(cache.summary(), err=True)
 
 
 if __name__ == "__main__":
-    assert sys.argv[-1].endswith(".db")
-    fetch_noaa_tide_times(sys.argv[-1])
+    cli()
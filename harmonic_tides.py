@@ -0,0 +1,422 @@
+from calculate_sunrise_sunset import utc_offsets
+from fetch_noaa_tide_times import prediction_window, save_predictions
+from plugins.template_vars import day_number, day_to_minute
+import click
+import datetime
+import numpy
+import pytz
+import sqlite_utils
+
+# Predicts tide heights from NOAA harmonic constituents, following Schureman's
+# "Manual of Harmonic Analysis and Prediction of Tides" with astronomical
+# arguments from Meeus's "Astronomical Algorithms":
+#
+#   height(t) = z0 + sum(f(t) * amplitude * cos(V(t) + u(t) - phase))
+#
+# where phase is the constituent's Greenwich epoch (NOAA's phase_GMT), V is
+# its equilibrium argument, u and f its nodal corrections, and z0 the height
+# of mean sea level above MLLW.
+
+# Meeus polynomials in Julian centuries since J2000.0, in degrees
+LUNAR_LONGITUDE = (218.3164591, 481267.88134236, -0.0013268, 1 / 538841 - 1 / 65194000)
+SOLAR_LONGITUDE = (280.46645, 36000.76983, 0.0003032)
+LUNAR_PERIGEE = (83.3532430, 4069.0137111, -0.0103238, -1 / 80053, 1 / 18999000)
+LUNAR_NODE = (125.0445550, -1934.1361849, 0.0020762, 1 / 467410, -1 / 60616000)
+SOLAR_PERIGEE = (280.46645 - 357.52910, 36000.76932 - 35999.05030, 0.0004591, 4.8e-7)
+OBLIQUITY = tuple(
+    c * 1e-2**i
+    for i, c in enumerate(
+        (
+            23 + 26 / 60 + 21.448 / 3600,
+            -4680.93 / 3600,
+            -1.55 / 3600,
+            1999.25 / 3600,
+            -51.38 / 3600,
+            -249.67 / 3600,
+            -39.05 / 3600,
+            7.12 / 3600,
+            27.87 / 3600,
+            5.79 / 3600,
+            2.45 / 3600,
+        )
+    )
+)
+# Inclination of the moon's orbit to the ecliptic
+LUNAR_INCLINATION = 5.145
+
+# Equilibrium arguments as multiples of (tau, s, h, p, N, p1, 90 degrees),
+# where tau = T + h - s is the hour angle of the mean moon, along with the
+# nodal corrections that apply to each constituent
+BASE_CONSTITUENTS = {
+    "SA": ((0, 0, 1, 0, 0, 0, 0), None),
+    "SSA": ((0, 0, 2, 0, 0, 0, 0), None),
+    "MM": ((0, 1, 0, -1, 0, 0, 0), "MM"),
+    "MF": ((0, 2, 0, 0, 0, 0, 0), "MF"),
+    "Q1": ((1, -2, 0, 1, 0, 0, 1), "O1"),
+    "O1": ((1, -1, 0, 0, 0, 0, 1), "O1"),
+    "K1": ((1, 1, 0, 0, 0, 0, -1), "K1"),
+    "J1": ((1, 2, 0, -1, 0, 0, -1), "J1"),
+    "M1": ((1, 0, 0, 1, 0, 0, 1), "M1"),
+    "P1": ((1, 1, -2, 0, 0, 0, 1), None),
+    "S1": ((1, 1, -1, 0, 0, 0, 0), None),
+    "OO1": ((1, 3, 0, 0, 0, 0, -1), "OO1"),
+    "2N2": ((2, -2, 0, 2, 0, 0, 0), "M2"),
+    "N2": ((2, -1, 0, 1, 0, 0, 0), "M2"),
+    "NU2": ((2, -1, 2, -1, 0, 0, 0), "M2"),
+    "M2": ((2, 0, 0, 0, 0, 0, 0), "M2"),
+    "LAM2": ((2, 1, -2, 1, 0, 0, 2), "M2"),
+    "L2": ((2, 1, 0, -1, 0, 0, 2), "L2"),
+    "T2": ((2, 2, -3, 0, 0, 1, 0), None),
+    "S2": ((2, 2, -2, 0, 0, 0, 0), None),
+    "R2": ((2, 2, -1, 0, 0, -1, 2), None),
+    "K2": ((2, 2, 0, 0, 0, 0, 0), "K2"),
+    "M3": ((3, 0, 0, 0, 0, 0, 0), "M3"),
+}
+# Shallow water and compound constituents, as sums of base constituents
+COMPOUND_CONSTITUENTS = {
+    "MSF": (("S2", 1), ("M2", -1)),
+    "2Q1": (("N2", 1), ("J1", -1)),
+    "RHO": (("NU2", 1), ("K1", -1)),
+    "MU2": (("M2", 2), ("S2", -1)),
+    "2SM2": (("S2", 2), ("M2", -1)),
+    "2MK3": (("M2", 1), ("O1", 1)),
+    "MK3": (("M2", 1), ("K1", 1)),
+    "MN4": (("M2", 1), ("N2", 1)),
+    "M4": (("M2", 2),),
+    "MS4": (("M2", 1), ("S2", 1)),
+    "S4": (("S2", 2),),
+    "M6": (("M2", 3),),
+    "S6": (("S2", 3),),
+    "M8": (("M2", 4),),
+}
+CONSTITUENT_NAMES = set(BASE_CONSTITUENTS) | set(COMPOUND_CONSTITUENTS)
+
+
+def julian_centuries(timestamps):
+    # Since J2000.0, for Unix timestamps
+    return (
+        numpy.asarray(timestamps, dtype=float) / 86400 + 2440587.5 - 2451545
+    ) / 36525
+
+
+def astronomical_arguments(timestamps):
+    # Returns a dictionary of arrays of angles in degrees
+    centuries = julian_centuries(timestamps)
+
+    def polynomial(coefficients):
+        return numpy.polynomial.polynomial.polyval(centuries, coefficients) % 360
+
+    s = polynomial(LUNAR_LONGITUDE)
+    h = polynomial(SOLAR_LONGITUDE)
+    p = polynomial(LUNAR_PERIGEE)
+    N = polynomial(LUNAR_NODE)
+    p1 = polynomial(SOLAR_PERIGEE)
+    omega = numpy.radians(polynomial(OBLIQUITY))
+    i = numpy.radians(LUNAR_INCLINATION)
+    N_rad = numpy.radians(N)
+    # Schureman table 6: I, nu and xi from N, i and omega
+    I = numpy.arccos(
+        numpy.cos(i) * numpy.cos(omega)
+        - numpy.sin(i) * numpy.sin(omega) * numpy.cos(N_rad)
+    )
+    e1 = numpy.arctan(
+        numpy.cos((omega - i) / 2) / numpy.cos((omega + i) / 2) * numpy.tan(N_rad / 2)
+    )
+    e2 = numpy.arctan(
+        numpy.sin((omega - i) / 2) / numpy.sin((omega + i) / 2) * numpy.tan(N_rad / 2)
+    )
+    e1, e2 = e1 - N_rad / 2, e2 - N_rad / 2
+    xi = -(e1 + e2)
+    nu = e1 - e2
+    # Schureman equations 224 and 232
+    nu_prime = numpy.arctan(
+        numpy.sin(2 * I) * numpy.sin(nu) / (numpy.sin(2 * I) * numpy.cos(nu) + 0.3347)
+    )
+    nu_double_prime = 0.5 * numpy.arctan(
+        numpy.sin(I) ** 2
+        * numpy.sin(2 * nu)
+        / (numpy.sin(I) ** 2 * numpy.cos(2 * nu) + 0.0727)
+    )
+    # Hour angle of the mean sun, from the fraction of the Julian day
+    julian_day = numpy.asarray(timestamps, dtype=float) / 86400 + 2440587.5
+    T = (julian_day % 1) * 360
+    return {
+        "tau": (T + h - s) % 360,
+        "s": s,
+        "h": h,
+        "p": p,
+        "N": N,
+        "p1": p1,
+        "omega": omega,
+        "i": i,
+        "I": I,
+        "xi": numpy.degrees(xi),
+        "nu": numpy.degrees(nu),
+        "nu_prime": numpy.degrees(nu_prime),
+        "nu_double_prime": numpy.degrees(nu_double_prime),
+        # Schureman's P, the lunar perigee measured from the intersection
+        "P": numpy.radians(p - numpy.degrees(xi)),
+    }
+
+
+def nodal_corrections(kind, a):
+    # Returns (u in degrees, f) for a BASE_CONSTITUENTS nodal correction kind,
+    # using Schureman equations 65-78, 195-235 and table 2
+    omega, i, I = a["omega"], a["i"], a["I"]
+    xi, nu = a["xi"], a["nu"]
+
+    def f_M2():
+        mean = numpy.cos(omega / 2) ** 4 * numpy.cos(i / 2) ** 4
+        return numpy.cos(I / 2) ** 4 / mean
+
+    def f_O1():
+        mean = numpy.sin(omega) * numpy.cos(omega / 2) ** 2 * numpy.cos(i / 2) ** 4
+        return numpy.sin(I) * numpy.cos(I / 2) ** 2 / mean
+
+    if kind is None:
+        return 0.0, 1.0
+    if kind == "MM":
+        mean = (2 / 3 - numpy.sin(omega) ** 2) * (1 - 1.5 * numpy.sin(i) ** 2)
+        return 0.0, (2 / 3 - numpy.sin(I) ** 2) / mean
+    if kind == "MF":
+        mean = numpy.sin(omega) ** 2 * numpy.cos(i / 2) ** 4
+        return -2 * xi, numpy.sin(I) ** 2 / mean
+    if kind == "O1":
+        return 2 * xi - nu, f_O1()
+    if kind == "J1":
+        mean = numpy.sin(2 * omega) * (1 - 1.5 * numpy.sin(i) ** 2)
+        return -nu, numpy.sin(2 * I) / mean
+    if kind == "OO1":
+        mean = numpy.sin(omega) * numpy.sin(omega / 2) ** 2 * numpy.cos(i / 2) ** 4
+        return -2 * xi - nu, numpy.sin(I) * numpy.sin(I / 2) ** 2 / mean
+    if kind == "M2":
+        return 2 * xi - 2 * nu, f_M2()
+    if kind == "M3":
+        return 1.5 * (2 * xi - 2 * nu), f_M2() ** 1.5
+    if kind == "K1":
+        mean = 0.5023 * numpy.sin(2 * omega) * (1 - 1.5 * numpy.sin(i) ** 2) + 0.1681
+        f = (
+            0.2523 * numpy.sin(2 * I) ** 2
+            + 0.1689 * numpy.sin(2 * I) * numpy.cos(numpy.radians(nu))
+            + 0.0283
+        ) ** 0.5 / mean
+        return -a["nu_prime"], f
+    if kind == "K2":
+        mean = 0.5023 * numpy.sin(omega) ** 2 * (1 - 1.5 * numpy.sin(i) ** 2) + 0.0365
+        f = (
+            0.2533 * numpy.sin(I) ** 4
+            + 0.0367 * numpy.sin(I) ** 2 * numpy.cos(2 * numpy.radians(nu))
+            + 0.0013
+        ) ** 0.5 / mean
+        return -2 * a["nu_double_prime"], f
+    if kind == "L2":
+        P = a["P"]
+        R = numpy.degrees(
+            numpy.arctan(
+                numpy.sin(2 * P) / (numpy.tan(I / 2) ** -2 / 6 - numpy.cos(2 * P))
+            )
+        )
+        f = (
+            f_M2()
+            * (
+                1
+                - 12 * numpy.tan(I / 2) ** 2 * numpy.cos(2 * P)
+                + 36 * numpy.tan(I / 2) ** 4
+            )
+            ** 0.5
+        )
+        return 2 * xi - 2 * nu - R, f
+    if kind == "M1":
+        # NOAA's M1 speed includes the lunar perigee p, so it is taken back out
+        # of Schureman's Q here
+        P = a["P"]
+        Q = numpy.degrees(
+            numpy.arctan((5 * numpy.cos(I) - 1) / (7 * numpy.cos(I) + 1) * numpy.tan(P))
+        )
+        # arctan only covers half a turn - keep Q in the same half as P
+        Q = numpy.where(numpy.cos(P) < 0, Q + 180, Q)
+        f = (
+            f_O1()
+            * (
+                0.25
+                + 1.5 * numpy.cos(I) * numpy.cos(2 * P) * numpy.cos(I / 2) ** -0.5
+                + 2.25 * numpy.cos(I) ** 2 * numpy.cos(I / 2) ** -4
+            )
+            ** 0.5
+        )
+        return xi - nu + Q - a["p"], f
+    raise ValueError("Unknown nodal correction {}".format(kind))
+
+
+def constituent_terms(name, a):
+    # Returns (V, u, f) arrays for the constituent called name, V and u in
+    # degrees
+    if name in COMPOUND_CONSTITUENTS:
+        V, u, f = 0.0, 0.0, 1.0
+        for member, n in COMPOUND_CONSTITUENTS[name]:
+            member_V, member_u, member_f = constituent_terms(member, a)
+            V = V + n * member_V
+            u = u + n * member_u
+            f = f * member_f ** abs(n)
+        return V, u, f
+    coefficients, kind = BASE_CONSTITUENTS[name]
+    V = 90.0 * coefficients[6] + sum(
+        c * a[key] for c, key in zip(coefficients, ("tau", "s", "h", "p", "N", "p1"))
+    )
+    u, f = nodal_corrections(kind, a)
+    ones = numpy.ones_like(a["tau"])
+    return V * ones, u * ones, f * ones
+
+
+def constituent_speed(name, timestamp=946728000):
+    # Degrees per hour, from the change in V over an hour
+    V = constituent_terms(name, astronomical_arguments([timestamp, timestamp + 3600]))[
+        0
+    ]
+    return (V[1] - V[0]) % 360
+
+
+def predict(constituents, timestamps, z0=0.0):
+    # constituents is a list of {"name", "amplitude", "phase"} dictionaries,
+    # phase being the Greenwich epoch in degrees. Returns an array of heights
+    # in the amplitudes' units at each Unix timestamp.
+    a = astronomical_arguments(timestamps)
+    heights = numpy.full(len(a["tau"]), float(z0))
+    for constituent in constituents:
+        V, u, f = constituent_terms(constituent["name"], a)
+        heights += (
+            f
+            * constituent["amplitude"]
+            * numpy.cos(numpy.radians(V + u - constituent["phase"]))
+        )
+    return heights
+
+
+def local_prediction_times(tz, start_date, end_date):
+    # Every 6 minutes of wall clock time in tz from the start of start_date to
+    # the end of end_date, as (local minutes, Unix timestamps). Local times
+    # skipped by a daylight saving change are left out.
+    local_seconds = 60 * numpy.arange(
+        day_to_minute(start_date), day_to_minute(end_date) + 1440, 6
+    )
+    offsets_for = utc_offsets(
+        tz, local_seconds[0] - 2 * 86400, local_seconds[-1] + 2 * 86400
+    )
+    # The offset at local time is close enough to find the offset at UTC
+    timestamps = local_seconds - offsets_for(local_seconds)
+    timestamps = local_seconds - offsets_for(timestamps)
+    exists = timestamps + offsets_for(timestamps) == local_seconds
+    return local_seconds[exists] // 60, timestamps[exists]
+
+
+def predict_station(constituents, z0, tz, start_date, end_date):
+    # Predictions from start_date to end_date in the same shape as the NOAA
+    # datagetter returns: {"t": "YYYY-MM-DD HH:MM" local time, "v": feet}
+    minutes, timestamps = local_prediction_times(tz, start_date, end_date)
+    heights = predict(constituents, timestamps, z0)
+    times = numpy.datetime_as_string((minutes * 60).astype("datetime64[s]"), unit="m")
+    return [
+        {"t": t.replace("T", " "), "v": "{:.3f}".format(v)}
+        for t, v in zip(times.tolist(), heights.tolist())
+    ]
+
+
+def station_harmonics(db):
+    # {station_id: (z0, constituents)} for stations with harmonic constituents
+    if not db["harmonic_constituents"].exists() or not db["tide_datums"].exists():
+        return {}
+    z0s = {r["station_id"]: r["msl_above_mllw"] for r in db["tide_datums"].rows}
+    harmonics = {}
+    for row in db["harmonic_constituents"].rows_where(order_by="station_id, name"):
+        if row["station_id"] in z0s and row["name"] in CONSTITUENT_NAMES:
+            harmonics.setdefault(row["station_id"], (z0s[row["station_id"]], []))[
+                1
+            ].append(row)
+    return harmonics
+
+
+def days_with_predictions(db, station_id, start_date, end_date):
+    if not db["tide_heights"].exists():
+        return set()
+    return {
+        row["day"]
+        for row in db.query(
+            "select distinct minute / 1440 as day from tide_heights "
+            "where station_id = ? and minute >= ? and minute < ?",
+            [station_id, day_to_minute(start_date), day_to_minute(end_date) + 1440],
+        )
+    }
+
+
+def stations_missing_days(db, start_date, end_date):
+    # {station_id: days from start_date to end_date without predictions} for
+    # the stations of live places, leaving out stations with every day
+    days = (end_date - start_date).days + 1
+    missing = {}
+    for row in db.query(
+        "select distinct station_id from places "
+        "where live_on_site = 1 and station_id is not null"
+    ):
+        station_id = int(row["station_id"])
+        covered = len(days_with_predictions(db, station_id, start_date, end_date))
+        if covered < days:
+            missing[station_id] = days - covered
+    return missing
+
+
+def fill_predictions(db, start_date, end_date, replace=False):
+    # Writes harmonic predictions for every day from start_date to end_date
+    # that has no predictions yet, or every day if replace is True, for each
+    # station with constituents. Returns the number of days written.
+    time_zones = {
+        place["station_id"]: place["time_zone"]
+        for place in db["places"].rows_where("station_id is not null")
+    }
+    written = 0
+    for station_id, (z0, constituents) in station_harmonics(db).items():
+        tz = pytz.timezone(time_zones.get(station_id, "America/Los_Angeles"))
+        existing = set()
+        if not replace:
+            existing = days_with_predictions(db, station_id, start_date, end_date)
+        days = [
+            start_date + datetime.timedelta(days=i)
+            for i in range((end_date - start_date).days + 1)
+        ]
+        missing = [day for day in days if day_number(day) not in existing]
+        # Predict each run of consecutive missing days in one go
+        runs = []
+        for day in missing:
+            if runs and runs[-1][1] == day - datetime.timedelta(days=1):
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+        for run_start, run_end in runs:
+            save_predictions(
+                db,
+                station_id,
+                predict_station(constituents, z0, tz, run_start, run_end),
+            )
+        written += len(missing)
+    return written
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False))
+@click.option(
+    "--days", type=int, help="Predict this many days ahead instead of the NOAA window"
+)
+@click.option("--replace", is_flag=True, help="Replace existing predictions")
+def cli(db_path, days, replace):
+    "Fill in tide predictions from harmonic constituents for days without any"
+    assert db_path.endswith(".db")
+    start_date, end_date = prediction_window()
+    if days is not None:
+        end_date = start_date + datetime.timedelta(days=days)
+    written = fill_predictions(
+        sqlite_utils.Database(db_path), start_date, end_date, replace=replace
+    )
+    click.echo("Predicted {} station days from harmonics".format(written), err=True)
+
+
+if __name__ == "__main__":
+    cli()
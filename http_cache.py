@@ -0,0 +1,177 @@
+import httpx
+import json
+import sqlite_utils
+import time
+import urllib.parse
+
+# On-disk cache of GET responses that carry an ETag or Last-Modified header.
+# Cached URLs are revalidated with a conditional request, so unchanged data
+# costs a 304 rather than a full download.
+
+# Not stored: the cached body is already decoded
+SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=200 * 1024 * 1024):
+        self.db = sqlite_utils.Database(path)
+        self.max_bytes = max_bytes
+        # Counts for this run, by host
+        self.stats = {}
+        if not self.db["responses"].exists():
+            self.db["responses"].create(
+                {
+                    "url": str,
+                    "etag": str,
+                    "last_modified": str,
+                    "headers": str,
+                    "body": bytes,
+                    "size": int,
+                    "last_used": float,
+                },
+                pk="url",
+            )
+            self.db["responses"].create_index(["last_used"])
+
+    def get(self, url):
+        rows = list(self.db["responses"].rows_where("url = ?", [url]))
+        return rows[0] if rows else None
+
+    def put(self, url, response, body):
+        headers = [
+            (key, value)
+            for key, value in response.headers.multi_items()
+            if key.lower() not in SKIP_HEADERS
+        ]
+        with self.db.conn:
+            self.db["responses"].insert(
+                {
+                    "url": url,
+                    "etag": response.headers.get("etag"),
+                    "last_modified": response.headers.get("last-modified"),
+                    "headers": json.dumps(headers),
+                    "body": body,
+                    "size": len(body),
+                    "last_used": time.time(),
+                },
+                replace=True,
+            )
+        self.evict()
+
+    def touch(self, url, response):
+        # A 304 may carry updated validators
+        updates = {"last_used": time.time()}
+        if response.headers.get("etag"):
+            updates["etag"] = response.headers["etag"]
+        if response.headers.get("last-modified"):
+            updates["last_modified"] = response.headers["last-modified"]
+        with self.db.conn:
+            self.db["responses"].update(url, updates)
+
+    def evict(self):
+        # Drops least recently used responses until the cache fits max_bytes
+        total = 0
+        evict = []
+        for row in self.db.query(
+            "select url, size from responses order by last_used desc"
+        ):
+            total += row["size"]
+            if total > self.max_bytes:
+                evict.append(row["url"])
+        if evict:
+            with self.db.conn:
+                for url in evict:
+                    self.db["responses"].delete(url)
+            self.count(None, "evictions", len(evict))
+
+    def count(self, url, stat, n=1):
+        host = urllib.parse.urlsplit(url).netloc if url else None
+        for key in (host, "total"):
+            if key:
+                counts = self.stats.setdefault(
+                    key, {"hits": 0, "misses": 0, "evictions": 0}
+                )
+                counts[stat] += n
+
+    def save_stats(self):
+        # Adds this run's counts to the running totals in the stats table
+        with self.db.conn:
+            for host, counts in self.stats.items():
+                rows = list(self.db["stats"].rows_where("host = ?", [host]))
+                previous = rows[0] if rows else {}
+                self.db["stats"].insert(
+                    dict(
+                        {
+                            key: value + previous.get(key, 0)
+                            for key, value in counts.items()
+                        },
+                        host=host,
+                    ),
+                    pk="host",
+                    replace=True,
+                )
+
+    def summary(self):
+        counts = self.stats.get("total", {"hits": 0, "misses": 0, "evictions": 0})
+        return "HTTP cache: {hits} hits, {misses} misses, {evictions} evictions".format(
+            **counts
+        )
+
+
+class CachingTransport(httpx.AsyncBaseTransport):
+    # Wraps another transport, adding If-None-Match/If-Modified-Since headers
+    # to GET requests for cached URLs. A 304 is returned to the client as the
+    # cached 200 response, with response.extensions["http_cache"] == "hit".
+    def __init__(self, cache, transport=None):
+        self.cache = cache
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        if request.method != "GET":
+            return await self.transport.handle_async_request(request)
+        url = str(request.url)
+        cached = self.cache.get(url)
+        if cached:
+            if cached["etag"]:
+                request.headers["if-none-match"] = cached["etag"]
+            if cached["last_modified"]:
+                request.headers["if-modified-since"] = cached["last_modified"]
+        response = await self.transport.handle_async_request(request)
+        if cached and response.status_code == 304:
+            await response.aclose()
+            self.cache.touch(url, response)
+            self.cache.count(url, "hits")
+            return httpx.Response(
+                200,
+                headers=json.loads(cached["headers"]),
+                content=cached["body"],
+                request=request,
+                extensions={"http_cache": "hit"},
+            )
+        self.cache.count(url, "misses")
+        if response.status_code != 200 or not (
+            response.headers.get("etag") or response.headers.get("last-modified")
+        ):
+            return response
+        # Store the decoded body, so cached responses never need decompressing
+        body = b"".join([chunk async for chunk in response.aiter_raw()])
+        await response.aclose()
+        decoded = httpx.Response(
+            200, headers=response.headers, content=body, request=request
+        )
+        body = decoded.content
+        self.cache.put(url, decoded, body)
+        return httpx.Response(
+            200,
+            headers=[
+                (key, value)
+                for key, value in response.headers.multi_items()
+                if key.lower() not in SKIP_HEADERS
+            ],
+            content=body,
+            request=request,
+            extensions={"http_cache": "miss"},
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,47 @@
+import asyncio
+import httpx
+
+# Retry on these status codes, as well as on network errors and timeouts
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+async def get_with_retries(client, url, params=None, retries=3, backoff=1.0):
+    # Retries failed requests with exponential backoff: backoff, 2 * backoff...
+    for attempt in range(retries + 1):
+        try:
+            response = await client.get(url, params=params)
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                return response
+            error = httpx.HTTPStatusError(
+                "{} for {}".format(response.status_code, response.url),
+                request=response.request,
+                response=response,
+            )
+        except httpx.TransportError as ex:
+            error = ex
+        if attempt == retries:
+            raise error
+        await asyncio.sleep(backoff * 2**attempt)
+
+
+async def get_lines_with_retries(client, url, params=None, retries=3, backoff=1.0):
+    # The same as get_with_retries, but returns the body's lines, read as
+    # they arrive inside the retry loop so that a timeout or dropped
+    # connection part way through the body is retried too
+    for attempt in range(retries + 1):
+        try:
+            async with client.stream("GET", url, params=params) as response:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return [line async for line in response.aiter_lines()]
+                error = httpx.HTTPStatusError(
+                    "{} for {}".format(response.status_code, response.url),
+                    request=response.request,
+                    response=response,
+                )
+        except httpx.TransportError as ex:
+            error = ex
+        if attempt == retries:
+            raise error
+        await asyncio.sleep(backoff * 2**attempt)
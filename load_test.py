@@ -0,0 +1,281 @@
+from benchmark import synthetic_build, synthetic_harmonics
+from build import STAGE_NAMES
+from datasette.plugins import pm
+from prerender_places import site_datasette
+import asyncio
+import click
+import datetime
+import httpx
+import json
+import numpy
+import pathlib
+import random
+import sqlite_utils
+import sys
+import tempfile
+import time
+import uvicorn
+
+# Drives concurrent requests for every live place at the site, in process or
+# over a local socket, and reports throughput and latency percentiles.
+
+ROUTES = {
+    "place_page": "/us/{slug}",
+    "tides_json": "/us/{slug}/tides.json",
+    "best_low_tides": "/best-low-tides.json",
+}
+
+
+def parse_mix(mix):
+    # "place_page=9,tides_json=1" to [("place_page", 9.0), ("tides_json", 1.0)]
+    weights = []
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        route = route.strip()
+        if route not in ROUTES:
+            raise click.BadParameter(
+                "Unknown route {}, expected one of {}".format(route, ", ".join(ROUTES))
+            )
+        weights.append((route, float(weight or 1)))
+    return weights
+
+
+def synthesize_database(directory, stations=4, places=8, days=366):
+    # The benchmark database, built by every stage but prerendering
+    synthetic_build(
+        directory,
+        synthetic_harmonics(stations),
+        places,
+        days,
+        datetime.date.today(),
+        only=set(STAGE_NAMES) - {"prerender_places"},
+    )
+    return str(pathlib.Path(directory) / "data.db")
+
+
+async def generate_load(
+    client, slugs, mix, concurrency=10, duration=10.0, warmup=2.0, seed=0
+):
+    # concurrency workers each send one request after another, picking a
+    # route by weight from mix and a slug at random, for warmup and then
+    # duration seconds. Returns ({route: [latency in seconds]}, {route:
+    # errors}, seconds measured) for requests started after the warm-up.
+    rng = random.Random(seed)
+    routes, weights = zip(*mix)
+    latencies = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    measure_from = time.perf_counter() + warmup
+    end = measure_from + duration
+
+    async def worker():
+        while time.perf_counter() < end:
+            route = rng.choices(routes, weights)[0]
+            path = ROUTES[route].format(slug=rng.choice(slugs))
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                failed = response.status_code != 200
+            except httpx.HTTPError:
+                failed = True
+            if start >= measure_from:
+                latencies[route].append(time.perf_counter() - start)
+                errors[route] += failed
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - measure_from
+
+
+def summarize(latencies, errors, seconds):
+    if not latencies:
+        return {"requests": 0, "errors": errors, "throughput_rps": 0.0}
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / seconds, 2),
+        "p50_ms": round(p50, 2),
+        "p95_ms": round(p95, 2),
+        "p99_ms": round(p99, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def report(latencies, errors, seconds):
+    # Summaries for each route and all of them together
+    results = {
+        route: summarize(latencies[route], errors[route], seconds)
+        for route in latencies
+    }
+    results["overall"] = summarize(
+        [latency for route in latencies for latency in latencies[route]],
+        sum(errors.values()),
+        seconds,
+    )
+    return results
+
+
+def format_report(results):
+    lines = [
+        "{:<12} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+        )
+    ]
+    for route, summary in results.items():
+        lines.append(
+            "{:<12} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+                route,
+                summary["requests"],
+                summary["errors"],
+                summary["throughput_rps"],
+                summary.get("p50_ms", "-"),
+                summary.get("p95_ms", "-"),
+                summary.get("p99_ms", "-"),
+            )
+        )
+    return "\n".join(lines)
+
+
+async def load_test(
+    db_path,
+    mix,
+    concurrency=10,
+    duration=10.0,
+    warmup=2.0,
+    socket=False,
+    page_cache=True,
+    seed=0,
+):
+    datasette = site_datasette(db_path, pathlib.Path(__file__).parent)
+    await datasette.invoke_startup()
+    slugs = [
+        place["slug"]
+        for place in sqlite_utils.Database(db_path)["places"].rows_where(
+            "live_on_site = 1", order_by="slug"
+        )
+    ]
+    cache = pm.get_plugin("urls.py").page_cache
+    max_size = cache.max_size
+    if not page_cache:
+        cache.max_size = 0
+    try:
+        if socket:
+            return await load_test_socket(
+                datasette, slugs, mix, concurrency, duration, warmup, seed
+            )
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=datasette.app()),
+            base_url="http://localhost",
+            limits=httpx.Limits(max_connections=concurrency),
+        ) as client:
+            return report(
+                *await generate_load(
+                    client, slugs, mix, concurrency, duration, warmup, seed
+                )
+            )
+    finally:
+        cache.max_size = max_size
+
+
+async def load_test_socket(datasette, slugs, mix, concurrency, duration, warmup, seed):
+    # Served by uvicorn on a free port, in this process and event loop
+    server = uvicorn.Server(
+        uvicorn.Config(datasette.app(), host="127.0.0.1", port=0, log_level="warning")
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        async with httpx.AsyncClient(
+            base_url="http://127.0.0.1:{}".format(port),
+            limits=httpx.Limits(max_connections=concurrency),
+            timeout=60,
+        ) as client:
+            return report(
+                *await generate_load(
+                    client, slugs, mix, concurrency, duration, warmup, seed
+                )
+            )
+    finally:
+        server.should_exit = True
+        await serving
+
+
+@click.command()
+@click.option(
+    "--db",
+    "db_path",
+    type=click.Path(dir_okay=False, exists=True),
+    help="Database to serve, instead of a synthetic one",
+)
+@click.option("--stations", type=int, default=4, help="Synthetic tide stations")
+@click.option("--places", type=int, default=8, help="Synthetic live places")
+@click.option("--concurrency", type=int, default=10, help="Requests in flight")
+@click.option("--duration", type=float, default=10.0, help="Seconds to measure for")
+@click.option("--warmup", type=float, default=2.0, help="Seconds before measuring")
+@click.option(
+    "--mix",
+    default="place_page=9,tides_json=1",
+    show_default=True,
+    help="Weights for each route",
+)
+@click.option("--socket", is_flag=True, help="Serve over a local socket with uvicorn")
+@click.option("--no-page-cache", is_flag=True, help="Render every place page afresh")
+@click.option("--seed", type=int, default=0, help="Seed for picking routes and slugs")
+@click.option(
+    "-o", "--output", type=click.File("w"), help="Write JSON results to this file"
+)
+def cli(
+    db_path,
+    stations,
+    places,
+    concurrency,
+    duration,
+    warmup,
+    mix,
+    socket,
+    no_page_cache,
+    seed,
+    output,
+):
+    "Load test the place pages for every live place"
+    mix = parse_mix(mix)
+    with tempfile.TemporaryDirectory() as directory:
+        if db_path is None:
+            click.echo("Building a synthetic database...", err=True)
+            db_path = synthesize_database(directory, stations, places)
+        results = asyncio.run(
+            load_test(
+                db_path,
+                mix,
+                concurrency=concurrency,
+                duration=duration,
+                warmup=warmup,
+                socket=socket,
+                page_cache=not no_page_cache,
+                seed=seed,
+            )
+        )
+    if output:
+        json.dump(
+            {
+                "parameters": {
+                    "concurrency": concurrency,
+                    "duration": duration,
+                    "warmup": warmup,
+                    "mix": dict(mix),
+                    "socket": socket,
+                    "page_cache": not no_page_cache,
+                },
+                "results": results,
+            },
+            output,
+            indent=2,
+        )
+    click.echo(format_report(results), err=True)
+    if results["overall"]["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
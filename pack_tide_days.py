@@ -0,0 +1,54 @@
+from plugins.template_vars import pack_tide_day
+import itertools
+import sqlite_utils
+import sys
+
+TIDE_DAYS_SQL = """
+create table if not exists tide_days (
+  station_id integer not null,
+  day integer not null,
+  heights blob not null,
+  primary key (station_id, day)
+) without rowid
+"""
+
+
+def pack_station_days(tide_times):
+    # tide_times are tide_heights rows for one station ordered by minute.
+    # Yields (day_number, blob) for every complete day.
+    for day_number, rows in itertools.groupby(
+        tide_times, key=lambda t: t["minute"] // 1440
+    ):
+        blob = pack_tide_day(day_number, list(rows))
+        if blob is not None:
+            yield day_number, blob
+
+
+def pack_tide_days(db):
+    # Rewrites tide_days from tide_heights. Incomplete days are left out, and
+    # readers fall back to tide_heights for those.
+    with db.conn:
+        db.execute(TIDE_DAYS_SQL)
+        db.execute("delete from tide_days")
+        station_ids = [
+            r[0] for r in db.execute("select distinct station_id from tide_heights")
+        ]
+        for station_id in station_ids:
+            tide_times = db["tide_heights"].rows_where(
+                "station_id = ?",
+                [station_id],
+                order_by="minute",
+                select="minute, mllw_mft",
+            )
+            db.conn.executemany(
+                "insert into tide_days values (?, ?, ?)",
+                (
+                    (station_id, day_number, blob)
+                    for day_number, blob in pack_station_days(tide_times)
+                ),
+            )
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1].endswith(".db")
+    pack_tide_days(sqlite_utils.Database(sys.argv[-1]))
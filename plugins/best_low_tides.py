@@ -0,0 +1,145 @@
+from datasette import hookimpl
+from datasette.plugins import pm
+from datasette.utils.asgi import Response
+import datetime
+import heapq
+import itertools
+import pytz
+
+# Limits for /best-low-tides.json
+DEFAULT_DAYS = 90
+MAX_DAYS = 366
+DEFAULT_RESULTS = 20
+MAX_RESULTS = 200
+
+LOW_TIDES_SQL = """
+select
+  daylight_low_tides.place,
+  places.name,
+  places.region,
+  places.time_zone,
+  daylight_low_tides.feet,
+  daylight_low_tides.day,
+  daylight_low_tides.time
+from daylight_low_tides join places on places.slug = daylight_low_tides.place
+order by daylight_low_tides.place, daylight_low_tides.feet, daylight_low_tides.day
+"""
+
+
+class LowTideIndex:
+    # Every place's daylight low tides from the daylight_low_tides table, held
+    # in memory as one run per place sorted by height
+    def __init__(self, rows):
+        self.places = {}
+        self.low_tides = {}
+        for row in rows:
+            slug = row["place"]
+            if slug not in self.places:
+                self.places[slug] = {
+                    "name": row["name"],
+                    "region": row["region"],
+                    "time_zone": row["time_zone"],
+                }
+                self.low_tides[slug] = []
+            self.low_tides[slug].append((row["feet"], row["day"], row["time"], slug))
+
+    def regions(self):
+        return sorted({place["region"] for place in self.places.values()})
+
+    def best(self, k, region=None, start=None, days=DEFAULT_DAYS, max_feet=None):
+        # The k lowest (feet, day, time, slug) across the places in region, on
+        # days from start, or each place's own local today, for days days
+        def run(slug):
+            first = start
+            if first is None:
+                time_zone = pytz.timezone(self.places[slug]["time_zone"])
+                first = datetime.datetime.now(time_zone).date()
+            first, last = (
+                first.isoformat(),
+                (first + datetime.timedelta(days=days - 1)).isoformat(),
+            )
+            for low_tide in self.low_tides[slug]:
+                if max_feet is not None and low_tide[0] > max_feet:
+                    # Every later low tide for this place is higher still
+                    return
+                if first <= low_tide[1] <= last:
+                    yield low_tide
+
+        runs = [
+            run(slug)
+            for slug, place in self.places.items()
+            if region is None or place["region"] == region
+        ]
+        # Lazily merges the sorted runs, reading only as far into each as the
+        # top k needs
+        return list(itertools.islice(heapq.merge(*runs), k))
+
+
+# {(path, mtime_ns, size): LowTideIndex} for the database being served
+indexes = {}
+
+
+async def low_tide_index(db):
+    stamp = (db.path, db.mtime_ns, db.size)
+    if stamp not in indexes:
+        rows = []
+        if await db.table_exists("daylight_low_tides"):
+            rows = (await db.execute(LOW_TIDES_SQL)).rows
+        indexes.clear()
+        indexes[stamp] = LowTideIndex(rows)
+    return indexes[stamp]
+
+
+async def best_low_tides_json(datasette, request):
+    try:
+        start = request.args.get("start")
+        start = datetime.date.fromisoformat(start) if start else None
+        days = int(request.args.get("days") or DEFAULT_DAYS)
+        k = int(request.args.get("k") or DEFAULT_RESULTS)
+        max_feet = request.args.get("max_feet")
+        max_feet = float(max_feet) if max_feet else None
+    except ValueError:
+        return Response.json(
+            {"error": "Invalid start, days, k or max_feet"}, status=400
+        )
+    if not 1 <= days <= MAX_DAYS:
+        return Response.json(
+            {"error": "days must be between 1 and {}".format(MAX_DAYS)}, status=400
+        )
+    if not 1 <= k <= MAX_RESULTS:
+        return Response.json(
+            {"error": "k must be between 1 and {}".format(MAX_RESULTS)}, status=400
+        )
+    index = await low_tide_index(datasette.get_database("data"))
+    region = request.args.get("region") or None
+    if region is not None and region not in index.regions():
+        return Response.json({"error": "Region not found"}, status=404)
+    results = [
+        {
+            "place": slug,
+            "name": index.places[slug]["name"],
+            "region": index.places[slug]["region"],
+            "day": day,
+            "time": time,
+            "feet": feet,
+            "url": "/us/{}".format(slug),
+        }
+        for feet, day, time, slug in index.best(k, region, start, days, max_feet)
+    ]
+    return Response.json(
+        {
+            "region": region,
+            "start": start and start.isoformat(),
+            "days": days,
+            "max_feet": max_feet,
+            "results": results,
+        },
+        headers={
+            "cache-control": pm.get_plugin("urls.py").CACHE_CONTROL.decode(),
+        },
+    )
+
+
+@hookimpl
+def register_routes():
+    return ((r"^/best-low-tides\.json$", best_low_tides_json),)
@@ -0,0 +1,204 @@
+from datasette import hookimpl
+from datasette.plugins import pm
+from datasette.utils.asgi import Response
+import heapq
+import math
+
+# Nearest places and good NOAA stations to a point, from KD-trees built once
+# per database. Points are stored as unit vectors, where the straight line
+# (chord) distance between two points orders them the same way as the great
+# circle distance, so the tree can split on plain coordinates.
+
+EARTH_RADIUS_KM = 6371.0088
+# Limits for ?k= on /near
+DEFAULT_NEAR = 5
+MAX_NEAR = 50
+
+
+def unit_vector(latitude, longitude):
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    # items is a list of (latitude, longitude, item). Each node is a tuple of
+    # (point, item, axis, left, right), split on the axis with the widest
+    # spread at the median point.
+    def __init__(self, items):
+        self.root = self.build(
+            [(unit_vector(lat, lon), item) for lat, lon, item in items]
+        )
+
+    def build(self, points):
+        if not points:
+            return None
+        axis = max(
+            range(3),
+            key=lambda a: max(p[0][a] for p in points) - min(p[0][a] for p in points),
+        )
+        points.sort(key=lambda p: p[0][axis])
+        median = len(points) // 2
+        point, item = points[median]
+        return (
+            point,
+            item,
+            axis,
+            self.build(points[:median]),
+            self.build(points[median + 1 :]),
+        )
+
+    def nearest(self, latitude, longitude, k=1):
+        # Returns up to k (km, item) pairs, nearest first
+        target = unit_vector(latitude, longitude)
+        # Max-heap of the k best so far, as (-squared chord, tie breaker, item)
+        best = []
+        counter = 0
+
+        def visit(node):
+            nonlocal counter
+            if node is None:
+                return
+            point, item, axis, left, right = node
+            distance = sum((p - t) ** 2 for p, t in zip(point, target))
+            counter += 1
+            if len(best) < k:
+                heapq.heappush(best, (-distance, counter, item))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, counter, item))
+            difference = target[axis] - point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            visit(near)
+            # Only cross the split if a closer point could be on the far side
+            if len(best) < k or difference**2 < -best[0][0]:
+                visit(far)
+
+        if k > 0:
+            visit(self.root)
+        return [
+            (chord_to_km(math.sqrt(-distance)), item)
+            for distance, _, item in sorted(best, key=lambda b: (-b[0], b[1]))
+        ]
+
+
+class NearbyIndex:
+    def __init__(self, places, stations):
+        # places and stations are dicts with latitude and longitude keys
+        self.places = KDTree(
+            [(p["latitude"], p["longitude"], p) for p in places if has_location(p)]
+        )
+        self.stations = KDTree(
+            [(s["latitude"], s["longitude"], s) for s in stations if has_location(s)]
+        )
+
+
+def has_location(row):
+    return row["latitude"] is not None and row["longitude"] is not None
+
+
+PLACES_SQL = """
+select slug, name, latitude, longitude, station_id, live_on_site from places
+"""
+STATIONS_SQL = """
+select
+  stationId as station_id,
+  geoGroupName as name,
+  lat as latitude,
+  lon as longitude
+from noaa_stations where good = 1
+"""
+
+
+async def nearby_index_rows(db):
+    # (places, stations) rows for a NearbyIndex
+    places = []
+    stations = []
+    if await db.table_exists("places"):
+        places = [dict(row) for row in (await db.execute(PLACES_SQL)).rows]
+    if await db.table_exists("noaa_stations"):
+        columns = set(await db.table_columns("noaa_stations"))
+        if {"stationId", "geoGroupName", "lat", "lon", "good"} <= columns:
+            stations = [dict(row) for row in (await db.execute(STATIONS_SQL)).rows]
+    return places, stations
+
+
+# {(path, mtime_ns, size): NearbyIndex} for the database being served
+indexes = {}
+
+
+async def nearby_index(db):
+    stamp = (db.path, db.mtime_ns, db.size)
+    if stamp not in indexes:
+        places, stations = await nearby_index_rows(db)
+        indexes.clear()
+        indexes[stamp] = NearbyIndex(places, stations)
+    return indexes[stamp]
+
+
+async def near(datasette, request):
+    try:
+        latitude = float(request.args["lat"])
+        longitude = float(request.args["lon"])
+        k = int(request.args.get("k") or DEFAULT_NEAR)
+    except (KeyError, ValueError):
+        return Response.json({"error": "lat and lon are required"}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return Response.json({"error": "lat or lon out of range"}, status=400)
+    if not 1 <= k <= MAX_NEAR:
+        return Response.json(
+            {"error": "k must be between 1 and {}".format(MAX_NEAR)}, status=400
+        )
+    index = await nearby_index(datasette.get_database("data"))
+    return Response.json(
+        {
+            "lat": latitude,
+            "lon": longitude,
+            "places": [
+                {
+                    "slug": place["slug"],
+                    "name": place["name"],
+                    "km": round(km, 3),
+                    "station_id": place["station_id"],
+                    "url": (
+                        "/us/{}".format(place["slug"])
+                        if place["live_on_site"]
+                        else None
+                    ),
+                }
+                for km, place in index.places.nearest(latitude, longitude, k)
+            ],
+            "stations": [
+                {
+                    "station_id": station["station_id"],
+                    "name": station["name"],
+                    "km": round(km, 3),
+                }
+                for km, station in index.stations.nearest(latitude, longitude, k)
+            ],
+        },
+        headers={
+            "cache-control": pm.get_plugin("urls.py").CACHE_CONTROL.decode(),
+        },
+    )
+
+
+@hookimpl
+def startup(datasette):
+    # Builds the index before the first request needs it
+    async def inner():
+        if "data" in datasette.databases:
+            await nearby_index(datasette.get_database("data"))
+
+    return inner
+
+
+@hookimpl
+def register_routes():
+    return ((r"^/near$", near),)
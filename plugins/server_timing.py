@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import itertools
+from datasette import hookimpl
+from datasette.tracer import capture_traces, trace_child_tasks
+from datasette.utils.asgi import Response
+import math
+import time
+
+# Breaks each request down into named sections, sent back in a Server-Timing
+# header and aggregated into histograms served at /-/timings.json. Sections:
+#
+#   total          the whole request, up to the start of the response
+#   functions      time in timed() blocks, e.g. the template functions
+#   render         the template render in place_page
+#   sql            every SQL query, from Datasette's query tracing
+#   other_sql      queries outside timed() blocks, for place pages the
+#                  row view's own queries
+#   jinja          render, less functions and other_sql
+#
+# plus one section per timed() block name. Tracing queries costs around 50us
+# each, so only one request in SQL_SAMPLE_EVERY has the last three.
+
+# Timings for the request being handled, set by the ASGI wrapper
+request_timings = ContextVar("request_timings", default=None)
+# The innermost timed() block, so queries can be attributed to it
+current_section = ContextVar("current_section", default=None)
+
+# Histogram buckets grow by HISTOGRAM_GROWTH from HISTOGRAM_MIN seconds, so
+# percentiles are within 9% of the true value, up to around five minutes
+HISTOGRAM_MIN = 1e-5
+HISTOGRAM_GROWTH = 2 ** (1 / 8)
+HISTOGRAM_BUCKETS = 200
+SQL_SAMPLE_EVERY = 10
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # Bucket b holds HISTOGRAM_MIN * HISTOGRAM_GROWTH ** (b - 1) < s <=
+        # HISTOGRAM_MIN * HISTOGRAM_GROWTH ** b
+        bucket = 0
+        if seconds > HISTOGRAM_MIN:
+            bucket = min(
+                HISTOGRAM_BUCKETS - 1,
+                math.ceil(math.log(seconds / HISTOGRAM_MIN, HISTOGRAM_GROWTH)),
+            )
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        # The upper bound of the bucket holding the pth percentile
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, HISTOGRAM_MIN * HISTOGRAM_GROWTH**bucket)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(1000 * self.total / self.count, 3) if self.count else 0,
+            "p50_ms": round(1000 * self.percentile(50), 3),
+            "p95_ms": round(1000 * self.percentile(95), 3),
+            "p99_ms": round(1000 * self.percentile(99), 3),
+            "max_ms": round(1000 * self.max, 3),
+        }
+
+
+# {section name: Histogram} across every request since startup
+histograms = {}
+requests = itertools.count()
+
+
+class QueryTimes(list):
+    # Stands in for the list Datasette's tracer appends queries to, adding
+    # their durations to timings instead of keeping them
+    def __init__(self, timings):
+        self.timings = timings
+
+    def append(self, trace_info):
+        if trace_info["type"] != "sql":
+            return
+        seconds = trace_info["duration_ms"] / 1000
+        self.timings.add("sql", seconds)
+        if current_section.get() is None:
+            self.timings.add("other_sql", seconds)
+
+
+class Timings:
+    # Seconds spent in each section while handling one request
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sections = {}
+        self.descriptions = {}
+        self.queries = QueryTimes(self)
+
+    def add(self, name, seconds):
+        self.sections[name] = self.sections.get(name, 0.0) + seconds
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def finish(self):
+        self.sections["total"] = time.perf_counter() - self.start
+        if "render" in self.sections and "sql" in self.sections:
+            self.sections["jinja"] = max(
+                0.0,
+                self.sections["render"]
+                - self.sections.get("functions", 0.0)
+                - self.sections.get("other_sql", 0.0),
+            )
+
+    def header(self):
+        metrics = []
+        for name, seconds in self.sections.items():
+            metric = "{};dur={:.2f}".format(name, 1000 * seconds)
+            if name in self.descriptions:
+                metric += ';desc="{}"'.format(self.descriptions[name])
+            metrics.append(metric)
+        for name, description in self.descriptions.items():
+            if name not in self.sections:
+                metrics.append('{};desc="{}"'.format(name, description))
+        return ", ".join(metrics)
+
+
+@contextmanager
+def timed(name):
+    # Adds the time taken by the block to the current request's timings
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    parent = current_section.get()
+    token = current_section.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        current_section.reset(token)
+        timings.add(name, seconds)
+        if parent is None:
+            timings.add("functions", seconds)
+
+
+def record(timings):
+    for name, seconds in timings.sections.items():
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].record(seconds)
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap_with_server_timing(app):
+        async def add_server_timing(scope, receive, send):
+            # Nested requests, like the render in place_page, add to the
+            # timings of the request that made them
+            if scope["type"] != "http" or request_timings.get() is not None:
+                await app(scope, receive, send)
+                return
+            timings = Timings()
+            token = request_timings.set(timings)
+
+            async def send_with_header(event):
+                if event["type"] == "http.response.start":
+                    timings.finish()
+                    headers = list(event.get("headers") or [])
+                    headers.append(
+                        (b"server-timing", timings.header().encode("latin-1"))
+                    )
+                    event = dict(event, headers=headers)
+                await send(event)
+
+            # Datasette's own ?_trace=1 needs the tracer to itself
+            query_string = scope.get("query_string", b"").split(b"&")
+            trace_sql = (
+                next(requests) % SQL_SAMPLE_EVERY == 0
+                and b"_trace=1" not in query_string
+            )
+            try:
+                if not trace_sql:
+                    await app(scope, receive, send_with_header)
+                else:
+                    with capture_traces(timings.queries), trace_child_tasks():
+                        await app(scope, receive, send_with_header)
+            finally:
+                request_timings.reset(token)
+            # Only requests that ran instrumented code, like place pages
+            if timings.descriptions or set(timings.sections) - {
+                "total",
+                "sql",
+                "other_sql",
+            }:
+                record(timings)
+
+        return add_server_timing
+
+    return wrap_with_server_timing
+
+
+async def timings_json(datasette, request):
+    # Only for actors allowed Datasette's debug menu, such as root
+    if not await datasette.permission_allowed(request.actor, "debug-menu"):
+        return Response.json({"error": "Permission denied"}, status=403)
+    return Response.json(
+        {name: histograms[name].summary() for name in sorted(histograms)}
+    )
+
+
+@hookimpl
+def register_routes():
+    return ((r"^/-/timings\.json$", timings_json),)
@@ -1,57 +1,87 @@
 from astral import LocationInfo, sun
 from datasette import hookimpl
+from datasette.plugins import pm
+import contextlib
 import datetime
+import functools
 import json
+import numpy
 import pytz
 
-TIDE_TIMES_SQL = """
-with previous_day_last_record as (
-  select
-    station_id,
-    datetime,
-    mllw_feet
-  from
-    tide_predictions
-  where
-    date("datetime") = date(:day, '-1 days')
-    and "station_id" = :station_id
-  order by
-    datetime desc
-  limit
-    1
-), next_day_first_record as (
-  select
-    station_id,
-    datetime,
-    mllw_feet
-  from
-    tide_predictions
-  where
-    date("datetime") = date(:day, '1 days')
-    and "station_id" = :station_id
-  order by
-    datetime
-  limit
-    1
-)
-select * from previous_day_last_record
-  union
-select * from next_day_first_record
-  union
+TIDE_WINDOW_SQL = """
 select
-  station_id,
-  datetime,
-  mllw_feet
+  minute,
+  mllw_mft
 from
-  tide_predictions
+  tide_heights
 where
-  date("datetime") = :day
-  and "station_id" = :station_id
+  station_id = :station_id
+  and minute >= :start
+  and minute < :end
 order by
-  station_id,
-  datetime
+  minute
+"""
+
+TIDE_DAYS_SQL = """
+select
+  day,
+  heights
+from
+  tide_days
+where
+  station_id = :station_id
+  and day >= :start
+  and day <= :end
+"""
+
+SUMMARY_WINDOW_SQL = """
+select
+  *
+from
+  daily_tide_summary
+where
+  place = :place
+  and day >= :start
+  and day <= :end
+"""
+
+SUN_WINDOW_SQL = """
+select
+  *
+from
+  sunrise_sunset
+where
+  place = :place
+  and day >= :start
+  and day <= :end
 """
 
+# Written by build_place_cards.py, already in display order
+PLACE_CARDS_SQL = """
+select * from [{}] where place = :place order by rank
+"""
+# Columns in daily_tide_summary that hold JSON-encoded tide info
+SUMMARY_JSON_COLUMNS = (
+    "minimas",
+    "maximas",
+    "lowest_daylight_minima",
+    "lowest_tide",
+    "heights",
+)
+SUN_PHASES = ("dawn", "sunrise", "noon", "sunset", "dusk")
+# tide_heights stores times as wall clock minutes since 1970-01-01 00:00 in
+# the station's local time, and heights as integer thousandths of a foot
+HEIGHT_SCALE = 1000
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# tide_days packs a complete day of 6 minute heights from tide_heights into
+# a blob of little-endian int16s, keyed by day number since 1970-01-01
+TIDE_DAY_INTERVAL = 6
+TIDE_DAY_SLOTS = 1440 // TIDE_DAY_INTERVAL
+TIDE_DAY_DTYPE = numpy.dtype("<i2")
+# Largest vertical error allowed when simplifying tide curves, in SVG viewBox
+# units - the 104 unit high viewBox is drawn 60px tall, so about 0.3px
+SVG_TOLERANCE = 0.5
+
 
 @hookimpl
 def extra_template_vars(datasette):
@@ -82,112 +112,158 @@ def extra_template_vars(datasette):
         }
 
     async def get_tide_data_for_next_30_days(place_slug):
-        days = []
-        for day in next_30_days():
-            tide_data = await tide_data_for_place(place_slug, day)
-            days.append((day, tide_data))
-        return days
+        return await tide_data_for_days(datasette, place_slug, next_30_days())
 
-    async def tide_data_for_place(place_slug, day=None):
+    async def place_cards(table, place_slug):
         db = datasette.get_database("data")
-        place = (
-            await db.execute(
-                "select * from places where slug = :place_slug",
-                {"place_slug": place_slug},
-            )
-        ).first()
+        if not await db.table_exists(table):
+            return []
+        results = await db.execute(PLACE_CARDS_SQL.format(table), {"place": place_slug})
+        return [dict(row) for row in results]
+
+    async def species_cards(place_slug):
+        return await place_cards("species_cards", place_slug)
+
+    async def observation_cards(place_slug):
+        return await place_cards("observation_cards", place_slug)
+
+    async def tide_data_for_place(place_slug, day=None):
+        place = await get_place(datasette, place_slug)
         # Use the timezone to figure out today
         if day is None:
             day = datetime.datetime.now(pytz.timezone(place["time_zone"])).date()
-        station_id = place["station_id"]
+        results = await tide_data_for_days(datasette, place_slug, [day], place=place)
+        return results[0][1]
+
+    return {
+        "calculate_best_times": timed_function(calculate_best_times),
+        "tide_data_for_place": timed_function(tide_data_for_place),
+        "get_tide_data_for_next_30_days": timed_function(
+            get_tide_data_for_next_30_days
+        ),
+        "tide_data_for_days": timed_function(
+            functools.partial(tide_data_for_days, datasette), "tide_data_for_days"
+        ),
+        "species_cards": timed_function(species_cards),
+        "observation_cards": timed_function(observation_cards),
+        "ordinal": ordinal,
+        "calculate_depth_view": calculate_depth_view,
+        "nice_time": nice_time,
+        "json": json,
+    }
+
+
+async def get_place(datasette, place_slug):
+    db = datasette.get_database("data")
+    return (
+        await db.execute(
+            "select * from places where slug = :place_slug",
+            {"place_slug": place_slug},
+        )
+    ).first()
+
+
+async def tide_data_for_days(datasette, place_slug, days, place=None):
+    # [(day, tide info)] for days at the place, from the tables the build
+    # precomputes where it can
+    days = list(days)
+    if not days:
+        return []
+    if place is None:
+        place = await get_place(datasette, place_slug)
+    db = datasette.get_database("data")
+    # Precomputed by calculate_daily_tide_summary.py at build time
+    tide_data_by_day = {}
+    if await db.table_exists("daily_tide_summary"):
         results = await db.execute(
-            TIDE_TIMES_SQL,
+            SUMMARY_WINDOW_SQL,
             {
-                "station_id": station_id,
-                "day": day.isoformat(),
+                "place": place["slug"],
+                "start": min(days).isoformat(),
+                "end": max(days).isoformat(),
             },
         )
-        tide_times = list(dict(r) for r in results)
-        heights = [
-            {
-                "time": tide_time["datetime"].split()[-1],
-                "time_pct": round(
-                    100 * time_to_float(tide_time["datetime"].split()[-1]), 2
-                ),
-                "feet": tide_time["mllw_feet"],
-            }
-            for tide_time in tide_times
-        ]
-        if len(heights) < 3:
-            return None
-        minimas, maximas = get_minimas_maximas(heights)
-        location_info = LocationInfo(
-            place["address"],
-            "",
-            place["time_zone"],
-            place["latitude"],
-            place["longitude"],
-        )
-        tz = pytz.timezone(place["time_zone"])
-        astral_info = sun.sun(location_info.observer, date=day)
-        # Calculate SVG points, refs https://github.com/natbat/rockybeaches/issues/31
-        min_feet = min(h["feet"] for h in heights[1:-1])
-        max_feet = max(h["feet"] for h in heights[1:-1])
-        feet_delta = max_feet - min_feet
-        svg_points = []
-        for i, height in enumerate(heights[1:-1]):
-            ratio = (height["feet"] - min_feet) / feet_delta
-            line_height_pct = 100 - (ratio * 100)
-            svg_points.append((i, line_height_pct))
-        # Figure out the lowest minima that's during daylight
-        sunrise = (
-            astral_info["sunrise"].astimezone(tz).time().isoformat(timespec="minutes")
-        )
-        sunset = (
-            astral_info["sunset"].astimezone(tz).time().isoformat(timespec="minutes")
-        )
-        daytime_minimas = [m for m in minimas if sunrise <= m["time"] <= sunset]
-        if daytime_minimas:
-            lowest_daylight_minima = sorted(daytime_minimas, key=lambda m: m["feet"])[0]
-        else:
-            lowest_daylight_minima = None
-        info = {
-            "minimas": minimas,
-            "maximas": maximas,
-            "lowest_daylight_minima": lowest_daylight_minima,
-            "heights": heights[1:-1],
-            "lowest_tide": list(sorted(heights[1:-1], key=lambda t: t["feet"]))[0],
-            "svg_points": " ".join("{},{:.2f}".format(i, pct) for i, pct in svg_points),
+        tide_data_by_day = {
+            datetime.date.fromisoformat(row["day"]): tide_info_from_summary_row(row)
+            for row in results
         }
-        info.update(
-            {
-                key: value.astimezone(tz).time().isoformat(timespec="seconds")
-                for key, value in astral_info.items()
+    missing_days = [day for day in days if day not in tide_data_by_day]
+    if missing_days:
+        window = {
+            "station_id": place["station_id"],
+            "place": place["slug"],
+            "start": min(missing_days).isoformat(),
+            "end": max(missing_days).isoformat(),
+        }
+        # Precomputed by calculate_sunrise_sunset.py at build time
+        sun_info_by_day = {}
+        if await db.table_exists("sunrise_sunset"):
+            results = await db.execute(SUN_WINDOW_SQL, window)
+            sun_info_by_day = {
+                datetime.date.fromisoformat(row["day"]): dict(row) for row in results
             }
-        )
-        info.update(
-            {
-                "{}_pct".format(key): round(
-                    100
-                    * time_to_float(
-                        value.astimezone(tz).time().isoformat(timespec="seconds")
-                    ),
-                    2,
+        # The day before the first day through the day after the last one,
+        # from packed tide_days blobs where the build wrote them
+        first_day = min(missing_days) - datetime.timedelta(days=1)
+        last_day = max(missing_days) + datetime.timedelta(days=1)
+        tide_times_by_day = {}
+        if await db.table_exists("tide_days"):
+            results = await db.execute(
+                TIDE_DAYS_SQL,
+                dict(
+                    window,
+                    start=day_number(first_day),
+                    end=day_number(last_day),
+                ),
+            )
+            for row in results:
+                day = datetime.date.fromordinal(EPOCH_ORDINAL + row["day"])
+                tide_times_by_day[day] = tide_times_from_packed_day(
+                    row["day"], row["heights"]
                 )
-                for key, value in astral_info.items()
-            }
-        )
-        return info
+        row_days = [
+            first_day + datetime.timedelta(days=i)
+            for i in range((last_day - first_day).days + 1)
+            if first_day + datetime.timedelta(days=i) not in tide_times_by_day
+        ]
+        if row_days:
+            # One range query on the (station_id, minute) primary key
+            results = await db.execute(
+                TIDE_WINDOW_SQL,
+                dict(
+                    window,
+                    start=day_to_minute(min(row_days)),
+                    end=day_to_minute(max(row_days)) + 1440,
+                ),
+            )
+            for day, arrays in split_tide_times_by_day(tide_arrays(results)).items():
+                tide_times_by_day.setdefault(day, arrays)
+        with timed("tide_info"):
+            for day in missing_days:
+                tide_data_by_day[day] = calculate_tide_info(
+                    place,
+                    day,
+                    tide_times_for_day(tide_times_by_day, day),
+                    sun_info=sun_info_by_day.get(day),
+                )
+    return [(day, tide_data_by_day[day]) for day in days]
 
-    return {
-        "calculate_best_times": calculate_best_times,
-        "tide_data_for_place": tide_data_for_place,
-        "get_tide_data_for_next_30_days": get_tide_data_for_next_30_days,
-        "ordinal": ordinal,
-        "calculate_depth_view": calculate_depth_view,
-        "nice_time": nice_time,
-        "json": json,
-    }
+
+def timed(name):
+    # Adds the time taken by a block to the Server-Timing header of the
+    # request being handled, see server_timing.py
+    server_timing = pm.get_plugin("server_timing.py")
+    if server_timing is None:
+        return contextlib.nullcontext()
+    return server_timing.timed(name)
+
+
+def timed_function(fn, name=None):
+    async def timed_fn(*args, **kwargs):
+        with timed(name or fn.__name__):
+            return await fn(*args, **kwargs)
+
+    return timed_fn
 
 
 def next_30_days():
@@ -196,27 +272,254 @@ def next_30_days():
         yield today + datetime.timedelta(days=i)
 
 
+def day_number(day):
+    return day.toordinal() - EPOCH_ORDINAL
+
+
+def day_to_minute(day):
+    return day_number(day) * 1440
+
+
+def datetime_to_minute(value):
+    # "YYYY-MM-DD HH:MM" as used by NOAA to a tide_heights minute
+    day = datetime.date.fromisoformat(value[:10])
+    return day_to_minute(day) + int(value[11:13]) * 60 + int(value[14:16])
+
+
+def tide_arrays(tide_times):
+    # (minutes, mllw_mft) arrays for tide_heights rows
+    tide_times = list(tide_times)
+    return (
+        numpy.fromiter((t["minute"] for t in tide_times), dtype=numpy.int64),
+        numpy.fromiter((t["mllw_mft"] for t in tide_times), dtype=numpy.int64),
+    )
+
+
+def split_tide_times_by_day(tide_times):
+    # tide_times is a (minutes, mllw_mft) pair of arrays ordered by minute -
+    # returns {date: (minutes, mllw_mft) for that day}, sharing their memory
+    minutes, heights = tide_times
+    starts = numpy.flatnonzero(numpy.r_[True, numpy.diff(minutes // 1440) != 0])
+    ends = numpy.r_[starts[1:], len(minutes)]
+    return {
+        datetime.date.fromordinal(EPOCH_ORDINAL + int(minutes[start]) // 1440): (
+            minutes[start:end],
+            heights[start:end],
+        )
+        for start, end in zip(starts.tolist(), ends.tolist())
+        if start < end
+    }
+
+
+def pack_tide_day(day_number, tide_times):
+    # A tide_days blob for tide_times, rows for a single day ordered by
+    # minute, or None if they are not a complete day at the 6 minute cadence
+    # or a height does not fit in an int16
+    minutes = numpy.fromiter((t["minute"] for t in tide_times), dtype=numpy.int64)
+    expected = day_number * 1440 + TIDE_DAY_INTERVAL * numpy.arange(TIDE_DAY_SLOTS)
+    if len(minutes) != TIDE_DAY_SLOTS or (minutes != expected).any():
+        return None
+    heights = numpy.fromiter((t["mllw_mft"] for t in tide_times), dtype=numpy.int64)
+    limits = numpy.iinfo(TIDE_DAY_DTYPE)
+    if heights.min() < limits.min or heights.max() > limits.max:
+        return None
+    return heights.astype(TIDE_DAY_DTYPE).tobytes()
+
+
+def unpack_tide_day(blob):
+    # Read-only array of mllw_mft heights, sharing memory with blob
+    return numpy.frombuffer(blob, dtype=TIDE_DAY_DTYPE)
+
+
+def tide_times_from_packed_day(day_number, blob):
+    # (minutes, mllw_mft) arrays for a tide_days blob
+    minutes = day_number * 1440 + TIDE_DAY_INTERVAL * numpy.arange(
+        TIDE_DAY_SLOTS, dtype=numpy.int64
+    )
+    return minutes, unpack_tide_day(blob)
+
+
+def tide_times_for_day(tide_times_by_day, day):
+    # The (minutes, mllw_mft) arrays for day, plus the last prediction of the
+    # previous day and the first of the next day so minimas/maximas at the
+    # edges can be detected
+    empty = numpy.array([], dtype=numpy.int64)
+    previous_day = tide_times_by_day.get(day - datetime.timedelta(days=1))
+    today = tide_times_by_day.get(day, (empty, empty))
+    next_day = tide_times_by_day.get(day + datetime.timedelta(days=1))
+    return tuple(
+        numpy.concatenate(
+            [
+                previous_day[i][-1:] if previous_day else empty,
+                today[i],
+                next_day[i][:1] if next_day else empty,
+            ]
+        )
+        for i in range(2)
+    )
+
+
+def calculate_tide_info(
+    place, day, tide_times, extrema=None, sun_info=None, svg_tolerance=SVG_TOLERANCE
+):
+    # tide_times is a (minutes, mllw_mft) pair of arrays, see
+    # tide_times_for_day(). extrema is an optional pre-calculated
+    # (minima_indexes, maxima_indexes) pair of positions within them, see
+    # find_extrema(). sun_info is an optional sunrise_sunset row, calculated
+    # with astral if not provided.
+    minutes, mllw_mft = tide_times
+    if len(minutes) < 3:
+        return None
+    minutes_of_day = (minutes % 1440).tolist()
+    feet = mllw_mft / HEIGHT_SCALE
+
+    # Dicts are only built for the heights that end up in the tide info
+    def height(i):
+        return {
+            "time": "{:02d}:{:02d}".format(*divmod(minutes_of_day[i], 60)),
+            "time_pct": round(100 * minutes_of_day[i] / 1440, 2),
+            "feet": float(feet[i]),
+        }
+
+    if extrema is None:
+        extrema = find_extrema(feet)
+    minimas = [height(i) for i in extrema[0]]
+    maximas = [height(i) for i in extrema[1]]
+    heights = [height(i) for i in range(1, len(minutes) - 1)]
+    if sun_info is None:
+        with timed("astral"):
+            sun_info = calculate_sun_info(place, day)
+    # Calculate SVG points, refs https://github.com/natbat/rockybeaches/issues/31
+    min_feet = feet[1:-1].min()
+    max_feet = feet[1:-1].max()
+    # A day with a single prediction would otherwise divide by zero
+    feet_delta = (max_feet - min_feet) or 1
+    line_height_pcts = 100 - 100 * (feet[1:-1] - min_feet) / feet_delta
+    # Drop points on smooth stretches, keeping the minimas and maximas, which
+    # are offset by one as the curve starts at heights[1]
+    keep = numpy.r_[extrema[0], extrema[1]] - 1
+    svg_points = [
+        (i, line_height_pcts[i])
+        for i in simplify_curve(line_height_pcts, svg_tolerance, keep).tolist()
+    ]
+    # Figure out the lowest minima that's during daylight - compare HH:MM
+    sunrise = sun_info["sunrise"][:5]
+    sunset = sun_info["sunset"][:5]
+    daytime_minimas = [m for m in minimas if sunrise <= m["time"] <= sunset]
+    if daytime_minimas:
+        lowest_daylight_minima = sorted(daytime_minimas, key=lambda m: m["feet"])[0]
+    else:
+        lowest_daylight_minima = None
+    info = {
+        "minimas": minimas,
+        "maximas": maximas,
+        "lowest_daylight_minima": lowest_daylight_minima,
+        "heights": heights,
+        "lowest_tide": heights[int(feet[1:-1].argmin())],
+        "svg_points": " ".join("{},{:.2f}".format(i, pct) for i, pct in svg_points),
+    }
+    for key in SUN_PHASES:
+        info[key] = sun_info[key]
+        info["{}_pct".format(key)] = sun_info["{}_pct".format(key)]
+    return info
+
+
+def calculate_sun_info(place, day):
+    location_info = LocationInfo(
+        place["address"],
+        "",
+        place["time_zone"],
+        place["latitude"],
+        place["longitude"],
+    )
+    tz = pytz.timezone(place["time_zone"])
+    sun_info = {}
+    for key, value in sun.sun(location_info.observer, date=day).items():
+        time = value.astimezone(tz).time().isoformat(timespec="seconds")
+        sun_info[key] = time
+        sun_info["{}_pct".format(key)] = round(100 * time_to_float(time), 2)
+    return sun_info
+
+
+def summary_row_from_tide_info(place_slug, day, info):
+    row = {"place": place_slug, "day": day.isoformat()}
+    row.update({key: json.dumps(info[key]) for key in SUMMARY_JSON_COLUMNS})
+    row["svg_points"] = info["svg_points"]
+    for key in SUN_PHASES:
+        row[key] = info[key]
+        row["{}_pct".format(key)] = info["{}_pct".format(key)]
+    return row
+
+
+def tide_info_from_summary_row(row):
+    info = {key: json.loads(row[key]) for key in SUMMARY_JSON_COLUMNS}
+    info["svg_points"] = row["svg_points"]
+    for key in SUN_PHASES:
+        info[key] = row[key]
+        info["{}_pct".format(key)] = row["{}_pct".format(key)]
+    return info
+
+
 def get_minimas_maximas(tide_times):
-    minimas = []
-    maximas = []
-    for i, row in enumerate(tide_times):
-        try:
-            previous = tide_times[i - 1]
-        except IndexError:
-            continue
-        try:
-            current = tide_times[i]
-            offset_to_change = 1
-            while current["feet"] == tide_times[i + offset_to_change]["feet"]:
-                offset_to_change += 1
-            next_ = tide_times[i + offset_to_change]
-        except IndexError:
+    minima_indexes, maxima_indexes = find_extrema([t["feet"] for t in tide_times])
+    return (
+        [tide_times[i] for i in minima_indexes],
+        [tide_times[i] for i in maxima_indexes],
+    )
+
+
+def find_extrema(feet):
+    # Returns (minima_indexes, maxima_indexes) as sorted arrays of positions
+    # in feet. The first and last values are never reported, and a plateau
+    # of equal values is reported at its first position.
+    feet = numpy.asarray(feet, dtype=float)
+    if len(feet) < 3:
+        empty = numpy.array([], dtype=numpy.intp)
+        return empty, empty
+    # Collapse runs of equal values, then compare each run with its neighbours
+    run_starts = numpy.flatnonzero(numpy.r_[True, feet[1:] != feet[:-1]])
+    values = feet[run_starts]
+    previous, current, next_ = values[:-2], values[1:-1], values[2:]
+    inner_starts = run_starts[1:-1]
+    return (
+        inner_starts[(previous > current) & (current < next_)],
+        inner_starts[(previous < current) & (current > next_)],
+    )
+
+
+def simplify_curve(ys, tolerance, keep=()):
+    # Ramer-Douglas-Peucker simplification of the curve through (i, ys[i]),
+    # measuring error vertically. Returns a sorted array of the indexes to
+    # keep: the ends, everything in keep and enough other points that
+    # straight lines between them stay within tolerance of every point.
+    ys = numpy.asarray(ys, dtype=float)
+    if len(ys) < 3:
+        return numpy.arange(len(ys))
+    kept = numpy.zeros(len(ys), dtype=bool)
+    kept[[0, -1]] = True
+    kept[numpy.asarray(keep, dtype=numpy.intp)] = True
+    anchors = numpy.flatnonzero(kept)
+    segments = list(zip(anchors[:-1], anchors[1:]))
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
             continue
-        if previous["feet"] < row["feet"] > next_["feet"]:
-            maximas.append(row)
-        if previous["feet"] > row["feet"] < next_["feet"]:
-            minimas.append(row)
-    return minimas, maximas
+        between = numpy.arange(start + 1, end)
+        line = ys[start] + (ys[end] - ys[start]) * (between - start) / (end - start)
+        deviations = numpy.abs(ys[start + 1 : end] - line)
+        worst = deviations.argmax()
+        if deviations[worst] > tolerance:
+            middle = start + 1 + worst
+            kept[middle] = True
+            segments.extend([(start, middle), (middle, end)])
+    return numpy.flatnonzero(kept)
+
+
+def indexes_in_range(indexes, start, end):
+    # Slice a sorted array of indexes returned by find_extrema to [start, end)
+    return indexes[
+        numpy.searchsorted(indexes, start) : numpy.searchsorted(indexes, end)
+    ]
 
 
 def time_to_float(s):
@@ -1,20 +1,329 @@
+from collections import OrderedDict
 from datasette import hookimpl
+from datasette.plugins import pm
 from datasette.utils.asgi import Response
+import datetime
+import gzip
+import hashlib
+import json
+import pathlib
+import pytz
+import time
+
+CACHE_CONTROL = b"max-age=0, s-maxage=600"
+# Compressed variants written by prerender_places.py, by content-encoding
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+# Limits for ?days= on tides.json
+DEFAULT_TIDE_DAYS = 30
+MAX_TIDE_DAYS = 60
+
+
+class PageCache:
+    # Least recently used cache of rendered pages, holding at most max_size
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.pages = OrderedDict()
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+
+
+# Rendered /us/<slug> pages, keyed by (slug, place's local date, database stamp)
+page_cache = PageCache()
+
+
+# {(path, mtime_ns, size): sha256} and {manifest path: (mtime_ns, manifest)}
+database_hashes = {}
+manifests = {}
+
+
+def database_hash(path):
+    # Identifies the database that pages were rendered from
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def current_database_hash(db):
+    # Immutable databases are hashed by Datasette on startup
+    if db.hash:
+        return db.hash
+    stamp = (db.path, db.mtime_ns, db.size)
+    if stamp not in database_hashes:
+        database_hashes[stamp] = database_hash(db.path)
+    return database_hashes[stamp]
+
+
+def load_manifest(directory):
+    path = directory / "manifest.json"
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if manifests.get(path, (None,))[0] != mtime_ns:
+        manifests[path] = (mtime_ns, json.loads(path.read_text()))
+    return manifests[path][1]
+
+
+def prerendered_page(datasette, db, slug, today):
+    # The manifest entry for slug from the directory mounted at /prerendered,
+    # if it was rendered today from the database being served
+    directory = dict(datasette.static_mounts).get("prerendered")
+    if directory is None:
+        return None
+    directory = pathlib.Path(directory)
+    manifest = load_manifest(directory)
+    if manifest is None:
+        return None
+    page = manifest["pages"].get(slug)
+    if page is None or page["day"] != today.isoformat():
+        return None
+    if manifest["database"] != current_database_hash(db):
+        return None
+    return dict(page, directory=directory)
+
+
+def accepted_encodings(accept_encoding):
+    # Encodings listed in an Accept-Encoding header, except any with q=0
+    encodings = set()
+    for part in accept_encoding.lower().split(","):
+        encoding, _, params = part.partition(";")
+        q = params.strip().partition("q=")[2]
+        try:
+            if q and float(q) == 0:
+                continue
+        except ValueError:
+            pass
+        encodings.add(encoding.strip())
+    return encodings
+
+
+async def send_prerendered(request, send, page):
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next(
+        (e for e in ("br", "gzip") if e in accepted and e in page["files"]),
+        "identity",
+    )
+    etags = {
+        e: '"{}"'.format(page["sha256"][:32] + ("" if e == "identity" else "-" + e))
+        for e in page["files"]
+    }
+    etag = etags[encoding]
+    headers = [
+        (b"cache-control", CACHE_CONTROL),
+        (b"etag", etag.encode("latin-1")),
+        (b"vary", b"accept-encoding"),
+    ]
+    if any(
+        etag_matches(request.headers.get("if-none-match", ""), e)
+        for e in etags.values()
+    ):
+        await send_page(send, 304, headers)
+        return
+    headers.append((b"content-type", b"text/html; charset=utf-8"))
+    if encoding != "identity":
+        headers.append((b"content-encoding", encoding.encode("latin-1")))
+    body = (page["directory"] / page["files"][encoding]).read_bytes()
+    await send_page(send, 200, headers, body)
+
+
+def etag_matches(if_none_match, etag):
+    return any(
+        candidate.strip() in (etag, "*") for candidate in if_none_match.split(",")
+    )
+
+
+async def render(app, scope, receive):
+    # Runs the request through app, returning (status, headers, body)
+    events = []
+
+    async def capture(event):
+        events.append(event)
+
+    await app(scope, receive, capture)
+    start = events[0]
+    body = b"".join(e.get("body", b"") for e in events[1:])
+    return start["status"], list(start.get("headers") or []), body
+
+
+async def send_page(send, status, headers, body=b""):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def shared_page(request):
+    # Whether the response can be shared with other requests for the page:
+    # a query string can change what Datasette renders, and its pages vary
+    # on Cookie and Authorization
+    return not (
+        request.scope.get("query_string")
+        or request.actor
+        or request.headers.get("cookie")
+        or request.headers.get("authorization")
+    )
+
+
+def request_timings():
+    # The Server-Timing breakdown for the request being handled, if any
+    server_timing = pm.get_plugin("server_timing.py")
+    return server_timing and server_timing.request_timings.get()
 
 
 async def place_page(datasette, request, scope, send, receive):
     slug = request.url_vars["slug"]
     internal_path = "/data/places/{}".format(slug)
     new_scope = dict(scope, path=internal_path, raw_path=internal_path.encode("utf-8"))
+    db = datasette.get_database("data")
+    place = (
+        await db.execute(
+            "select time_zone from places where slug = :slug", {"slug": slug}
+        )
+    ).first()
+    timings = request_timings()
+    key = None
+    page = None
+    if place is not None and shared_page(request):
+        # A new day or a rebuilt database both mean a fresh render
+        today = datetime.datetime.now(pytz.timezone(place["time_zone"])).date()
+        prerendered = prerendered_page(datasette, db, slug, today)
+        if prerendered is not None:
+            if timings:
+                timings.describe("cache", "prerendered")
+            await send_prerendered(request, send, prerendered)
+            return
+        key = (slug, today, (db.path, db.mtime_ns, db.size))
+        page = page_cache.get(key)
+    if timings:
+        timings.describe("cache", "miss" if page is None else "hit")
+    if page is None:
+        start = time.perf_counter()
+        status, headers, body = await render(datasette.app(), new_scope, receive)
+        if timings:
+            timings.add("render", time.perf_counter() - start)
+        headers = [(k, v) for k, v in headers if k.lower() != b"cache-control"]
+        headers.append((b"cache-control", CACHE_CONTROL))
+        if status != 200 or key is None:
+            await send_page(send, status, headers, body)
+            return
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        headers.append((b"etag", etag.encode("latin-1")))
+        page = (etag, headers, body)
+        page_cache.put(key, page)
+    etag, headers, body = page
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        await send_page(
+            send,
+            304,
+            [(b"etag", etag.encode("latin-1")), (b"cache-control", CACHE_CONTROL)],
+        )
+    else:
+        await send_page(send, 200, headers, body)
+
+
+def tides_json_data(place, start, results):
+    # Columnar tide heights for the days in results, a list of (day, info)
+    # from tide_data_for_days. minutes are wall clock minutes since midnight
+    # at the start of the first day, and heights are integers in units of
+    # 1/HEIGHT_SCALE feet, the same as in tide_heights.
+    height_scale = pm.get_plugin("template_vars.py").HEIGHT_SCALE
+    minutes = []
+    heights = []
+    days = []
+    for i, (day, info) in enumerate(results):
+        if info is None:
+            days.append({"day": day.isoformat()})
+            continue
+        for height in info["heights"]:
+            hh, mm = height["time"].split(":")
+            minutes.append(i * 1440 + int(hh) * 60 + int(mm))
+            heights.append(round(height["feet"] * height_scale))
+        day_info = {"day": day.isoformat()}
+        for key in ("minimas", "maximas"):
+            day_info[key] = [{"time": m["time"], "feet": m["feet"]} for m in info[key]]
+        lowest = info["lowest_daylight_minima"]
+        day_info["lowest_daylight_minima"] = lowest and {
+            "time": lowest["time"],
+            "feet": lowest["feet"],
+        }
+        for key in ("dawn", "sunrise", "noon", "sunset", "dusk"):
+            day_info[key] = info[key]
+        days.append(day_info)
+    return {
+        "place": place["slug"],
+        "station_id": place["station_id"],
+        "time_zone": place["time_zone"],
+        "start": start.isoformat(),
+        "height_scale": height_scale,
+        "minutes": minutes,
+        "heights": heights,
+        "days": days,
+    }
 
-    async def send_with_cache_control(event):
-        if event["type"] == "http.response.start":
-            headers = dict(event["headers"])
-            headers[b"cache-control"] = b"max-age=0, s-maxage=600"
-            event["headers"] = list(headers.items())
-        await send(event)
 
-    await datasette.app()(new_scope, receive, send_with_cache_control)
+async def tides_json(datasette, request):
+    slug = request.url_vars["slug"]
+    try:
+        days = int(request.args.get("days") or DEFAULT_TIDE_DAYS)
+        start = request.args.get("start")
+        start = datetime.date.fromisoformat(start) if start else None
+    except ValueError:
+        return Response.json({"error": "Invalid days or start"}, status=400)
+    if not 1 <= days <= MAX_TIDE_DAYS:
+        return Response.json(
+            {"error": "days must be between 1 and {}".format(MAX_TIDE_DAYS)},
+            status=400,
+        )
+    db = datasette.get_database("data")
+    place = (
+        await db.execute("select * from places where slug = :slug", {"slug": slug})
+    ).first()
+    if place is None:
+        return Response.json({"error": "Place not found"}, status=404)
+    if start is None:
+        start = datetime.datetime.now(pytz.timezone(place["time_zone"])).date()
+    template_vars = pm.get_plugin("template_vars.py")
+    with template_vars.timed("tide_data_for_days"):
+        results = await template_vars.tide_data_for_days(
+            datasette,
+            slug,
+            [start + datetime.timedelta(days=i) for i in range(days)],
+            place=place,
+        )
+    body = json.dumps(
+        tides_json_data(place, start, results), separators=(",", ":")
+    ).encode("utf-8")
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    use_gzip = "gzip" in accepted_encodings(request.headers.get("accept-encoding", ""))
+    headers = {
+        "cache-control": CACHE_CONTROL.decode(),
+        "vary": "accept-encoding",
+        "etag": '"{}{}"'.format(digest, "-gzip" if use_gzip else ""),
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if any(
+        etag_matches(if_none_match, etag)
+        for etag in ('"{}"'.format(digest), '"{}-gzip"'.format(digest))
+    ):
+        return Response("", status=304, headers=headers)
+    if use_gzip:
+        body = gzip.compress(body, mtime=0)
+        headers["content-encoding"] = "gzip"
+    return Response(
+        body,
+        headers=headers,
+        content_type="application/json; charset=utf-8",
+    )
 
 
 @hookimpl
@@ -24,4 +333,5 @@ def register_routes():
         (r"^/$", lambda: Response.redirect("/us/pillar-point")),
         # country/slug - US only for the moment
         (r"^/us/(?P<slug>[^/]+)$", place_page),
+        (r"^/us/(?P<slug>[^/]+)/tides\.json$", tides_json),
     )
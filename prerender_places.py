@@ -0,0 +1,77 @@
+from datasette.app import Datasette
+import asyncio
+import brotli
+import click
+import datetime
+import gzip
+import hashlib
+import httpx
+import json
+import pathlib
+import pytz
+import yaml
+from plugins.urls import ENCODINGS, database_hash
+
+
+def write_page(output_dir, slug, html):
+    # Writes us/<slug>.html plus compressed variants, returning manifest info
+    path = pathlib.Path(output_dir) / "us" / "{}.html".format(slug)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(html)
+    files = {"identity": str(path.relative_to(output_dir))}
+    variants = {"gzip": gzip.compress(html, mtime=0), "br": brotli.compress(html)}
+    for encoding, content in variants.items():
+        variant_path = path.with_name(path.name + ENCODINGS[encoding])
+        variant_path.write_bytes(content)
+        files[encoding] = str(variant_path.relative_to(output_dir))
+    return {"sha256": hashlib.sha256(html).hexdigest(), "files": files}
+
+
+async def prerender(datasette, output_dir, database_path):
+    # Renders the page for every live place through datasette, in process,
+    # and writes them to output_dir along with a manifest.json
+    db = datasette.get_database("data")
+    places = (
+        await db.execute("select slug, time_zone from places where live_on_site = 1")
+    ).rows
+    manifest = {"database": database_hash(database_path), "pages": {}}
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=datasette.app())
+    ) as client:
+        for place in places:
+            day = datetime.datetime.now(pytz.timezone(place["time_zone"])).date()
+            response = await client.get(
+                "http://localhost/data/places/{}".format(place["slug"])
+            )
+            response.raise_for_status()
+            page = write_page(output_dir, place["slug"], response.content)
+            page["day"] = day.isoformat()
+            manifest["pages"][place["slug"]] = page
+    manifest_path = pathlib.Path(output_dir) / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def site_datasette(db_path, root="."):
+    # Configured the same way as the datasette publish in deploy.yml
+    root = pathlib.Path(root)
+    return Datasette(
+        [db_path],
+        metadata=yaml.safe_load(open(root / "metadata.yml")),
+        template_dir=str(root / "templates"),
+        plugins_dir=str(root / "plugins"),
+        static_mounts=[("static", str(root / "static"))],
+        settings={"max_returned_rows": 4000},
+    )
+
+
+@click.command()
+@click.argument("db_path", type=click.Path(dir_okay=False, exists=True))
+@click.argument("output_dir", type=click.Path(file_okay=False))
+def cli(db_path, output_dir):
+    "Render the page for every live place to static files"
+    asyncio.run(prerender(site_datasette(db_path), output_dir, db_path))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,37 @@
+from plugins.nearby import KDTree
+import sqlite_utils
+import sys
+
+# A build check: lists places without a station_id, each with the nearest
+# good NOAA station to use for it
+
+
+def suggest_stations(db):
+    # Yields (place, km, station) for each place missing a station_id
+    if "good" not in db["noaa_stations"].columns_dict:
+        return
+    stations = KDTree(
+        [
+            (row["lat"], row["lon"], row)
+            for row in db["noaa_stations"].rows_where(
+                "good = 1 and lat is not null and lon is not null"
+            )
+        ]
+    )
+    for place in db["places"].rows_where(
+        "station_id is null and latitude is not null", order_by="slug"
+    ):
+        for km, station in stations.nearest(place["latitude"], place["longitude"]):
+            yield place, km, station
+
+
+def format_suggestion(place, km, station):
+    return "{}: no station_id, nearest good station is {} {} ({:.1f} km)".format(
+        place["slug"], station["stationId"], station["geoGroupName"], km
+    )
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1].endswith(".db")
+    for suggestion in suggest_stations(sqlite_utils.Database(sys.argv[-1])):
+        print(format_suggestion(*suggestion))
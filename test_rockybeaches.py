@@ -1,32 +1,107 @@
 from datasette.app import Datasette
+from datasette.plugins import pm
+from benchmark import compare, predictions_csv, run_benchmarks
+from load_test import load_test, parse_mix, synthesize_database
 from yaml_to_sqlite.cli import cli as yaml_to_sqlite_cli
+from fetch_inaturalist import Harvester, TokenBucket, collect_place, save_place
+from fetch_noaa_tide_times import (
+    ensure_tide_heights,
+    fetch_noaa_tide_times_async,
+    month_ranges,
+    prediction_window,
+    save_predictions,
+    station_ids_for_places,
+)
+from fetch_noaa_stations import fetch_noaa_stations_async
+from fetch_noaa_harmonics import fetch_noaa_harmonics_async
+from harmonic_tides import (
+    constituent_speed,
+    fill_predictions,
+    predict,
+    stations_missing_days,
+)
+from pack_tide_days import pack_tide_days
+from http_cache import CachingTransport, ResponseCache
+from calculate_daily_tide_summary import (
+    calculate_daily_tide_summary,
+    refresh_daily_tide_summary,
+)
+from build import (
+    STAGE_NAMES,
+    Stage,
+    check_stages,
+    load_yaml,
+    prune_removed,
+    run_stages,
+    site_stages,
+)
+from build_place_cards import refresh_place_cards
+from suggest_stations import suggest_stations
+from calculate_sunrise_sunset import (
+    calculate_sunrise_sunset,
+    calculate_sunrise_sunset_for_places,
+    refresh_sunrise_sunset,
+)
 from plugins.template_vars import (
+    calculate_sun_info,
     extra_template_vars,
+    find_extrema,
     get_minimas_maximas,
     calculate_depth_view,
+    day_to_minute,
+    simplify_curve,
+    unpack_tide_day,
+    SVG_TOLERANCE,
 )
+from plugins.urls import PageCache
+from plugins.best_low_tides import LowTideIndex
+from plugins.nearby import KDTree, chord_to_km, unit_vector
+from plugins.server_timing import Histogram
+from prerender_places import prerender
+import asyncio
+import brotli
+import click
 import httpx
 import datetime
+import gzip
+import json
+import math
+import numpy
 import pytest
 import pytest_asyncio
 import pathlib
 import sqlite_utils
+import time
+import tracemalloc
+import urllib.parse
+import yaml
 
 root = pathlib.Path(__file__).parent.resolve()
 
 
 @pytest.fixture
-def db_path(tmpdir):
+def places_db_path(tmpdir):
     db_path = str(tmpdir / "data.db")
     yaml_to_sqlite_cli.callback(
         db_path, "places", open(root / "airtable" / "tidepool_areas.yml"), "slug", None
     )
+    return db_path
+
+
+@pytest.fixture
+def db_path(places_db_path):
+    db_path = places_db_path
     db = sqlite_utils.Database(db_path)
     # Fake tide data
     station_ids = {p["station_id"] for p in db["places"].rows if p["station_id"]}
     for station_id in station_ids:
-        db["tide_predictions"].insert_all(
-            generate_tide_data(station_id), pk=("station_id", "datetime")
+        save_predictions(
+            db,
+            station_id,
+            [
+                {"t": row["datetime"], "v": str(row["mllw_feet"])}
+                for row in generate_tide_data(station_id)
+            ],
         )
     return db_path
 
@@ -51,6 +126,568 @@ async def test_live_pages(ds):
             assert response.status_code == 200, slug
 
 
+@pytest.mark.asyncio
+async def test_place_page_etag(ds, db_path):
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get("http://localhost/us/pillar-point")
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == "max-age=0, s-maxage=600"
+        etag = response.headers["etag"]
+        # Cached page is identical
+        response2 = await client.get("http://localhost/us/pillar-point")
+        assert response2.headers["etag"] == etag
+        assert response2.text == response.text
+        not_modified = await client.get(
+            "http://localhost/us/pillar-point",
+            headers={"if-none-match": 'W/"other", ' + etag},
+        )
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == etag
+        assert not_modified.content == b""
+        # Requests with a query string, cookie or actor get their own render
+        for kwargs in (
+            {"params": {"_shape": "objects"}},
+            {"headers": {"cookie": "ds_actor=x"}},
+            {"headers": {"authorization": "Bearer x"}},
+        ):
+            uncached = await client.get("http://localhost/us/pillar-point", **kwargs)
+            assert uncached.status_code == 200
+            assert "etag" not in uncached.headers
+        # Changing the database invalidates the cached page
+        sqlite_utils.Database(db_path)["places"].update(
+            "pillar-point", {"name": "Pillar Point Reef"}
+        )
+        response3 = await client.get(
+            "http://localhost/us/pillar-point", headers={"if-none-match": etag}
+        )
+        assert response3.status_code == 200
+        assert response3.headers["etag"] != etag
+        assert "Pillar Point Reef" in response3.text
+        # Unknown places are not cached
+        missing = await client.get("http://localhost/us/not-a-place")
+        assert missing.status_code == 404
+        assert "etag" not in missing.headers
+
+
+def parse_server_timing(header):
+    # {name: (milliseconds or None, description or None)}
+    metrics = {}
+    for metric in header.split(", "):
+        name, *params = metric.split(";")
+        params = dict(param.split("=", 1) for param in params)
+        metrics[name] = (
+            float(params["dur"]) if "dur" in params else None,
+            params.get("desc", "").strip('"') or None,
+        )
+    return metrics
+
+
+@pytest.mark.asyncio
+async def test_server_timing(ds, monkeypatch):
+    # Break down SQL on every request, not just a sample
+    monkeypatch.setattr(pm.get_plugin("server_timing.py"), "SQL_SAMPLE_EVERY", 1)
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        # Only for root, as it is not meant to be public
+        denied = await client.get("http://localhost/-/timings.json")
+        assert denied.status_code == 403
+        root = {"cookie": "ds_actor=" + ds.sign({"a": {"id": "root"}}, "actor")}
+        before = (
+            await client.get("http://localhost/-/timings.json", headers=root)
+        ).json()
+        response = await client.get("http://localhost/us/pillar-point")
+        metrics = parse_server_timing(response.headers["server-timing"])
+        assert metrics["cache"] == (None, "miss")
+        assert {"total", "render", "sql", "other_sql", "jinja"} <= set(metrics)
+        assert metrics["render"][0] <= metrics["total"][0]
+        cached = await client.get("http://localhost/us/pillar-point")
+        metrics = parse_server_timing(cached.headers["server-timing"])
+        assert metrics["cache"] == (None, "hit")
+        assert "render" not in metrics
+        # Template functions are timed, including the queries they run
+        response = await client.get(
+            "http://localhost/us/pillar-point/tides.json?start=2020-08-19&days=2"
+        )
+        metrics = parse_server_timing(response.headers["server-timing"])
+        assert {"tide_data_for_days", "tide_info", "astral", "functions"} <= set(
+            metrics
+        )
+        assert metrics["functions"][0] == metrics["tide_data_for_days"][0]
+        # Only the place lookup in tides_json itself is outside a function
+        assert metrics["other_sql"][0] < metrics["sql"][0]
+        timings = (
+            await client.get("http://localhost/-/timings.json", headers=root)
+        ).json()
+    assert timings["total"]["count"] - before.get("total", {}).get("count", 0) == 3
+    assert timings["tide_data_for_days"]["count"] >= 1
+    summary = timings["total"]
+    assert summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"]
+    assert summary["p99_ms"] <= summary["max_ms"]
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for ms in range(1, 101):
+        histogram.record(ms / 1000)
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert summary["mean_ms"] == pytest.approx(50.5)
+    for p in (50, 95, 99):
+        assert p <= summary["p{}_ms".format(p)] <= p * 2 ** (1 / 8)
+    assert summary["max_ms"] == 100
+
+
+@pytest.mark.asyncio
+async def test_prerendered_place_pages(tmpdir, db_path):
+    output_dir = pathlib.Path(tmpdir / "prerendered")
+    ds = Datasette(
+        [db_path],
+        plugins_dir=str(root / "plugins"),
+        static_mounts=[("prerendered", str(output_dir))],
+    )
+    await ds.invoke_startup()
+    manifest = await prerender(ds, output_dir, db_path)
+    live_slugs = [
+        r["slug"]
+        for r in sqlite_utils.Database(db_path)["places"].rows_where("live_on_site = 1")
+    ]
+    assert sorted(manifest["pages"]) == sorted(live_slugs)
+    page = manifest["pages"]["pillar-point"]
+    html = (output_dir / page["files"]["identity"]).read_bytes()
+    assert gzip.decompress((output_dir / page["files"]["gzip"]).read_bytes()) == html
+    assert brotli.decompress((output_dir / page["files"]["br"]).read_bytes()) == html
+    assert json.loads((output_dir / "manifest.json").read_text()) == manifest
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get(
+            "http://localhost/us/pillar-point", headers={"accept-encoding": "gzip"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert "accept-encoding" in response.headers["vary"]
+        assert response.headers["etag"] == '"{}-gzip"'.format(page["sha256"][:32])
+        assert response.content == html
+        br = await client.get(
+            "http://localhost/us/pillar-point",
+            headers={"accept-encoding": "gzip, br"},
+        )
+        assert br.headers["content-encoding"] == "br"
+        assert br.headers["etag"] == '"{}-br"'.format(page["sha256"][:32])
+        identity = await client.get(
+            "http://localhost/us/pillar-point",
+            headers={"accept-encoding": "gzip;q=0, identity"},
+        )
+        assert "content-encoding" not in identity.headers
+        assert identity.content == html
+        not_modified = await client.get(
+            "http://localhost/us/pillar-point",
+            headers={"if-none-match": identity.headers["etag"]},
+        )
+        assert not_modified.status_code == 304
+        # Pages rendered on a previous day are ignored
+        manifest["pages"]["pillar-point"]["day"] = "2020-08-18"
+        (output_dir / "manifest.json").write_text(json.dumps(manifest))
+        stale = await client.get("http://localhost/us/pillar-point")
+        assert stale.status_code == 200
+        # Rendered dynamically, so no compressed variant
+        assert "content-encoding" not in stale.headers
+        assert "accept-encoding" not in stale.headers["vary"]
+
+
+@pytest.mark.asyncio
+async def test_tides_json(ds):
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get(
+            "http://localhost/us/pillar-point/tides.json?start=2020-08-19&days=3"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json; charset=utf-8"
+        assert response.headers["content-encoding"] == "gzip"
+        data = response.json()
+        # 2020-08-19 has a full day of predictions, 2020-08-20 just one
+        # usable one and 2020-08-21 none
+        assert data["days"][2] == {"day": "2020-08-21"}
+        assert data["start"] == "2020-08-19"
+        assert data["height_scale"] == 1000
+        assert len(data["minutes"]) == len(data["heights"]) == 241
+        assert data["minutes"][-13] == 22 * 60 + 48
+        assert data["heights"][-13] == 6253
+        assert data["minutes"][-1] == 1440
+        assert data["days"][0] == {
+            "day": "2020-08-19",
+            "minimas": [
+                {"time": "05:42", "feet": -0.77},
+                {"time": "17:30", "feet": 1.979},
+            ],
+            "maximas": [
+                {"time": "12:12", "feet": 4.97},
+                {"time": "23:24", "feet": 6.397},
+            ],
+            "lowest_daylight_minima": {"time": "17:30", "feet": 1.979},
+            "dawn": "06:02:08",
+            "sunrise": "06:30:10",
+            "noon": "13:13:37",
+            "sunset": "19:57:24",
+            "dusk": "20:25:25",
+        }
+        not_modified = await client.get(
+            "http://localhost/us/pillar-point/tides.json?start=2020-08-19&days=3",
+            headers={"if-none-match": response.headers["etag"]},
+        )
+        assert not_modified.status_code == 304
+        for path, status in (
+            ("/us/pillar-point/tides.json?days=61", 400),
+            ("/us/pillar-point/tides.json?start=yesterday", 400),
+            ("/us/not-a-place/tides.json", 404),
+        ):
+            response = await client.get("http://localhost" + path)
+            assert response.status_code == status
+
+
+def test_low_tide_index_matches_sorting_everything():
+    rng = numpy.random.default_rng(0)
+    rows = []
+    for p in range(12):
+        for d in range(60):
+            rows.append(
+                {
+                    "place": "place-{}".format(p),
+                    "name": "Place {}".format(p),
+                    "region": "north" if p % 3 else "south",
+                    "time_zone": "America/Los_Angeles",
+                    "feet": round(float(rng.normal(0.5, 1)), 3),
+                    "day": (
+                        datetime.date(2021, 1, 1) + datetime.timedelta(days=d)
+                    ).isoformat(),
+                    "time": "12:00",
+                }
+            )
+    rows.sort(key=lambda r: (r["place"], r["feet"], r["day"]))
+    index = LowTideIndex(rows)
+    assert index.regions() == ["north", "south"]
+    for region, start, days, max_feet in (
+        (None, datetime.date(2021, 1, 1), 60, None),
+        ("north", datetime.date(2021, 1, 10), 14, None),
+        ("south", datetime.date(2021, 2, 1), 30, -0.5),
+        (None, datetime.date(2021, 1, 20), 7, -5.0),
+    ):
+        last = (start + datetime.timedelta(days=days - 1)).isoformat()
+        expected = sorted(
+            (r["feet"], r["day"], r["time"], r["place"])
+            for r in rows
+            if (region is None or r["region"] == region)
+            and start.isoformat() <= r["day"] <= last
+            and (max_feet is None or r["feet"] <= max_feet)
+        )[:10]
+        assert index.best(10, region, start, days, max_feet) == expected
+
+
+@pytest.mark.asyncio
+async def test_best_low_tides_json(db_path):
+    db = sqlite_utils.Database(db_path)
+    refresh_daily_tide_summary(db)
+    live = [
+        p["slug"]
+        for p in db["places"].rows_where(
+            "live_on_site = 1 and station_id is not null", order_by="slug"
+        )
+    ]
+    assert db["daylight_low_tides"].count == len(live)
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    await ds.invoke_startup()
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get(
+            "http://localhost/best-low-tides.json?start=2020-08-19&days=3&k=3"
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["start"] == "2020-08-19"
+        # Every station has the same fake predictions, so ties go by slug
+        assert [r["place"] for r in data["results"]] == live[:3]
+        assert data["results"][0] == {
+            "place": live[0],
+            "name": db["places"].get(live[0])["name"],
+            "region": "us_pacific_coast",
+            "day": "2020-08-19",
+            "time": "17:30",
+            "feet": 1.979,
+            "url": "/us/{}".format(live[0]),
+        }
+        for query, count in (
+            ("start=2020-08-19&region=us_pacific_coast&k=200", len(live)),
+            ("start=2020-08-19&max_feet=1.5", 0),
+            ("start=2020-08-20", 0),
+        ):
+            response = await client.get("http://localhost/best-low-tides.json?" + query)
+            assert len(response.json()["results"]) == count
+        for query, status in (
+            ("days=0", 400),
+            ("k=201", 400),
+            ("start=tomorrow", 400),
+            ("region=atlantis", 404),
+        ):
+            response = await client.get("http://localhost/best-low-tides.json?" + query)
+            assert response.status_code == status
+
+
+def test_kd_tree_matches_brute_force():
+    rng = numpy.random.default_rng(0)
+    points = [
+        (float(lat), float(lon), i)
+        for i, (lat, lon) in enumerate(
+            zip(rng.uniform(-90, 90, 500), rng.uniform(-180, 180, 500))
+        )
+    ]
+    tree = KDTree(points)
+    # Including either side of the antimeridian and a pole
+    for latitude, longitude in ((37.5, -122.5), (0.0, 179.9), (0.0, -179.9), (90, 0)):
+        target = unit_vector(latitude, longitude)
+        expected = sorted(
+            (chord_to_km(math.dist(unit_vector(lat, lon), target)), i)
+            for lat, lon, i in points
+        )[:7]
+        nearest = tree.nearest(latitude, longitude, 7)
+        assert [i for _, i in nearest] == [i for _, i in expected]
+        assert [km for km, _ in nearest] == pytest.approx([km for km, _ in expected])
+    assert KDTree([]).nearest(0, 0, 3) == []
+    assert len(tree.nearest(0, 0, 600)) == 500
+
+
+def add_noaa_stations(db):
+    db["noaa_stations"].insert_all(
+        [
+            {
+                "stationId": "9414290",
+                "geoGroupName": "San Francisco",
+                "lat": 37.8067,
+                "lon": -122.465,
+                "good": 1,
+            },
+            {
+                "stationId": "9414131",
+                "geoGroupName": "Pillar Point Harbor",
+                "lat": 37.5025,
+                "lon": -122.4822,
+                "good": 1,
+            },
+            {
+                "stationId": "9414523",
+                "geoGroupName": "Redwood City",
+                "lat": 37.5067,
+                "lon": -122.2100,
+                "good": 0,
+            },
+        ],
+        pk="stationId",
+    )
+
+
+@pytest.mark.asyncio
+async def test_near(db_path):
+    add_noaa_stations(sqlite_utils.Database(db_path))
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    await ds.invoke_startup()
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        # Pillar Point Harbor
+        response = await client.get("http://localhost/near?lat=37.495&lon=-122.497&k=2")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["places"][0]["slug"] == "pillar-point"
+        assert data["places"][0]["url"] == "/us/pillar-point"
+        assert data["places"][0]["km"] < 2
+        assert data["places"][0]["km"] <= data["places"][1]["km"]
+        # Redwood City is closer than San Francisco but not a good station
+        assert [s["station_id"] for s in data["stations"]] == ["9414131", "9414290"]
+        assert data["stations"][1]["km"] == pytest.approx(34.77, abs=0.01)
+        for query in ("lat=37.5", "lat=91&lon=0", "lat=37.5&lon=-122.5&k=0", "lat=x"):
+            response = await client.get("http://localhost/near?" + query)
+            assert response.status_code == 400
+
+
+def test_suggest_stations(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    # No stations have been fetched yet
+    assert list(suggest_stations(db)) == []
+    add_noaa_stations(db)
+    suggestions = {
+        place["slug"]: (km, station["stationId"])
+        for place, km, station in suggest_stations(db)
+    }
+    # Places with no location get no suggestion
+    assert len(suggestions) == db["places"].count_where(
+        "station_id is null and latitude is not null"
+    )
+    km, station_id = suggestions["seal-cove"]
+    assert station_id == "9414131"
+    assert km < 5
+    km, station_id = suggestions["muir-beach"]
+    assert station_id == "9414290"
+
+
+@pytest.mark.asyncio
+async def test_run_stages(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "build.db"))
+    db["rows"].create({"stage": str, "n": int})
+    events = []
+
+    def insert(stage, count):
+        with db.conn:
+            db["rows"].insert_all({"stage": stage, "n": n} for n in range(count))
+
+    async def write_later(stage, count):
+        await asyncio.sleep(0.01)
+        insert(stage, count)
+
+    async def fetch(stage, count):
+        # Writes in two halves, interleaved with the other fetch, the second
+        # from a task it starts
+        events.append(("start", stage))
+        insert(stage, count // 2)
+        await asyncio.gather(write_later(stage, count - count // 2))
+        events.append(("end", stage))
+
+    def fail():
+        raise ValueError("Failed")
+
+    stages = [
+        Stage("a", lambda: fetch("a", 5)),
+        Stage("b", lambda: fetch("b", 8)),
+        Stage("c", lambda: insert("c", 3), ["a", "b"]),
+        Stage("optional", fail, optional=True),
+        Stage("after_optional", lambda: insert("d", 1), ["optional"]),
+        Stage("required", fail),
+        Stage("after_required", lambda: insert("e", 1), ["required"]),
+    ]
+    results = await run_stages(stages, db)
+    assert {name: (r["status"], r["rows"]) for name, r in results.items()} == {
+        "a": ("ok", 5),
+        "b": ("ok", 8),
+        "c": ("ok", 3),
+        "optional": ("failed", 0),
+        "after_optional": ("ok", 1),
+        "required": ("failed", 0),
+        "after_required": ("skipped", 0),
+    }
+    # a and b ran at the same time
+    assert events.index(("start", "b")) < events.index(("end", "a"))
+    assert results["a"]["seconds"] >= 0.01
+    # Rerunning one stage alone, whatever it depends on
+    results = await run_stages(stages, db, only={"c"})
+    assert list(results) == ["c"]
+    assert results["c"]["rows"] == 3
+    assert db["rows"].count == 20
+
+
+def test_check_stages():
+    check_stages(site_stages(None, None, None))
+    for stages, message in (
+        ([Stage("a", None), Stage("a", None)], "Duplicate stage a"),
+        ([Stage("a", None, ["b"])], "a depends on unknown stage b"),
+        (
+            [Stage("a", None, ["b"]), Stage("b", None, ["a"])],
+            "Stages depend on each other: a",
+        ),
+    ):
+        with pytest.raises(ValueError) as e:
+            check_stages(stages)
+        assert str(e.value) == message
+
+
+@pytest.mark.asyncio
+async def test_site_stages_without_network(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    stages = site_stages(db, db_path, str(tmpdir / "prerendered"))
+    results = await run_stages(
+        stages, db, only={"load_stations", "load_places", "calculate_sunrise_sunset"}
+    )
+    assert all(r["status"] == "ok" for r in results.values())
+    assert results["load_places"]["rows"] == db["places"].count == 64
+    assert results["calculate_sunrise_sunset"]["rows"] > 0
+
+
+@pytest.mark.asyncio
+async def test_check_tide_coverage(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    db["places"].insert_all(
+        [
+            {"slug": "a", "live_on_site": 1, "station_id": 1},
+            {"slug": "b", "live_on_site": 1, "station_id": 2},
+            {"slug": "c", "live_on_site": None, "station_id": 3},
+        ],
+        pk="slug",
+    )
+    start_date, end_date = prediction_window()
+    days = (end_date - start_date).days + 1
+    ensure_tide_heights(db)
+    db["tide_heights"].insert_all(
+        {
+            "station_id": station_id,
+            "minute": day_to_minute(start_date) + 1440 * i,
+            "mllw_mft": 0,
+        }
+        for station_id in (1, 2)
+        for i in range(days if station_id == 1 else days - 3)
+    )
+    assert stations_missing_days(db, start_date, end_date) == {2: 3}
+    stages = site_stages(db, None, None)
+    results = await run_stages(stages, db, only={"check_tide_coverage"})
+    assert results["check_tide_coverage"]["status"] == "failed"
+
+
+def test_load_yaml_replaces_table_and_prunes_removed(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    places = [
+        {"slug": "a", "live_on_site": True, "station_id": 1},
+        {"slug": "b", "live_on_site": True, "station_id": 2},
+        {"slug": "c", "live_on_site": True, "station_id": 1},
+    ]
+    path = tmpdir / "places.yml"
+    path.write_text(yaml.dump(places), "utf-8")
+    load_yaml(db, "places", path, "slug")
+    for slug in "abc":
+        db["sunrise_sunset"].insert({"place": slug, "day": "2020-01-01"})
+        db["species_counts"].insert({"place": slug, "taxon": 1, "count": 1})
+        db["watermarks"].insert(
+            {"stage": "sunrise_sunset", "key": slug, "start": "", "end": ""}
+        )
+    for station_id in (1, 2):
+        db["tide_heights"].insert(
+            {"station_id": station_id, "minute": 0, "mllw_mft": 0}
+        )
+        db["watermarks"].insert(
+            {
+                "stage": "tide_predictions",
+                "key": str(station_id),
+                "start": "",
+                "end": "",
+            }
+        )
+    # b is removed and c is unpublished, leaving out its false live_on_site
+    path.write_text(yaml.dump([places[0], {"slug": "c", "station_id": 1}]), "utf-8")
+    load_yaml(db, "places", path, "slug")
+    prune_removed(db)
+    assert [(r["slug"], r["live_on_site"]) for r in db["places"].rows] == [
+        ("a", 1),
+        ("c", None),
+    ]
+    assert [r["place"] for r in db["sunrise_sunset"].rows] == ["a"]
+    assert [r["place"] for r in db["species_counts"].rows] == ["a"]
+    assert [r["station_id"] for r in db["tide_heights"].rows] == [1]
+    assert [(r["stage"], r["key"]) for r in db["watermarks"].rows] == [
+        ("sunrise_sunset", "a"),
+        ("tide_predictions", "1"),
+    ]
+
+
+def test_page_cache_evicts_least_recently_used():
+    cache = PageCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert list(cache.pages) == ["a", "c"]
+
+
 @pytest.mark.asyncio
 async def test_tide_data_for_place(ds):
     tide_data_for_place = extra_template_vars(ds)["tide_data_for_place"]
@@ -88,7 +725,17 @@ async def test_tide_data_for_place(ds):
         "time_pct": 95.0,
     }
     assert svg_points.startswith("0,6.7")
-    assert len(svg_points.split()) == 240
+    # Simplified, but never more than SVG_TOLERANCE away from the full curve
+    points = [tuple(map(float, p.split(","))) for p in svg_points.split()]
+    assert len(points) < 60
+    feet = [h["feet"] for h in heights]
+    full_curve = [100 - 100 * (f - min(feet)) / (max(feet) - min(feet)) for f in feet]
+    simplified = numpy.interp(range(240), *zip(*points))
+    assert max(abs(simplified - full_curve)) <= SVG_TOLERANCE + 0.005
+    # Every minima and maxima is still a point on the curve
+    xs = {x for x, _ in points}
+    for extremum in expected["minimas"] + expected["maximas"]:
+        assert heights.index(extremum) in xs
 
 
 @pytest.mark.asyncio
@@ -98,6 +745,1099 @@ async def test_tide_data_for_place_if_day_not_available(ds):
     assert tide_data is None
 
 
+@pytest.mark.asyncio
+async def test_tide_data_for_days(ds):
+    template_vars = extra_template_vars(ds)
+    days = [datetime.date(2020, 8, d) for d in (18, 19, 25)]
+    results = await template_vars["tide_data_for_days"]("pillar-point", days)
+    assert [day for day, _ in results] == days
+    # Should match the single-day lookup for every day in the window
+    for day, tide_data in results:
+        assert tide_data == await template_vars["tide_data_for_place"](
+            "pillar-point", day
+        )
+    assert results[1][1]["lowest_tide"] == {
+        "time": "05:42",
+        "time_pct": 23.75,
+        "feet": -0.77,
+    }
+    assert results[0][1] is None
+    assert results[2][1] is None
+
+
+@pytest.mark.asyncio
+async def test_tide_data_for_place_uses_daily_tide_summary(db_path):
+    db = sqlite_utils.Database(db_path)
+    place = db["places"].get("pillar-point")
+    tide_times = list(
+        db["tide_heights"].rows_where(
+            "station_id = ?", [place["station_id"]], order_by="minute"
+        )
+    )
+    db["daily_tide_summary"].insert_all(
+        calculate_daily_tide_summary(place, tide_times), pk=("place", "day")
+    )
+    assert [r["day"] for r in db["daily_tide_summary"].rows] == [
+        "2020-08-19",
+        "2020-08-20",
+    ]
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    tide_data_for_place = extra_template_vars(ds)["tide_data_for_place"]
+    day = datetime.date(2020, 8, 19)
+    summary_tide_data = await tide_data_for_place("pillar-point", day)
+    # Should match the live calculation, which is used for other places
+    db["daily_tide_summary"].delete_where()
+    assert summary_tide_data == await tide_data_for_place("pillar-point", day)
+    # Prove the summary row is what gets read
+    db["daily_tide_summary"].insert(
+        dict(
+            next(calculate_daily_tide_summary(place, tide_times)),
+            svg_points="0,0",
+        )
+    )
+    assert (await tide_data_for_place("pillar-point", day))["svg_points"] == "0,0"
+
+
+@pytest.mark.asyncio
+async def test_tide_data_for_place_uses_tide_days(db_path):
+    db = sqlite_utils.Database(db_path)
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    tide_data_for_days = extra_template_vars(ds)["tide_data_for_days"]
+    days = [datetime.date(2020, 8, d) for d in (18, 19, 20)]
+    expected = await tide_data_for_days("pillar-point", days)
+    pack_tide_days(db)
+    # Only 2020-08-19 is a complete day
+    assert [r["day"] for r in db["tide_days"].rows_where("station_id = 9414131")] == [
+        18493
+    ]
+    heights = unpack_tide_day(db["tide_days"].get((9414131, 18493))["heights"])
+    assert len(heights) == 240
+    assert heights[57] == -770
+    # Packed day is used in place of the rows, which are still used for
+    # the incomplete days either side
+    db["tide_heights"].delete_where(
+        "station_id = 9414131 and minute >= ? and minute < ?",
+        [18493 * 1440, 18494 * 1440],
+    )
+    assert await tide_data_for_days("pillar-point", days) == expected
+
+
+@pytest.mark.asyncio
+async def test_tide_data_for_place_uses_sunrise_sunset(db_path):
+    db = sqlite_utils.Database(db_path)
+    place = db["places"].get("pillar-point")
+    day = datetime.date(2020, 8, 19)
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    tide_data_for_place = extra_template_vars(ds)["tide_data_for_place"]
+    astral_tide_data = await tide_data_for_place("pillar-point", day)
+    sun_infos = calculate_sunrise_sunset(place, day, day)
+    assert sun_infos == [
+        {
+            "place": "pillar-point",
+            "day": "2020-08-19",
+            "dawn": "06:02:08",
+            "dawn_pct": 25.15,
+            "sunrise": "06:30:10",
+            "sunrise_pct": 27.09,
+            "noon": "13:13:37",
+            "noon_pct": 55.11,
+            "sunset": "19:57:24",
+            "sunset_pct": 83.15,
+            "dusk": "20:25:25",
+            "dusk_pct": 85.1,
+        }
+    ]
+    db["sunrise_sunset"].insert_all(sun_infos, pk=("place", "day"))
+    assert await tide_data_for_place("pillar-point", day) == astral_tide_data
+    # Prove the table is what gets read
+    db["sunrise_sunset"].update(("pillar-point", "2020-08-19"), {"noon_pct": 50.0})
+    assert (await tide_data_for_place("pillar-point", day))["noon_pct"] == 50.0
+
+
+def test_calculate_sunrise_sunset_for_places_matches_astral(db_path):
+    db = sqlite_utils.Database(db_path)
+    places = [db["places"].get("pillar-point"), db["places"].get("laguna-point")]
+    # A year, including both daylight saving time transitions
+    start = datetime.date(2020, 1, 1)
+    day_infos = calculate_sunrise_sunset_for_places(
+        places, start, datetime.date(2020, 12, 31)
+    )
+    assert len(day_infos) == 2 * 366
+    for day_info in day_infos:
+        place = db["places"].get(day_info.pop("place"))
+        day = datetime.date.fromisoformat(day_info.pop("day"))
+        assert day_info == calculate_sun_info(place, day), (place["slug"], day)
+
+
+class FakeDatagetter:
+    # ASGI stand-in for the NOAA datagetter API, serving generate_tide_data()
+    def __init__(self, failures=None):
+        # {station_id: number of 503 responses to return before succeeding}
+        self.failures = dict(failures or {})
+        self.requests = []
+        self.date_ranges = []
+
+    async def __call__(self, scope, receive, send):
+        params = dict(urllib.parse.parse_qsl(scope["query_string"].decode("utf-8")))
+        station_id = params["station"]
+        self.requests.append(station_id)
+        self.date_ranges.append((params["begin_date"], params["end_date"]))
+        if self.failures.get(station_id):
+            self.failures[station_id] -= 1
+            status, body = 503, b"Service Unavailable"
+        else:
+            # The rows for the requested days, in YYYY-MM-DD format
+            begin, end = (
+                "{}-{}-{}".format(d[:4], d[4:6], d[6:])
+                for d in (params["begin_date"], params["end_date"])
+            )
+            predictions = [
+                {"t": row["datetime"], "v": "{:.3f}".format(row["mllw_feet"])}
+                for row in generate_tide_data(int(station_id))
+                if begin <= row["datetime"][:10] <= end
+            ]
+            status, body = 200, predictions_csv(predictions).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/csv")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    station_ids = station_ids_for_places(db)
+    app = FakeDatagetter(failures={"9414131": 2})
+    await fetch_noaa_tide_times_async(
+        db,
+        station_ids,
+        concurrency=2,
+        backoff=0,
+        transport=httpx.ASGITransport(app=app),
+        today=datetime.date(2020, 8, 19),
+    )
+    # One request per month from 2020-08-18 to 2021-08-18, plus two retries
+    assert sorted(app.requests) == sorted(
+        [str(station_id) for station_id in station_ids] * 13 + ["9414131"] * 2
+    )
+    assert app.date_ranges[0] == ("20200818", "20200831")
+    assert ("20210801", "20210818") in app.date_ranges
+    assert db["tide_predictions"].count == len(station_ids) * len(generate_tide_data(0))
+    assert db["tide_heights"].get((9414131, 26630262)) == {
+        "station_id": 9414131,
+        "minute": 26630262,
+        "mllw_mft": -770,
+    }
+    # The tide_predictions view has the original columns
+    assert list(
+        db.query(
+            "select * from tide_predictions where station_id = 9414131 "
+            "and datetime = '2020-08-19 05:42'"
+        )
+    ) == [{"station_id": 9414131, "datetime": "2020-08-19 05:42", "mllw_feet": -0.77}]
+
+
+class StalledStream(httpx.AsyncByteStream):
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        yield self.body[: len(self.body) // 2]
+        raise httpx.ReadTimeout("Stalled part way through the body")
+
+
+class StallOnceTransport(httpx.AsyncBaseTransport):
+    # Cuts off the body of the first response with a read timeout, like a
+    # connection that stalls after the headers
+    def __init__(self, transport):
+        self.transport = transport
+        self.stalled = False
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        if self.stalled:
+            return response
+        self.stalled = True
+        body = await response.aread()
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=StalledStream(body),
+        )
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async_retries_stalled_body(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    app = FakeDatagetter()
+    await fetch_noaa_tide_times_async(
+        db,
+        [9414131],
+        backoff=0,
+        transport=StallOnceTransport(httpx.ASGITransport(app=app)),
+        today=datetime.date(2020, 8, 19),
+    )
+    # The first month was requested again after its body stalled
+    assert app.requests == ["9414131"] * 14
+    assert app.date_ranges[0] == app.date_ranges[1] == ("20200818", "20200831")
+    assert db["tide_heights"].count == len(generate_tide_data(0))
+
+
+def test_month_ranges():
+    assert month_ranges(datetime.date(2020, 1, 30), datetime.date(2020, 3, 1)) == [
+        (datetime.date(2020, 1, 30), datetime.date(2020, 1, 31)),
+        (datetime.date(2020, 2, 1), datetime.date(2020, 2, 29)),
+        (datetime.date(2020, 3, 1), datetime.date(2020, 3, 1)),
+    ]
+    assert month_ranges(datetime.date(2020, 12, 5), datetime.date(2020, 12, 5)) == [
+        (datetime.date(2020, 12, 5), datetime.date(2020, 12, 5))
+    ]
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async_noaa_error(places_db_path):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send(
+            {
+                "type": "http.response.body",
+                "body": b" Error: No Predictions data was found.",
+            }
+        )
+
+    db = sqlite_utils.Database(places_db_path)
+    with pytest.raises(ValueError) as e:
+        await fetch_noaa_tide_times_async(
+            db, [9414131], transport=httpx.ASGITransport(app=app)
+        )
+    assert str(e.value) == (
+        "NOAA error for station 9414131: Error: No Predictions data was found."
+    )
+    assert not db["watermarks"].exists()
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async_memory(tmpdir):
+    # Peak memory should not grow with the number of days fetched
+    today = datetime.date(2021, 1, 1)
+
+    async def app(scope, receive, send):
+        # A 6 minute sine wave for the requested days, as CSV
+        params = dict(urllib.parse.parse_qsl(scope["query_string"].decode("utf-8")))
+        begin = datetime.datetime.strptime(params["begin_date"], "%Y%m%d")
+        end = datetime.datetime.strptime(params["end_date"], "%Y%m%d")
+        predictions = [
+            {
+                "t": (begin + datetime.timedelta(minutes=m)).strftime("%Y-%m-%d %H:%M"),
+                "v": "{:.3f}".format(3 + 3 * math.sin(m / 745 * 2 * math.pi)),
+            }
+            for m in range(0, ((end - begin).days + 1) * 1440, 6)
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send(
+            {
+                "type": "http.response.body",
+                "body": predictions_csv(predictions).encode(),
+            }
+        )
+
+    async def peak_memory(days):
+        db = sqlite_utils.Database(str(tmpdir / "{}.db".format(days)))
+        tracemalloc.start()
+        try:
+            await fetch_noaa_tide_times_async(
+                db,
+                [9400000],
+                transport=httpx.ASGITransport(app=app),
+                today=today,
+                days=days,
+            )
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert db["tide_heights"].count == (days + 1) * 240
+        return peak
+
+    # Warm up anything imported or cached on first use
+    await peak_memory(0)
+    one_year = await peak_memory(365)
+    two_years = await peak_memory(730)
+    # Decoding a year as one JSON response peaked at around 30MB. Closed
+    # responses wait for the cyclic garbage collector, so memory creeps up
+    # a little over the first months before levelling off.
+    assert two_years < 8 * 1024 * 1024
+    assert two_years < one_year * 1.25
+
+
+def test_ensure_tide_heights_migrates_tide_predictions_table(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    db["tide_predictions"].insert_all(
+        generate_tide_data(9414131), pk=("station_id", "datetime")
+    )
+    ensure_tide_heights(db)
+    assert "tide_predictions" in db.view_names()
+    assert db["tide_heights"].count == len(generate_tide_data(0))
+    assert list(
+        db.query("select * from tide_predictions order by datetime")
+    ) == generate_tide_data(9414131)
+    assert "WITHOUT ROWID" in db["tide_heights"].schema.upper()
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async_incremental(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+
+    async def fetch(today, full=False):
+        app = FakeDatagetter()
+        await fetch_noaa_tide_times_async(
+            db,
+            [9414131],
+            transport=httpx.ASGITransport(app=app),
+            full=full,
+            today=today,
+        )
+        return app.date_ranges
+
+    def months(begin, end):
+        return [
+            (b.strftime("%Y%m%d"), e.strftime("%Y%m%d"))
+            for b, e in month_ranges(begin, end)
+        ]
+
+    assert await fetch(datetime.date(2020, 8, 19)) == months(
+        datetime.date(2020, 8, 18), datetime.date(2021, 8, 18)
+    )
+    assert db["watermarks"].get(("tide_predictions", "9414131")) == {
+        "stage": "tide_predictions",
+        "key": "9414131",
+        "start": "2020-08-18",
+        "end": "2021-08-18",
+    }
+    # Nothing new to fetch on the same day
+    assert await fetch(datetime.date(2020, 8, 19)) == []
+    # Next day only fetches the new day, and prunes the day that fell out
+    assert db["tide_predictions"].count == len(generate_tide_data(0))
+    assert await fetch(datetime.date(2020, 8, 20)) == [("20210819", "20210819")]
+    assert db["tide_predictions"].count == len(generate_tide_data(0)) - 1
+    assert db["watermarks"].get(("tide_predictions", "9414131"))["end"] == (
+        "2021-08-19"
+    )
+    # full=True ignores the watermark
+    assert await fetch(datetime.date(2020, 8, 20), full=True) == months(
+        datetime.date(2020, 8, 19), datetime.date(2021, 8, 19)
+    )
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_tide_times_async_gives_up(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    app = FakeDatagetter(failures={"9414131": 3})
+    with pytest.raises(httpx.HTTPStatusError):
+        await fetch_noaa_tide_times_async(
+            db,
+            [9414131],
+            retries=2,
+            backoff=0,
+            transport=httpx.ASGITransport(app=app),
+        )
+    assert app.requests == ["9414131"] * 3
+
+
+def test_refresh_sunrise_sunset_incremental(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    live_places = db["places"].count_where("live_on_site = 1")
+    refresh_sunrise_sunset(db, today=datetime.date(2020, 8, 19))
+    assert db["sunrise_sunset"].count == live_places * 546
+    # Tamper with a row, an incremental refresh should leave it alone
+    db["sunrise_sunset"].update(("pillar-point", "2020-08-19"), {"noon": "tampered"})
+    refresh_sunrise_sunset(db, today=datetime.date(2020, 8, 20))
+    assert db["sunrise_sunset"].count == live_places * 546
+    days = [r["day"] for r in db["sunrise_sunset"].rows_where("place = 'pillar-point'")]
+    assert min(days) == "2020-02-22"
+    assert max(days) == "2021-08-20"
+    assert db["sunrise_sunset"].get(("pillar-point", "2020-08-19"))["noon"] == (
+        "tampered"
+    )
+    refresh_sunrise_sunset(db, full=True, today=datetime.date(2020, 8, 20))
+    assert db["sunrise_sunset"].get(("pillar-point", "2020-08-19"))["noon"] == (
+        "13:13:37"
+    )
+
+
+def test_fetch_inaturalist_pipeline(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    crab = {"id": 1, "name": "Pachygrapsus crassipes"}
+    crab_with_photo = dict(crab, default_photo={"medium_url": "crab.jpg"})
+    anemone = {"id": 2, "name": "Anthopleura sola"}
+    seen_taxa = {}
+    taxons, species_counts, observations = collect_place(
+        {"slug": "pillar-point"},
+        [{"taxon": crab, "count": 3}, {"taxon": anemone, "count": 1}],
+        [{"id": 10, "taxon": crab, "observed_on": "2020-08-19"}],
+        seen_taxa,
+    )
+    # The observation's taxon was already collected from species_counts
+    assert taxons == [crab, anemone]
+    assert species_counts == [
+        {"place": "pillar-point", "taxon": 1, "count": 3},
+        {"place": "pillar-point", "taxon": 2, "count": 1},
+    ]
+    assert observations == [
+        {"place": "pillar-point", "taxon": 1, "id": 10, "observed_on": "2020-08-19"}
+    ]
+    save_place(db, taxons, species_counts, observations)
+    taxons, species_counts, observations = collect_place(
+        {"slug": "fitzgerald-marine-reserve"},
+        [{"taxon": anemone, "count": 5}, {"taxon": crab_with_photo, "count": 2}],
+        [],
+        seen_taxa,
+    )
+    # Only the crab is written again, because it has a new key
+    assert taxons == [crab_with_photo]
+    save_place(db, taxons, species_counts, observations)
+    assert list(db["taxons"].rows) == [
+        {
+            "id": 1,
+            "name": "Pachygrapsus crassipes",
+            "default_photo": '{"medium_url": "crab.jpg"}',
+        },
+        {"id": 2, "name": "Anthopleura sola", "default_photo": None},
+    ]
+    assert db["species_counts"].count == 4
+    assert db["observations"].count == 1
+
+
+@pytest.mark.asyncio
+async def test_place_cards(db_path):
+    db = sqlite_utils.Database(db_path)
+    crab = {
+        "id": 1,
+        "name": "Pachygrapsus crassipes",
+        "preferred_common_name": "Striped Shore Crab",
+        "default_photo": {"medium_url": "crab.jpg"},
+    }
+    anemone = {"id": 2, "name": "Anthopleura sola"}
+    observations = [
+        {
+            "id": i,
+            "taxon": crab if i % 2 else anemone,
+            "observed_on": "2020-08-{:02d}".format(i),
+            "quality_grade": "research" if i != 29 else "needs_id",
+            "user": {"login": "user{}".format(i)},
+            "observation_photos": [
+                {"photo": {"url": "https://x/{}/square.jpg".format(i)}}
+            ],
+        }
+        for i in range(1, 31)
+    ]
+    save_place(
+        db,
+        *collect_place(
+            {"slug": "pillar-point"},
+            [{"taxon": anemone, "count": 5}, {"taxon": crab, "count": 9}],
+            observations,
+            {},
+        )
+    )
+    refresh_place_cards(db)
+    ds = Datasette([db_path], plugins_dir=str(root / "plugins"))
+    template_vars = extra_template_vars(ds)
+    assert await template_vars["species_cards"]("pillar-point") == [
+        {
+            "place": "pillar-point",
+            "rank": 1,
+            "taxon_id": 1,
+            "common_name": "Striped Shore Crab",
+            "latin_name": "Pachygrapsus crassipes",
+            "photo_url": "crab.jpg",
+            "count": 9,
+        },
+        {
+            "place": "pillar-point",
+            "rank": 2,
+            "taxon_id": 2,
+            "common_name": None,
+            "latin_name": "Anthopleura sola",
+            "photo_url": None,
+            "count": 5,
+        },
+    ]
+    observation_cards = await template_vars["observation_cards"]("pillar-point")
+    # The 24 most recent research grade observations
+    assert [card["observation_id"] for card in observation_cards] == [
+        30,
+        28,
+        27,
+    ] + list(range(26, 5, -1))
+    assert observation_cards[0] == {
+        "place": "pillar-point",
+        "rank": 1,
+        "observation_id": 30,
+        "common_name": None,
+        "latin_name": "Anthopleura sola",
+        "photo_url": "https://x/30/medium.jpg",
+        "user_login": "user30",
+        "observed_on": "2020-08-30",
+    }
+    assert await template_vars["observation_cards"]("fitzgerald-marine-reserve") == []
+
+
+class FakeINaturalist:
+    # ASGI stand-in for the iNaturalist API, with 7 species and 25 observations
+    # near every place by default. Returns a 400 for the request numbered
+    # fail_on_request.
+    def __init__(self, fail_on_request=None, species=7, observations=25):
+        self.fail_on_request = fail_on_request
+        self.species = species
+        self.observations = observations
+        self.requests = []
+
+    async def __call__(self, scope, receive, send):
+        params = dict(urllib.parse.parse_qsl(scope["query_string"].decode("utf-8")))
+        per_page = int(params["per_page"])
+        self.requests.append((scope["path"], params))
+        if len(self.requests) == self.fail_on_request:
+            status, data = 400, {"error": "Bad request"}
+        elif scope["path"].endswith("/species_counts"):
+            page = int(params["page"])
+            species = [
+                {"count": 10 - i, "taxon": {"id": i, "name": "Taxon {}".format(i)}}
+                for i in range(1, self.species + 1)
+            ]
+            status = 200
+            data = {
+                "total_results": len(species),
+                "results": species[(page - 1) * per_page : page * per_page],
+            }
+        else:
+            id_below = int(params.get("id_below", 1000))
+            observations = [
+                {"id": i, "taxon": {"id": i % 7 + 1}, "observed_on": "2020-08-19"}
+                for i in range(self.observations, 0, -1)
+                if i < id_below
+            ]
+            status, data = 200, {"results": observations[:per_page]}
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+@pytest.mark.asyncio
+async def test_harvester_follows_pages(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    app = FakeINaturalist()
+    harvester = Harvester(
+        db,
+        rate=1000,
+        per_page=3,
+        max_pages=4,
+        transport=httpx.ASGITransport(app=app),
+    )
+    places = list(db["places"].rows_where("slug in ('pillar-point', 'china-beach')"))
+    await harvester.harvest(places)
+    requests = [
+        (path, params.get("page"), params.get("id_below"))
+        for path, params in app.requests
+        if params["lat"] == str(places[0]["latitude"])
+    ]
+    assert requests == [
+        ("/v1/observations/species_counts", "1", None),
+        ("/v1/observations/species_counts", "2", None),
+        ("/v1/observations/species_counts", "3", None),
+        ("/v1/observations", None, None),
+        ("/v1/observations", None, "23"),
+        ("/v1/observations", None, "20"),
+        # Capped at max_pages
+        ("/v1/observations", None, "17"),
+    ]
+    assert db["species_counts"].count == 14
+    assert db["taxons"].count == 7
+    # 4 pages of 3 observations, shared by both places
+    assert sorted(r["id"] for r in db["observations"].rows) == list(range(14, 26))
+    assert db["inaturalist_checkpoints"].count == 0
+
+
+@pytest.mark.asyncio
+async def test_harvester_resumes_from_checkpoint(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    places = list(db["places"].rows_where("slug = 'pillar-point'"))
+
+    def harvester(app):
+        return Harvester(
+            db, rate=1000, per_page=3, transport=httpx.ASGITransport(app=app)
+        )
+
+    interrupted = FakeINaturalist(fail_on_request=5)
+    with pytest.raises(httpx.HTTPStatusError):
+        await harvester(interrupted).harvest(places)
+    assert db["inaturalist_checkpoints"].get(("pillar-point", "observations")) == {
+        "place": "pillar-point",
+        "kind": "observations",
+        "cursor": 23,
+        "pages": 1,
+        "done": 0,
+    }
+    resumed = FakeINaturalist()
+    await harvester(resumed).harvest(places)
+    # Carries on with the page that failed
+    assert [params.get("id_below") for _, params in resumed.requests] == [
+        "23",
+        "20",
+        "17",
+        "14",
+    ]
+    assert db["observations"].count == 15
+
+
+@pytest.mark.asyncio
+async def test_harvester_replaces_previous_harvest(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    places = list(db["places"].rows_where("slug = 'pillar-point'"))
+    for app in (FakeINaturalist(), FakeINaturalist(species=4, observations=10)):
+        await Harvester(
+            db, rate=1000, per_page=3, transport=httpx.ASGITransport(app=app)
+        ).harvest(places)
+    # Species and observations iNaturalist stopped returning are gone
+    assert [r["taxon"] for r in db["species_counts"].rows_where(order_by="taxon")] == [
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert sorted(r["id"] for r in db["observations"].rows) == list(range(1, 11))
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        await bucket.acquire()
+    # Two tokens up front, then five more at 50 per second
+    assert time.monotonic() - start >= 0.09
+
+
+class FakeStationList:
+    # ASGI stand-in for the NOAA geogroup API, serving a gzipped station list
+    # with an ETag and answering matching If-None-Match requests with a 304
+    def __init__(self):
+        self.etag = '"v1"'
+        self.station_ids = ["9414131", "9414290"]
+        self.statuses = []
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        if headers.get(b"if-none-match") == self.etag.encode():
+            status, body, extra = 304, b"", []
+        else:
+            station_list = [{"stationId": s} for s in self.station_ids]
+            # Geogroups have no stationId
+            station_list.append({"stationId": None, "geoGroupName": "Marin"})
+            status = 200
+            body = gzip.compress(json.dumps({"stationList": station_list}).encode())
+            extra = [(b"content-encoding", b"gzip")]
+        self.statuses.append(status)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"etag", self.etag.encode()),
+                ]
+                + extra,
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+@pytest.mark.asyncio
+async def test_fetch_noaa_stations_uses_http_cache(tmpdir, places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    app = FakeStationList()
+    cache = ResponseCache(str(tmpdir / "http-cache.db"))
+    for _ in range(2):
+        await fetch_noaa_stations_async(
+            db, transport=httpx.ASGITransport(app=app), cache=cache
+        )
+    assert app.statuses == [200, 304]
+    assert [r["stationId"] for r in db["noaa_stations"].rows] == [
+        "9414131",
+        "9414290",
+    ]
+    assert cache.stats["api.tidesandcurrents.noaa.gov"] == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+    # A new ETag means a full response again
+    app.etag = '"v2"'
+    app.station_ids.append("9414317")
+    await fetch_noaa_stations_async(
+        db, transport=httpx.ASGITransport(app=app), cache=cache
+    )
+    assert app.statuses == [200, 304, 200]
+    assert db["noaa_stations"].count == 3
+    cache.save_stats()
+    assert list(cache.db["stats"].rows_where("host = 'total'")) == [
+        {"host": "total", "hits": 1, "misses": 2, "evictions": 0}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_response_cache_evicts_least_recently_used(tmpdir):
+    app = FakeStationList()
+    cache = ResponseCache(str(tmpdir / "http-cache.db"), max_bytes=250)
+    transport = CachingTransport(cache, httpx.ASGITransport(app=app))
+    async with httpx.AsyncClient(transport=transport) as client:
+        for path in ("/a", "/b", "/a", "/c"):
+            response = await client.get("https://example.com" + path)
+            assert len(response.json()["stationList"]) == 3
+    # Each body is around 110 bytes, so only two fit
+    assert app.statuses == [200, 200, 304, 200]
+    assert [r["url"] for r in cache.db["responses"].rows_where(order_by="url")] == [
+        "https://example.com/a",
+        "https://example.com/c",
+    ]
+    assert cache.stats["total"]["evictions"] == 1
+
+
+def test_benchmarks(tmpdir):
+    # Place pages need tides for the next 30 days
+    results = run_benchmarks(tmpdir, stations=2, places=3, days=32, repeat=2)
+    # Every stage of the real build
+    assert set(results["benchmarks"]) == {"build." + name for name in STAGE_NAMES} | {
+        "build.total",
+        "render.tide_data_for_place",
+        "render.get_tide_data_for_next_30_days",
+        "render.calculate_best_times",
+        "render.place_page",
+        "render.best_low_tides",
+    }
+    assert results["benchmarks"]["render.place_page"]["runs"] == 2
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    assert list(
+        db.query(
+            "select station_id, count(distinct minute / 1440) as days "
+            "from tide_heights group by station_id"
+        )
+    ) == [{"station_id": 9400000, "days": 32}, {"station_id": 9400001, "days": 32}]
+    assert db["places"].count_where("live_on_site = 1") == 3
+    assert db["tide_datums"].count == db["noaa_stations"].count == 2
+    assert db["species_counts"].count == 3 * 60
+
+
+def test_compare_benchmarks():
+    baseline = {
+        "benchmarks": {
+            "a": {"median": 1.0},
+            "b": {"median": 1.0},
+            "gone": {"median": 1.0},
+        }
+    }
+    results = {
+        "benchmarks": {"a": {"median": 1.2}, "b": {"median": 1.3}, "new": {"median": 1}}
+    }
+    assert compare(results, baseline, tolerance=0.25) == [
+        ("a", 1.0, 1.2, 1.2, False),
+        ("b", 1.0, 1.3, 1.3, True),
+        ("gone", 1.0, None, None, False),
+        ("new", None, 1, None, False),
+    ]
+
+
+@pytest.mark.parametrize("socket", [False, True])
+def test_load_test(tmpdir, socket):
+    db_path = synthesize_database(tmpdir, stations=1, places=3, days=32)
+    results = asyncio.run(
+        load_test(
+            db_path,
+            parse_mix("place_page=3,tides_json=1"),
+            concurrency=4,
+            duration=0.5,
+            warmup=0.2,
+            socket=socket,
+        )
+    )
+    assert set(results) == {"place_page", "tides_json", "overall"}
+    overall = results["overall"]
+    assert overall["requests"] == sum(
+        results[route]["requests"] for route in ("place_page", "tides_json")
+    )
+    assert overall["requests"] > 0
+    assert overall["errors"] == 0
+    assert overall["p50_ms"] <= overall["p95_ms"] <= overall["p99_ms"]
+
+
+def test_parse_mix():
+    assert parse_mix("place_page=9, tides_json") == [
+        ("place_page", 9.0),
+        ("tides_json", 1.0),
+    ]
+    with pytest.raises(click.BadParameter):
+        parse_mix("homepage=1")
+
+
+# Constituent speeds in degrees per hour, as published by NOAA
+NOAA_CONSTITUENT_SPEEDS = {
+    "M2": 28.9841042,
+    "S2": 30.0,
+    "N2": 28.4397295,
+    "K1": 15.0410686,
+    "M4": 57.9682084,
+    "O1": 13.9430356,
+    "M6": 86.9523127,
+    "MK3": 44.0251729,
+    "S4": 60.0,
+    "MN4": 57.4238337,
+    "NU2": 28.5125831,
+    "S6": 90.0,
+    "MU2": 27.9682084,
+    "2N2": 27.8953548,
+    "OO1": 16.1391017,
+    "LAM2": 29.4556253,
+    "S1": 15.0,
+    "M1": 14.4966939,
+    "J1": 15.5854433,
+    "MM": 0.5443747,
+    "SSA": 0.0821373,
+    "SA": 0.0410686,
+    "MSF": 1.0158958,
+    "MF": 1.0980331,
+    "RHO": 13.4715145,
+    "Q1": 13.3986609,
+    "T2": 29.9589333,
+    "R2": 30.0410667,
+    "2Q1": 12.8542862,
+    "P1": 14.9589314,
+    "2SM2": 31.0158958,
+    "M3": 43.4761563,
+    "L2": 29.5284789,
+    "2MK3": 42.9271398,
+    "K2": 30.0821373,
+    "M8": 115.9364166,
+    "MS4": 58.9841042,
+}
+
+
+@pytest.mark.parametrize("name,speed", NOAA_CONSTITUENT_SPEEDS.items())
+def test_constituent_speed(name, speed):
+    assert constituent_speed(name) == pytest.approx(speed, abs=1e-6)
+
+
+# NOAA's published harmonic constituents for Seattle, 9447130, as (name,
+# amplitude in metres, phase_GMT in degrees), and its MSL and MLLW datums in
+# metres above station datum, from the metadata API
+SEATTLE_HARCON = [
+    ("M2", 1.063, 10.8),
+    ("S2", 0.268, 36.8),
+    ("N2", 0.214, 341.1),
+    ("K1", 0.834, 276.8),
+    ("M4", 0.021, 200.7),
+    ("O1", 0.459, 254.6),
+    ("M6", 0.009, 312.8),
+    ("MK3", 0.036, 79.3),
+    ("S4", 0.002, 254.3),
+    ("MN4", 0.009, 172.7),
+    ("NU2", 0.044, 355.5),
+    ("S6", 0.0, 0.0),
+    ("MU2", 0.034, 238.9),
+    ("2N2", 0.023, 313.1),
+    ("OO1", 0.031, 330.2),
+    ("LAM2", 0.02, 49.9),
+    ("S1", 0.021, 45.0),
+    ("M1", 0.024, 304.1),
+    ("J1", 0.043, 313.4),
+    ("MM", 0.0, 0.0),
+    ("SSA", 0.024, 217.0),
+    ("SA", 0.07, 283.2),
+    ("MSF", 0.0, 0.0),
+    ("MF", 0.015, 157.0),
+    ("RHO", 0.015, 245.0),
+    ("Q1", 0.073, 248.9),
+    ("T2", 0.016, 38.0),
+    ("R2", 0.003, 11.2),
+    ("2Q1", 0.01, 265.5),
+    ("P1", 0.257, 276.2),
+    ("2SM2", 0.008, 284.4),
+    ("M3", 0.004, 178.0),
+    ("L2", 0.049, 58.7),
+    ("2MK3", 0.035, 48.5),
+    ("K2", 0.079, 37.7),
+    ("M8", 0.001, 204.4),
+    ("MS4", 0.012, 229.3),
+]
+SEATTLE_MSL = 4.443
+SEATTLE_MLLW = 2.419
+# NOAA's own high and low tide predictions for Seattle from the datagetter,
+# in GMT and metres above MLLW - a window no constituent was fitted to
+SEATTLE_HIGH_LOW = [
+    ("2015-01-01 03:40", 0.011, "L"),
+    ("2015-01-01 11:06", 3.091, "H"),
+    ("2015-01-01 15:51", 2.098, "L"),
+    ("2015-01-01 21:15", 3.537, "H"),
+    ("2015-01-02 04:26", -0.214, "L"),
+    ("2015-01-02 12:03", 3.355, "H"),
+    ("2015-01-02 17:00", 2.168, "L"),
+    ("2015-01-02 22:02", 3.452, "H"),
+]
+# How closely harmonic predictions must match NOAA's high and low tides
+HIGH_LOW_MINUTES = 8
+HIGH_LOW_METRES = 0.1
+
+
+def seattle_constituents():
+    return [
+        {"name": name, "amplitude": amplitude, "phase": phase}
+        for name, amplitude, phase in SEATTLE_HARCON
+    ]
+
+
+def high_lows(minutes, heights):
+    # [(minute, height, "H" or "L")] for the extrema in a series
+    minima, maxima = find_extrema(heights)
+    return sorted(
+        [(minutes[i], heights[i], "L") for i in minima]
+        + [(minutes[i], heights[i], "H") for i in maxima]
+    )
+
+
+def assert_matches_noaa_high_lows(predicted, utc_offset_minutes, minute_tolerance):
+    expected = [
+        (
+            datetime.datetime.strptime(t, "%Y-%m-%d %H:%M")
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+            // 60
+            + utc_offset_minutes,
+            metres,
+            kind,
+        )
+        for t, metres, kind in SEATTLE_HIGH_LOW
+    ]
+    assert [p[2] for p in predicted] == [e[2] for e in expected]
+    for (minute, metres, _), (noaa_minute, noaa_metres, _) in zip(predicted, expected):
+        assert abs(minute - noaa_minute) <= minute_tolerance
+        assert metres == pytest.approx(noaa_metres, abs=HIGH_LOW_METRES)
+
+
+def test_predict_matches_noaa_high_and_low_tides():
+    # Every minute of NOAA's window, 2015-01-01 to 2015-01-03 GMT
+    start = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    timestamps = start + 60 * numpy.arange(2 * 1440)
+    heights = predict(
+        seattle_constituents(), timestamps, SEATTLE_MSL - SEATTLE_MLLW
+    ).tolist()
+    minutes = (timestamps // 60).tolist()
+    assert_matches_noaa_high_lows(high_lows(minutes, heights), 0, HIGH_LOW_MINUTES)
+
+
+def test_fill_predictions_matches_noaa_high_and_low_tides(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    db["places"].insert(
+        {"slug": "seattle", "station_id": 9447130, "time_zone": "America/Los_Angeles"},
+        pk="slug",
+    )
+    db["harmonic_constituents"].insert_all(
+        [dict(c, station_id=9447130) for c in seattle_constituents()],
+        pk=("station_id", "name"),
+    )
+    db["tide_datums"].insert(
+        {"station_id": 9447130, "msl_above_mllw": SEATTLE_MSL - SEATTLE_MLLW},
+        pk="station_id",
+    )
+    # NOAA's window in PST, predicted in metres so stored as millimetres
+    fill_predictions(db, datetime.date(2014, 12, 31), datetime.date(2015, 1, 2))
+    rows = db.execute(
+        "select minute, mllw_mft from tide_heights where minute >= ? and minute < ?",
+        [
+            day_to_minute(datetime.date(2014, 12, 31)) + 16 * 60,
+            day_to_minute(datetime.date(2015, 1, 2)) + 16 * 60,
+        ],
+    ).fetchall()
+    predicted = high_lows([r[0] for r in rows], [r[1] / 1000 for r in rows])
+    # Heights are every 6 minutes, so extrema can be 3 minutes further out
+    assert_matches_noaa_high_lows(predicted, -8 * 60, HIGH_LOW_MINUTES + 3)
+
+
+class FakeMdapi:
+    # ASGI stand-in for the NOAA metadata API, with harmonic constituents for
+    # 9414131 only - every other station is subordinate
+    constituents = [
+        {"name": "M2", "amplitude": 2.0, "phase_GMT": 190.0, "speed": 28.9841042},
+        {"name": "K1", "amplitude": 1.2, "phase_GMT": 220.0, "speed": 15.0410686},
+        {"name": "M8", "amplitude": 0.0, "phase_GMT": 0.0, "speed": 115.9364166},
+    ]
+
+    async def __call__(self, scope, receive, send):
+        station_id, filename = scope["path"].split("/")[-2:]
+        if filename == "harcon.json":
+            data = {"HarmonicConstituents": []}
+            if station_id == "9414131":
+                data["HarmonicConstituents"] = self.constituents
+        else:
+            data = {
+                "datums": [
+                    {"name": "MSL", "value": 4.1},
+                    {"name": "MLLW", "value": 1.0},
+                ]
+            }
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+@pytest.mark.asyncio
+async def test_fill_predictions_from_harmonics(places_db_path):
+    db = sqlite_utils.Database(places_db_path)
+    await fetch_noaa_harmonics_async(
+        db,
+        station_ids_for_places(db),
+        transport=httpx.ASGITransport(app=FakeMdapi()),
+    )
+    assert [r["name"] for r in db["harmonic_constituents"].rows] == ["M2", "K1"]
+    assert list(db["tide_datums"].rows) == [
+        {"station_id": 9414131, "msl_above_mllw": pytest.approx(3.1)}
+    ]
+    # NOAA predictions for the first day are kept
+    save_predictions(db, 9414131, [{"t": "2021-03-13 00:00", "v": "9.999"}])
+    written = fill_predictions(
+        db, datetime.date(2021, 3, 13), datetime.date(2021, 3, 15)
+    )
+    assert written == 2
+    counts = db.execute(
+        "select minute / 1440, count(*) from tide_heights group by 1 order by 1"
+    ).fetchall()
+    # Daylight saving time started at 2am on the 14th
+    assert [count for _, count in counts] == [1, 230, 240]
+
+
+@pytest.mark.parametrize("tolerance", [0.1, 0.5, 2])
+def test_simplify_curve(tolerance):
+    ys = 50 + 40 * numpy.sin(numpy.linspace(0, 4 * numpy.pi, 240))
+    keep = [10, 100]
+    indexes = simplify_curve(ys, tolerance, keep)
+    assert indexes[0] == 0 and indexes[-1] == 239
+    assert set(keep) <= set(indexes)
+    simplified = numpy.interp(range(240), indexes, ys[indexes])
+    assert numpy.abs(simplified - ys).max() <= tolerance
+    assert len(indexes) < 120
+
+
 @pytest.mark.parametrize(
     "input,expected_minimas,expected_maximas",
     [
@@ -118,6 +1858,27 @@ def test_get_minimas_maximas(input, expected_minimas, expected_maximas):
     assert maximas == expected_maximas_reformatted
 
 
+@pytest.mark.parametrize(
+    "input,expected_minima_indexes,expected_maxima_indexes",
+    [
+        ([0.5, 0.4, 0.5], [1], []),
+        ([0.5, 0.4, 0.5, 0.3, 0.5], [1, 3], [2]),
+        # Plateaus are reported at their first index
+        ([0.5, 0.4, 0.4, 0.5, 0.3, 0.5], [1, 4], [3]),
+        ([0.1, 0.4, 0.4, 0.4, 0.3], [], [1]),
+        # A plateau running off either end is not an extremum
+        ([0.4, 0.4, 0.5, 0.3, 0.3], [], [2]),
+        # First value is never compared with the last one
+        ([0.3, 0.5, 0.4, 0.5], [2], [1]),
+        ([0.5, 0.4], [], []),
+    ],
+)
+def test_find_extrema(input, expected_minima_indexes, expected_maxima_indexes):
+    minima_indexes, maxima_indexes = find_extrema(input)
+    assert minima_indexes.tolist() == expected_minima_indexes
+    assert maxima_indexes.tolist() == expected_maxima_indexes
+
+
 @pytest.mark.parametrize(
     "min_tide,max_tide,today_lowest_tide,expected_left,expected_width",
     [
@@ -0,0 +1,44 @@
+import datetime
+
+# Records which days each build stage has data for, so incremental builds
+# only fetch or calculate the days that are missing from the current window
+
+
+def get_watermark(db, stage, key):
+    # Returns (start_date, end_date) or None if nothing has been recorded
+    if not db["watermarks"].exists():
+        return None
+    rows = list(db["watermarks"].rows_where("stage = ? and key = ?", [stage, str(key)]))
+    if not rows:
+        return None
+    return (
+        datetime.date.fromisoformat(rows[0]["start"]),
+        datetime.date.fromisoformat(rows[0]["end"]),
+    )
+
+
+def set_watermark(db, stage, key, start, end):
+    db["watermarks"].insert(
+        {
+            "stage": stage,
+            "key": str(key),
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+        },
+        pk=("stage", "key"),
+        replace=True,
+    )
+
+
+def missing_range(watermark, start, end):
+    # The (start, end) range of days in the window that is not yet covered by
+    # watermark, or None if the whole window is covered. Coverage that ends
+    # before the window starts is treated as no coverage.
+    if watermark is None:
+        return start, end
+    covered_start, covered_end = watermark
+    if covered_start > start or covered_end < start - datetime.timedelta(days=1):
+        return start, end
+    if covered_end >= end:
+        return None
+    return max(start, covered_end + datetime.timedelta(days=1)), end